@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# autobackup-dcm: benchmark of the Backup records used by rotation.
+# builds 100k backups with the previous ``__dict__`` based record (kept here as LegacyBackup) and with the
+# current :class:`core.rotate_dcm.Backup`, and reports the memory they take (tracemalloc) and the time to
+# create them, group them by period (:func:`RotateBackupsCM.group_backups()`) and read their type.
+#
+# run from this directory like the scripts: PYTHONPATH=.. python bench_backup_records.py --backups 100000
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import argparse
+import collections
+import datetime
+import gc
+import os
+import time
+import tracemalloc
+
+# Modules included in our package.
+from core.rotate_dcm import SUPPORTED_FREQUENCIES, Backup, RotateBackupsCM
+
+
+class LegacyBackup(object):
+    """The record used before, every period key is computed again on each access."""
+
+    def __init__(self, pathname, datetime):
+        self.pathname = pathname
+        self.datetime = datetime
+
+    @property
+    def type(self):
+        if os.path.islink(self.pathname):
+            return 'symbolic link'
+        elif os.path.isdir(self.pathname):
+            return 'directory'
+        else:
+            return 'file'
+
+    @property
+    def week(self):
+        return self.datetime.isocalendar()[1]
+
+    def __getattr__(self, name):
+        return getattr(self.datetime, name)
+
+    def __hash__(self):
+        return hash(self.pathname)
+
+
+def legacy_group_backups(backups):
+    backups_by_frequency = dict((frequency, collections.defaultdict(list)) for frequency in SUPPORTED_FREQUENCIES)
+    for b in backups:
+        backups_by_frequency['hourly'][(b.year, b.month, b.day, b.hour)].append(b)
+        backups_by_frequency['daily'][(b.year, b.month, b.day)].append(b)
+        backups_by_frequency['weekly'][(b.year, b.week)].append(b)
+        backups_by_frequency['monthly'][(b.year, b.month)].append(b)
+        backups_by_frequency['yearly'][b.year].append(b)
+    return backups_by_frequency
+
+
+def timestamps(count):
+    start = datetime.datetime(2000, 1, 1)
+    return [start + datetime.timedelta(hours=i) for i in range(count)]
+
+
+def measure(record, group, stamps, directory):
+    paths = [os.path.join(directory, 'jom_{:%Y-%m-%d_%H-%M}_hourly.gz'.format(stamp)) for stamp in stamps]
+    gc.collect()
+    tracemalloc.start()
+    backups = [record(path, stamp) for path, stamp in zip(paths, stamps)]
+    memory = tracemalloc.get_traced_memory()[0]  # the records only, paths and datetimes exist before
+    tracemalloc.stop()
+    del backups
+    gc.collect()
+
+    start = time.perf_counter()
+    backups = [record(path, stamp) for path, stamp in zip(paths, stamps)]
+    created = time.perf_counter() - start
+
+    start = time.perf_counter()
+    groups = group(backups)
+    grouped = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for backup in backups[:10000]:
+        backup.type
+        backup.type
+    typed = time.perf_counter() - start
+    return memory, created, grouped, typed, dict((f, len(g)) for f, g in groups.items())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backups', type=int, default=100000)
+    parser.add_argument('--dir', default='/tmp', help='directory the synthetic paths point to (for the type)')
+    args = parser.parse_args()
+
+    stamps = timestamps(args.backups)
+    rotate = RotateBackupsCM({'daily': 7})
+    print('{:<8} {:>12} {:>10} {:>10} {:>13}'.format('record', 'memory MiB', 'create s', 'group s', 'type x2 10k s'))
+    results = []
+    for name, record, group in (('legacy', LegacyBackup, legacy_group_backups),
+                                ('slots', lambda path, stamp: Backup(path, stamp, file_type='file'),
+                                 rotate.group_backups)):
+        memory, created, grouped, typed, groups = measure(record, group, stamps, args.dir)
+        results.append(groups)
+        print('{:<8} {:>12.1f} {:>10.3f} {:>10.3f} {:>13.3f}'.format(name, memory / 1024 / 1024, created, grouped,
+                                                                      typed))
+    print('same groups: {}'.format(results[0] == results[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# autobackup-dcm: benchmark of the concurrent app scheduler.
+# every synthetic app runs a dump subprocess that produces SQL-like text at a limited rate (the database),
+# compresses it on the shared pool (the CPU) and sleeps for the time its upload takes at a limited bandwidth
+# (the network). The same apps are run one after another and with the limits given on the command line.
+#
+# run from this directory like the scripts: PYTHONPATH=.. python bench_concurrent_apps.py --apps 12 --size 8
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import argparse
+import io
+import sys
+import time
+
+# Modules included in our package.
+from core.scheduler_dcm import ResourceLimitsCM, run_apps
+from core.stream_dcm import ParallelGzipWriter, stream_command
+
+DUMP_SCRIPT = '''
+import sys, time
+line = b"INSERT INTO t VALUES (1, 'abcdefghijklmnopqrstuvwxyz', 3.14159, NULL);\\n" * 1000
+left = {size}
+while left > 0:
+    sys.stdout.buffer.write(line[:left])
+    left -= len(line)
+    time.sleep({delay})
+'''
+
+
+class CountingWriter(io.RawIOBase):
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+
+def make_job(limits, args):
+    dump_delay = 70000 / (args.db_rate * 1024 * 1024)  # seconds per block of the dump script
+
+    def job(app):
+        with limits.slot('dump'):
+            output = CountingWriter()
+            with ParallelGzipWriter(output, threads=2, executor=limits.compress_executor) as writer:
+                command = [sys.executable, '-c', DUMP_SCRIPT.format(size=args.size * 1024 * 1024, delay=dump_delay)]
+                stream_command(command, writer)
+        with limits.slot('upload'):
+            time.sleep(output.size / (args.bandwidth * 1024 * 1024))
+        return output.size
+
+    return job
+
+
+def run(args, apps, dump_slots, compress_threads, upload_slots):
+    limits = ResourceLimitsCM(apps=apps, dump_slots=dump_slots, compress_threads=compress_threads,
+                              upload_slots=upload_slots)
+    names = [{'cfg': {'app_name': 'app{:02d}'.format(i)}} for i in range(args.apps)]
+    try:
+        timings, elapsed = run_apps(names, make_job(limits, args), max_workers=limits.apps)
+    finally:
+        limits.shutdown()
+    slowest = max(seconds for result, seconds in timings.values())
+    return elapsed, slowest, limits.waits['dump'], limits.waits['upload']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--apps', type=int, default=12, help='number of synthetic apps')
+    parser.add_argument('--size', type=int, default=8, help='MiB dumped by every app')
+    parser.add_argument('--db-rate', type=float, default=16, help='MiB/s produced by one dump')
+    parser.add_argument('--bandwidth', type=float, default=2, help='MiB/s of compressed upload of one app')
+    parser.add_argument('--workers', type=int, default=6)
+    parser.add_argument('--dump-slots', type=int, default=3)
+    parser.add_argument('--compress-threads', type=int, default=2)
+    parser.add_argument('--upload-slots', type=int, default=3)
+    args = parser.parse_args()
+
+    print('{:<12} {:>10} {:>12} {:>11} {:>13}'.format('mode', 'seconds', 'slowest app', 'dump wait', 'upload wait'))
+    for mode, limits in (('sequential', (1, 1, args.compress_threads, 1)),
+                         ('concurrent', (args.workers, args.dump_slots, args.compress_threads, args.upload_slots))):
+        elapsed, slowest, dump_wait, upload_wait = run(args, *limits)
+        print('{:<12} {:>10.2f} {:>12.2f} {:>11.2f} {:>13.2f}'.format(mode, elapsed, slowest, dump_wait,
+                                                                       upload_wait))
+
+
+if __name__ == '__main__':
+    main()
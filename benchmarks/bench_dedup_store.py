@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# autobackup-dcm: benchmark of the deduplicated chunk store over a month of daily backups.
+# a synthetic database changes every day like a real one (rows appended to an orders table, a few customers
+# updated, a rolling window of log rows) and is dumped in the layout of ``mysqldump`` (extended inserts of about
+# 1 MiB). Every daily dump is saved as a ``.gz`` and in the chunk store, the last --keep backups are kept, and the
+# bytes uploaded and stored by both modes are reported.
+#
+# run from this directory like the scripts: PYTHONPATH=.. python bench_dedup_store.py --days 30 --size 20
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Modules included in our package.
+from core.dedup_dcm import CHUNKS_EXTENSION, ChunkStoreCM, DedupWriter, read_chunk_manifest, referenced_chunks
+from core.stream_dcm import ParallelGzipWriter
+
+NET_BUFFER_LENGTH = 1024 * 1024  # mysqldump starts a new INSERT when a statement reaches this size
+
+ROW_SIZE = 100
+
+
+class CountingWriter(object):
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+
+def random_text(rng, size):
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz ') for _ in range(size))
+
+
+class SyntheticDatabase(object):
+    """Tables of ``(id, text)`` rows that change a little every day."""
+
+    def __init__(self, size, seed=1):
+        self.rng = random.Random(seed)
+        rows = size // ROW_SIZE
+        self.next_id = 0
+        self.tables = {'customers': self.new_rows(rows // 5), 'orders': self.new_rows(rows // 2),
+                       'logs': self.new_rows(rows - rows // 5 - rows // 2 - 100), 'settings': self.new_rows(100)}
+
+    def new_rows(self, count):
+        rows = []
+        for _ in range(count):
+            self.next_id += 1
+            rows.append((self.next_id, random_text(self.rng, self.rng.randint(ROW_SIZE // 2, ROW_SIZE * 3 // 2))))
+        return rows
+
+    def next_day(self, growth, updates, log_window):
+        self.tables['orders'].extend(self.new_rows(int(len(self.tables['orders']) * growth)))
+        customers = self.tables['customers']
+        for _ in range(int(len(customers) * updates)):
+            index = self.rng.randrange(len(customers))
+            customers[index] = (customers[index][0], random_text(self.rng, self.rng.randint(50, 150)))
+        logs = self.tables['logs']
+        added = int(len(logs) * log_window)
+        self.tables['logs'] = logs[added:] + self.new_rows(added)
+
+    def dump(self):
+        parts = ['-- MySQL dump 10.13\n/*!40101 SET NAMES utf8 */;\n']
+        for name, rows in sorted(self.tables.items()):
+            parts.append('\n--\n-- Table structure for table `{0}`\n--\n\nCREATE TABLE `{0}` (`id` int, `text` '
+                         'varchar(255));\n'.format(name))
+            statement, size = [], 0
+            for row in rows:
+                value = "({},'{}')".format(*row)
+                statement.append(value)
+                size += len(value) + 1
+                if size >= NET_BUFFER_LENGTH:
+                    parts.append('INSERT INTO `{}` VALUES {};\n'.format(name, ','.join(statement)))
+                    statement, size = [], 0
+            if statement:
+                parts.append('INSERT INTO `{}` VALUES {};\n'.format(name, ','.join(statement)))
+        return ''.join(parts).encode('utf-8')
+
+
+def feed(writer, data, block=1024 * 1024):
+    view = memoryview(data)
+    for offset in range(0, len(data), block):
+        writer.write(view[offset:offset + block])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--days', type=int, default=30, help='number of daily backups')
+    parser.add_argument('--size', type=int, default=20, help='size of the first dump in MiB')
+    parser.add_argument('--keep', type=int, default=7, help='backups kept by rotation')
+    parser.add_argument('--growth', type=float, default=0.01, help='orders appended every day (fraction)')
+    parser.add_argument('--updates', type=float, default=0.005, help='customers updated every day (fraction)')
+    parser.add_argument('--log-window', type=float, default=0.05, help='log rows replaced every day (fraction)')
+    parser.add_argument('--average-chunk', type=int, default=256, help='average chunk size in KiB')
+    parser.add_argument('--verbose', action='store_true', help='print every day')
+    args = parser.parse_args()
+
+    database = SyntheticDatabase(args.size * 1024 * 1024)
+    gzip_sizes = []
+    totals = {'dump': 0, 'gzip_upload': 0, 'dedup_upload': 0, 'gzip_seconds': 0.0, 'dedup_seconds': 0.0}
+    with tempfile.TemporaryDirectory() as directory:
+        store = ChunkStoreCM(os.path.join(directory, 'chunks'))
+        for day in range(args.days):
+            if day:
+                database.next_day(args.growth, args.updates, args.log_window)
+            data = database.dump()
+            totals['dump'] += len(data)
+
+            start = time.perf_counter()
+            compressed = CountingWriter()
+            with ParallelGzipWriter(compressed) as writer:
+                feed(writer, data)
+            totals['gzip_seconds'] += time.perf_counter() - start
+            gzip_sizes.append(compressed.size)
+
+            start = time.perf_counter()
+            with DedupWriter(store, average=args.average_chunk * 1024) as writer:
+                feed(writer, data)
+            manifest = json.dumps(writer.manifest()).encode('utf-8')
+            name = 'bench_{:%Y-%m-%d}_00-00_daily.{}'.format(datetime.date(2016, 1, 1) + datetime.timedelta(day),
+                                                             CHUNKS_EXTENSION)
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(manifest)
+            totals['dedup_seconds'] += time.perf_counter() - start
+            totals['gzip_upload'] += compressed.size
+            totals['dedup_upload'] += writer.stored + len(manifest)
+
+            # rotation: the oldest manifest goes, then the chunks nobody references
+            manifests = sorted(entry for entry in os.listdir(directory) if entry.endswith(CHUNKS_EXTENSION))
+            for expired in manifests[:-args.keep]:
+                os.remove(os.path.join(directory, expired))
+            store.collect_garbage(referenced_chunks(directory), grace=0)
+
+            if args.verbose:
+                print('day {:2d}: dump {:6.1f} MiB, gzip {:6.2f} MiB, new chunks {:4d}/{:4d} {:6.2f} MiB'.format(
+                    day + 1, len(data) / 2 ** 20, compressed.size / 2 ** 20, len(writer.new_chunks),
+                    len(writer.chunks), writer.stored / 2 ** 20))
+
+        manifests = [os.path.join(directory, entry) for entry in os.listdir(directory)
+                     if entry.endswith(CHUNKS_EXTENSION)]
+        dedup_storage = store.size() + sum(os.path.getsize(manifest) for manifest in manifests)
+        gzip_storage = sum(gzip_sizes[-args.keep:])
+        # the last backup restores to the last dump
+        restored = CountingWriter()
+        store.restore(read_chunk_manifest(sorted(manifests)[-1]), restored)
+
+    print('{} daily dumps, {:.1f} MiB dumped, last {} kept'.format(args.days, totals['dump'] / 2 ** 20, args.keep))
+    print('uploaded: gzip {:8.1f} MiB   dedup {:8.1f} MiB   saved {:5.1f}%'.format(
+        totals['gzip_upload'] / 2 ** 20, totals['dedup_upload'] / 2 ** 20,
+        100 - 100.0 * totals['dedup_upload'] / totals['gzip_upload']))
+    print('stored:   gzip {:8.1f} MiB   dedup {:8.1f} MiB   saved {:5.1f}%'.format(
+        gzip_storage / 2 ** 20, dedup_storage / 2 ** 20, 100 - 100.0 * dedup_storage / gzip_storage))
+    print('time:     gzip {:8.2f} s     dedup {:8.2f} s'.format(totals['gzip_seconds'], totals['dedup_seconds']))
+    if restored.size != len(data):
+        print('ERROR the last backup restores to {} bytes, the dump had {}'.format(restored.size, len(data)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
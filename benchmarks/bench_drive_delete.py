@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# autobackup-dcm: benchmark of remote pruning against the local fake Drive.
+# compares one delete_file() round-trip per backup with the batched GDriveCM.delete_files(),
+# counting the HTTP round-trips the fake server received, optionally with latency and injected errors.
+#
+# run from this directory like the scripts: PYTHONPATH=.. python bench_drive_delete.py --files 300 --latency 0.05
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import argparse
+import time
+
+# Modules included in our package.
+from fake_drive import FakeDrive, FakeDriveServer, fake_gdrivecm_class
+
+
+def run(mode, args):
+    drive = FakeDrive(latency=args.latency, error_rate=args.error_rate)
+    ids = [drive.add_file('jom_2016-01-{:02d}_10-00_daily.gz'.format(i % 28 + 1), 'fake-folder')
+           for i in range(args.files)]
+    with FakeDriveServer(drive) as server:
+        gdrive = fake_gdrivecm_class()(server)
+        gdrive.get_service()  # discovery and connection setup are not part of the measure
+        drive.counters.clear()
+        start = time.perf_counter()
+        if mode == 'one-by-one':
+            deleted = sum(1 for file_id in ids if gdrive.delete_file(file_id))
+        else:
+            deleted = sum(1 for ok in gdrive.delete_files(ids).values() if ok)
+        elapsed = time.perf_counter() - start
+    return deleted, elapsed, drive.counters['round_trips'], len(drive.files)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=300)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per round-trip')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a 500 per call')
+    args = parser.parse_args()
+
+    print('{:<12} {:>8} {:>9} {:>12} {:>10}'.format('mode', 'deleted', 'seconds', 'round-trips', 'remaining'))
+    for mode in ('one-by-one', 'batched'):
+        deleted, elapsed, round_trips, remaining = run(mode, args)
+        print('{:<12} {:>8} {:>9.3f} {:>12} {:>10}'.format(mode, deleted, elapsed, round_trips, remaining))
+
+
+if __name__ == '__main__':
+    main()
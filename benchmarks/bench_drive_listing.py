@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# autobackup-dcm: benchmark of the remote catalog reconciliation against the local fake Drive.
+# compares a full listing of a big folder on every run with reading only the Drive changes feed since the
+# previous run, and checks that both leave the same backups in the catalog. In the ``expired`` mode Drive refuses
+# the saved page token once, the run that finds it out must fall back to exactly one full listing.
+#
+# run from this directory like the scripts: PYTHONPATH=.. python bench_drive_listing.py --files 10000 --runs 5
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import argparse
+import datetime
+import sys
+import time
+
+# Modules included in our package.
+from core.catalog_dcm import BackupCatalogCM
+from core.rotate_dcm import RotateBackupsCM
+from fake_drive import FakeDrive, FakeDriveServer, fake_gdrivecm_class
+
+FOLDER = 'fake-folder'
+
+
+def backup_name(day):
+    date = datetime.date(2000, 1, 1) + datetime.timedelta(days=day)
+    return 'jom_{}_10-00_daily.gz'.format(date.isoformat())
+
+
+def run(mode, args):
+    """Reconcile the catalog ``args.runs`` times, with a few backups added and deleted between runs. In the
+    ``expired`` mode the page tokens are expired before the run in the middle.
+
+    :returns: a tuple with the seconds, the round-trips, the full listings of the runs and whether the catalog
+              has the backups of the fake Drive.
+    """
+    drive = FakeDrive(latency=args.latency)
+    ids = [drive.add_file(backup_name(day), FOLDER) for day in range(args.files)]
+    catalog = BackupCatalogCM(':memory:')
+    with FakeDriveServer(drive) as server:
+        gdrive = fake_gdrivecm_class()(server, remote_folder=FOLDER)
+        # a zero audit interval makes every run a full listing, as before the changes feed
+        rotate = RotateBackupsCM({'daily': 7}, rotate_type='remote', gdrivecm=gdrive, catalog=catalog,
+                                 audit_interval=0 if mode == 'full' else 7 * 86400)
+        rotate.reconcile_catalog(FOLDER, 'remote')  # first run: both modes list the folder
+        drive.counters.clear()
+        start = time.perf_counter()
+        for run_number in range(args.runs):
+            for i in range(args.changes):
+                ids.append(drive.add_file(backup_name(args.files + run_number * args.changes + i), FOLDER))
+                gdrive.delete_file(ids.pop(0))
+            drive.add_file('unrelated-{}.txt'.format(run_number), 'other-folder')
+            if mode == 'expired' and run_number == args.runs // 2:
+                drive.expire_page_tokens()
+            rotate.reconcile_catalog(FOLDER, 'remote')
+        elapsed = time.perf_counter() - start
+    names = sorted(entry.name for entry in catalog.backups('remote', FOLDER))
+    expected = sorted(f['name'] for f in drive.files.values() if FOLDER in f['parents'])
+    # every full listing starts by taking a new page token of the changes feed
+    return (elapsed, drive.counters['round_trips'] - args.runs * args.changes, drive.counters['changes_token'],
+            names == expected)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--changes', type=int, default=2, help='backups added and deleted between two runs')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per round-trip')
+    args = parser.parse_args()
+
+    errors = []
+    print('{:<12} {:>9} {:>12} {:>9} {:>10}'.format('mode', 'seconds', 'round-trips', 'listings', 'consistent'))
+    for mode, expected_listings in (('full', args.runs), ('incremental', 0), ('expired', 1)):
+        elapsed, round_trips, listings, consistent = run(mode, args)
+        print('{:<12} {:>9.3f} {:>12} {:>9} {:>10}'.format(mode, elapsed, round_trips, listings, str(consistent)))
+        if not consistent:
+            errors.append('{}: the catalog does not have the backups of the fake Drive'.format(mode))
+        if listings != expected_listings:
+            errors.append('{}: {} full listings, expected {}'.format(mode, listings, expected_listings))
+
+    for error in errors:
+        print('ERROR', error)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# autobackup-dcm: benchmark of resumable uploads against the local fake Drive.
+# measures upload throughput for several chunk sizes and concurrency limits, and the bytes sent again
+# when an upload is interrupted and resumed by a second run from its saved session.
+#
+# run from this directory like the scripts: PYTHONPATH=.. python bench_drive_upload.py --size 64 --latency 0.02
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import argparse
+import os
+import tempfile
+import time
+
+# Modules included in our package.
+from core.upload_dcm import ResumableUploadCM, UploadFailed
+from fake_drive import FakeDrive, FakeDriveServer, fake_gdrivecm_class
+
+
+def make_files(directory, count, size_mb):
+    files = []
+    for i in range(count):
+        path = os.path.join(directory, 'jom_2016-01-{:02d}_10-00_daily.gz'.format(i + 1))
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size_mb * 1024 * 1024))
+        files.append(path)
+    return files
+
+
+def throughput(files, chunk_size, concurrency, latency):
+    drive = FakeDrive(latency=latency)
+    with FakeDriveServer(drive) as server:
+        gdrive = fake_gdrivecm_class()(server, chunk_size=chunk_size)
+        start = time.perf_counter()
+        results = gdrive.upload_files(files, concurrency=concurrency)
+        elapsed = time.perf_counter() - start
+    total_mb = sum(os.path.getsize(f) for f in files) / 1024 / 1024
+    return all(results.values()), elapsed, total_mb / elapsed, drive.counters['round_trips']
+
+
+def interrupted(path, chunk_size, session_dir):
+    """Upload ``path`` with a crash at the middle, then resume it like the next run would."""
+    size = os.path.getsize(path)
+    drive = FakeDrive(interrupt_at=size // 2)
+    with FakeDriveServer(drive) as server:
+        http = fake_gdrivecm_class()(server).get_http()
+        url = server.root_url + 'upload/drive/v3/files'
+        first = ResumableUploadCM(http, upload_url=url, chunk_size=chunk_size, session_dir=session_dir, retries=0)
+        try:
+            first.upload(path, {'name': os.path.basename(path), 'parents': ['fake-folder']})
+        except UploadFailed:
+            pass
+        second = ResumableUploadCM(http, upload_url=url, chunk_size=chunk_size, session_dir=session_dir)
+        second.upload(path, {'name': os.path.basename(path), 'parents': ['fake-folder']})
+    return first.bytes_sent + second.bytes_sent - size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=32, help='size of every file in MiB')
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per round-trip')
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[256 * 1024, 1024 * 1024, 8 * 1024 * 1024])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        files = make_files(tmp, args.files, args.size)
+        print('{:>10} {:>5} {:>9} {:>8} {:>12} {:>4}'.format('chunk', 'conc', 'seconds', 'MiB/s', 'round-trips',
+                                                             'ok'))
+        for chunk_size in args.chunk_sizes:
+            for concurrency in args.concurrency:
+                ok, elapsed, speed, round_trips = throughput(files, chunk_size, concurrency, args.latency)
+                print('{:>10} {:>5} {:>9.3f} {:>8.1f} {:>12} {:>4}'.format(chunk_size, concurrency, elapsed, speed,
+                                                                           round_trips, str(ok)))
+        print('\nbytes resent after an interrupted run:')
+        for chunk_size in args.chunk_sizes:
+            resent = interrupted(files[0], chunk_size, os.path.join(tmp, 'sessions'))
+            print('{:>10} {:>12} bytes of {}'.format(chunk_size, resent, os.path.getsize(files[0])))
+
+
+if __name__ == '__main__':
+    main()
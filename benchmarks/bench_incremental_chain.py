@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# autobackup-dcm: check of the incremental backup chain against the fake mysql clients of fake_mysql.py.
+# :class:`MysqlBackupCM` creates, one simulated day after another: two full backups and two incremental backups
+# (the binary logs since the previous backup of the chain, read with the fake ``mysqlbinlog``), the folder is
+# rotated keeping two days (the full backup the incremental ones depend on must stay), then the binary log the chain
+# continues from is purged from the fake server (a full backup must be created instead of an incremental one) and a
+# new chain starts from it. The ``--start-position`` and the binary logs of every incremental backup, the ``base``
+# and the coordinates recorded in the catalog and the backups kept by the rotations are checked. The exit code is 1
+# when a check fails.
+#
+# run from this directory, the backup script is imported: PYTHONPATH=..:../scripts python bench_incremental_chain.py
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import argparse
+import datetime
+import gzip
+import os
+import sys
+import tempfile
+import time
+
+# Modules included in our package.
+import mysql_backup
+from core.generic_backup import GenericBackupCM
+from core.metrics_dcm import app_scope, start_run
+from core.rotate_dcm import RotateBackupsCM
+from fake_mysql import install
+
+START = datetime.datetime(2016, 1, 4, 3, 0)
+
+STEPS = (('weekly', 'full'), ('monthly', 'full'), ('daily', 'incremental'), ('daily', 'incremental'), ('rotate', 3),
+         ('purge', 'full'), ('daily', 'incremental'), ('rotate', 2))
+"""The backup of every simulated day and the kind of backup expected, ``purge`` drops the binary logs of the chain
+before a daily backup, ``rotate`` rotates the folder keeping two days and gives how many of the last backups stay."""
+
+
+class ChainBackupCM(mysql_backup.MysqlBackupCM):
+    """The backups of :class:`~mysql_backup.MysqlBackupCM` in a temporary directory, named after a simulated clock
+    and not uploaded"""
+
+    def __init__(self, directory):
+        GenericBackupCM.__init__(self, mysql_backup.log, None, catalog_file=os.path.join(directory, 'catalog.db'),
+                                 scheduler_file=os.path.join(directory, 'scheduler.json'),
+                                 state_dir=os.path.join(directory, 'state'))
+        self.now = START
+
+    def backup_filename(self, app, backup_type, extension):
+        return '{}{}_{:%Y-%m-%d_%H-%M}_{}.{}'.format(app['cfg']['local_backup_dir'], app['cfg']['app_name'], self.now,
+                                                    backup_type, extension)
+
+    def upload_backup(self, app, backup_file, streamed=None):
+        return True
+
+
+def make_app(directory):
+    return {'cfg': {'app_name': 'jom', 'local_backup_dir': os.path.join(directory, 'backups') + os.sep},
+            'custom': {'db_user': 'jom', 'db_password': 'jom', 'db_name': 'jom'},
+            'incremental': {'enabled': True}, 'compress': {'threads': 1}}
+
+
+def check_incremental(backup_file, entry, head, errors):
+    """Check the content and the catalog entry of an incremental backup that continues from ``head``"""
+    with gzip.open(backup_file, 'rt') as f:
+        lines = f.read().splitlines()
+    files = [line.rsplit(' ', 1)[1] for line in lines if ' fake binary log ' in line]
+    positions = [line for line in lines if line.startswith('# at ')]
+    name = os.path.basename(backup_file)
+    if not files or files[0] != head.binlog_file:
+        errors.append('{}: binary logs {}, expected to start at {}'.format(name, files, head.binlog_file))
+    if not positions or positions[0] != '# at {}'.format(head.binlog_position):
+        errors.append('{}: starts {}, expected at position {}'.format(name, positions[:1], head.binlog_position))
+    if entry.base != (head.base or head.name):
+        errors.append('{}: base {}, expected {}'.format(name, entry.base, head.base or head.name))
+    if files and entry.binlog_file in files:
+        errors.append('{}: ends in {}, a binary log it already has'.format(name, entry.binlog_file))
+
+
+def run(args, directory, errors):
+    """Create the backups and run the rotations of :data:`STEPS`"""
+    clients = install(directory, {'database': 'jom', 'tables': {'t': args.size * 1024},
+                                  'binary_logs': ['mysql-bin.000001'], 'position': 154})
+    mysql_backup.MYSQL_BIN = clients['mysql']
+    mysql_backup.MYSQLDUMP_BIN = clients['mysqldump']
+    mysql_backup.MYSQLBINLOG_BIN = clients['mysqlbinlog']
+
+    backup = ChainBackupCM(directory)
+    app = make_app(directory)
+    local_dir = os.path.abspath(app['cfg']['local_backup_dir'])
+    mysqlcm = backup.get_mysqlcm(app)
+    created = []
+    print('{:<36} {:<12} {:<34} {:>18} {:>9}'.format('backup', 'kind', 'base', 'ends at', 'seconds'))
+    for backup_type, expected in STEPS:
+        if backup_type == 'rotate':
+            check_rotation(backup, local_dir, created, created[-expected:], errors)
+            continue
+        backup.now = START + datetime.timedelta(days=len(created))
+        if backup_type == 'purge':
+            # the binary log the chain continues from is not on the server anymore
+            mysqlcm.flush_binary_logs()
+            mysqlcm.query("PURGE BINARY LOGS TO '{}'".format(mysqlcm.binary_logs()[-1]))
+            backup_type = 'daily'
+        head = backup.catalog.chain_head('local', local_dir)
+
+        start = time.perf_counter()
+        with app_scope('jom'):
+            result = backup.do_backup(app, backup_type)
+        elapsed = time.perf_counter() - start
+        entry = backup.catalog.chain_head('local', local_dir)
+        if not result or entry is None or entry.name == (head.name if head else None):
+            errors.append('day {}: no {} backup was created'.format(len(created), backup_type))
+            return backup
+        created.append(entry.name)
+        kind = 'incremental' if entry.name.endswith(mysql_backup.INCREMENTAL_EXTENSION) else 'full'
+        print('{:<36} {:<12} {:<34} {:>18} {:>9.3f}'.format(entry.name, kind, entry.base or '-', '{}:{}'.format(
+            entry.binlog_file, entry.binlog_position), elapsed))
+        if kind != expected:
+            errors.append('{}: a {} backup, expected a {} one'.format(entry.name, kind, expected))
+        elif kind == 'incremental':
+            check_incremental(os.path.join(local_dir, entry.name), entry, head, errors)
+        elif entry.base is not None or entry.binlog_file != mysqlcm.binary_logs()[-1]:
+            errors.append('{}: full backup with base {} ending at {}'.format(entry.name, entry.base,
+                                                                             entry.binlog_file))
+    return backup
+
+
+def check_rotation(backup, local_dir, created, expected, errors):
+    """Rotate the folder keeping two days, only the ``expected`` backups must stay: the backups of the last two
+    days and the backups of the chain they continue"""
+    RotateBackupsCM({'daily': 2}, rotate_type='local', catalog=backup.catalog).rotate_backups(local_dir)
+    remaining = sorted(name for name in os.listdir(local_dir) if name in created)
+    print('kept by the rotation: {}'.format(', '.join(remaining)))
+    if remaining != expected:
+        errors.append('rotation kept {}, expected {}'.format(remaining, expected))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=256, help='size of the fake database in KiB')
+    args = parser.parse_args()
+
+    errors = []
+    start_run()
+    with tempfile.TemporaryDirectory() as directory:
+        backup = run(args, directory, errors)
+        backup.limits.shutdown()
+
+    for error in errors:
+        print('ERROR', error)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# autobackup-dcm: benchmark of the deletion of expired local backups.
+# compares the previous ``[ionice --class idle] rm -Rf backup backup.md5 backup.sha256`` subprocess per backup
+# with the in-process :class:`core.delete_dcm.LocalDeleterCM` on one and several threads, on synthetic backups
+# (small files with their checksum sidecars, and some directory backups).
+#
+# run from this directory like the scripts: PYTHONPATH=.. python bench_local_delete.py --backups 10000
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+# Modules included in our package.
+from core.delete_dcm import LocalDeleterCM, set_io_priority
+from core.stream_dcm import CHECKSUM_ALGORITHMS, checksum_file
+
+
+def make_backups(directory, count, directory_every):
+    backups = []
+    for i in range(count):
+        path = os.path.join(directory, 'jom_{:06d}_10-00_hourly.gz'.format(i))
+        if directory_every and i % directory_every == 0:
+            os.mkdir(path)
+            for j in range(3):
+                with open(os.path.join(path, 'part{}.sql'.format(j)), 'wb') as f:
+                    f.write(b'x' * 512)
+        else:
+            with open(path, 'wb') as f:
+                f.write(b'x' * 4096)
+        for algorithm in CHECKSUM_ALGORITHMS:
+            with open(checksum_file(path, algorithm), 'w') as f:
+                f.write('0  {}\n'.format(path))
+        backups.append([path] + [checksum_file(path, algorithm) for algorithm in CHECKSUM_ALGORITHMS])
+    return backups
+
+
+def subprocess_delete(backups, io_scheduling_class):
+    for item in backups:
+        command = ['rm', '-Rf'] + item
+        if io_scheduling_class:
+            command = ['ionice', '--class', io_scheduling_class] + command
+        subprocess.check_call(command)
+
+
+def in_process_delete(backups, io_scheduling_class, threads):
+    results = LocalDeleterCM(io_scheduling_class=io_scheduling_class, threads=threads).delete_all(backups)
+    return sum(1 for item, error in results if error)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backups', type=int, default=10000)
+    parser.add_argument('--directory-every', type=int, default=10, help='one directory backup every N backups')
+    parser.add_argument('--ionice', default='idle', help="I/O scheduling class, '' to disable")
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--dir', default=None, help='where the synthetic backups are created')
+    args = parser.parse_args()
+
+    ionice = args.ionice if args.ionice and shutil.which('ionice') else None
+    print('{:<22} {:>9} {:>14} {:>7}'.format('mode', 'seconds', 'backups/second', 'errors'))
+    modes = [('subprocess', None)] + [('in-process x{}'.format(threads), threads) for threads in args.threads]
+    for mode, threads in modes:
+        with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+            backups = make_backups(tmp, args.backups, args.directory_every)
+            start = time.perf_counter()
+            if threads is None:
+                subprocess_delete(backups, ionice)
+                errors = 0
+            else:
+                errors = in_process_delete(backups, args.ionice or None, threads)
+            elapsed = time.perf_counter() - start
+            left = len(os.listdir(tmp))
+        print('{:<22} {:>9.3f} {:>14.0f} {:>7}'.format(mode, elapsed, args.backups / elapsed, errors + left))
+    print('ioprio_set available: {}'.format(set_io_priority('best-effort')))
+
+
+if __name__ == '__main__':
+    main()
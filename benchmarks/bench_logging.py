@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# autobackup-dcm: benchmark of the rotation of a big folder with the logging modes of the program.
+# a local folder of --entries synthetic entries is rotated in dry run mode (every backup is logged as preserved or
+# deleted, nothing is deleted) with the handlers of config/logging.json writing to temporary files: attached to the
+# loggers like before ("direct"), on the listener thread ("queue"), on the listener thread with the per-entry lines
+# summarized up to INFO ("summary", config/logging.json only summarizes the debug lines: the preserved and deleted
+# lines are always written), and with INFO disabled as the floor ("off"). The seconds of the rotation, the seconds the
+# listener took to write what was left in the queue and the lines written are reported.
+#
+# run from this directory like the scripts: PYTHONPATH=.. python bench_logging.py --entries 100000
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import argparse
+import logging
+import logging.config
+import os
+import tempfile
+import time
+
+# Modules included in our package.
+from core.logging_dcm import start_queue_logging, stop_queue_logging
+from core.rotate_dcm import RotateBackupsCM
+from synthetic_backups import local_folder
+
+MODES = ('direct', 'queue', 'summary', 'off')
+
+ROTATION_SCHEME = {'hourly': 24, 'daily': 7, 'weekly': 4, 'monthly': 12, 'yearly': 'always'}
+
+ENTRY_LOGGERS = ('dacopancm.entries.rotate', 'dacopancm.entries.listing')
+
+
+def logging_config(mode, directory):
+    """The handlers of config/logging.json, the console is a file too (the output of cron goes to a file)"""
+    handler = {'formatter': 'simple', 'maxBytes': 1024 ** 3, 'backupCount': 1,
+               'class': 'logging.handlers.RotatingFileHandler'}
+    config = {
+        'version': 1, 'disable_existing_loggers': False,
+        'formatters': {'simple': {'format': '%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+                                  'datefmt': '%m/%d/%Y %H:%M:%S'}},
+        'filters': {'entries': {'()': 'core.logging_dcm.SummaryFilter', 'limit': 20, 'interval': 60,
+                                'max_level': 'INFO'}},
+        'handlers': {
+            'console': dict(handler, level='DEBUG', filename=os.path.join(directory, 'console.log')),
+            'info_file_handler': dict(handler, level='INFO', filename=os.path.join(directory, 'info.log')),
+            'error_file_handler': dict(handler, level='ERROR', filename=os.path.join(directory, 'errors.log')),
+        },
+        'loggers': {'dacopancm': {'level': 'WARNING' if mode == 'off' else 'INFO', 'propagate': False,
+                                  'handlers': ['console', 'error_file_handler', 'info_file_handler']}},
+    }
+    if mode == 'summary':
+        for name in ENTRY_LOGGERS:
+            config['loggers'][name] = {'filters': ['entries']}
+    return config
+
+
+def count_lines(directory):
+    lines = 0
+    for name in ('console.log', 'info.log'):
+        with open(os.path.join(directory, name), 'rb') as f:
+            lines += sum(1 for _ in f)
+    return lines
+
+
+def run(mode, folder):
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ENTRY_LOGGERS:
+            logger = logging.getLogger(name)
+            logger.filters.clear()
+            logger.setLevel(logging.NOTSET)
+        logging.config.dictConfig(logging_config(mode, directory))
+        if mode in ('queue', 'summary'):
+            start_queue_logging()
+        rotate = RotateBackupsCM(ROTATION_SCHEME, dry_run=True)
+        start = time.perf_counter()
+        rotate.rotate_backups(folder)
+        elapsed = time.perf_counter() - start
+        # what is still in the queue is written by the listener thread, not by the rotation
+        start = time.perf_counter()
+        stop_queue_logging()
+        drain = time.perf_counter() - start
+        for handler in logging.getLogger('dacopancm').handlers:
+            handler.close()
+        logging.getLogger('dacopancm').handlers = []
+        return elapsed, drain, count_lines(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=100000, help='entries of the folder rotated')
+    parser.add_argument('modes', nargs='*', default=MODES, help='logging modes: ' + ', '.join(MODES))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        backups = local_folder(folder, args.entries)
+        print('{} entries, {} backups'.format(args.entries, backups))
+        print('{:<8} {:>10} {:>14} {:>10} {:>10}'.format('mode', 'seconds', 'backups/s', 'drain s', 'lines'))
+        for mode in args.modes:
+            elapsed, drain, lines = run(mode, folder)
+            print('{:<8} {:>10.3f} {:>14.0f} {:>10.3f} {:>10}'.format(mode, elapsed, backups / elapsed, drain, lines))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# autobackup-dcm: benchmark of the per-table parallel dump.
+# a schema with a few big tables and many small ones is dumped by the fake ``mysqldump`` of fake_mysql.py, which
+# writes at a limited rate per connection like a busy server, once with a single ``mysqldump --databases`` and
+# once on several connections. The members of the parallel dump are checked against its manifest: every table
+# decompresses alone to its ``INSERT`` statements and the whole file decompresses to all of them.
+#
+# run from this directory like the scripts: PYTHONPATH=.. python bench_parallel_dump.py --workers 4 --rate 5
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import argparse
+import gzip
+import io
+import sys
+import tempfile
+import time
+
+# Modules included in our package.
+from core.mysql_dcm import MysqlClientCM
+from core.paralleldump_dcm import ParallelDumpCM
+from core.stream_dcm import ParallelGzipWriter, stream_command
+
+import fake_mysql
+
+
+def make_schema(args):
+    tables = {'big_{:02d}'.format(i): args.big * 1024 * 1024 for i in range(args.big_tables)}
+    tables.update(('small_{:03d}'.format(i), args.small * 1024) for i in range(args.small_tables))
+    return {'database': 'bench', 'tables': tables, 'views': ['summary'], 'rate': args.rate * 1024 * 1024,
+            'binary_logs': ['mysql-bin.000001'], 'position': 154}
+
+
+def single_dump(clients, threads):
+    output = io.BytesIO()
+    start = time.perf_counter()
+    with ParallelGzipWriter(output, threads=threads) as writer:
+        size = stream_command([clients['mysqldump'], '--opt', '--triggers', '--events', '--databases', 'bench'],
+                              writer)
+    return time.perf_counter() - start, size, output.getvalue()
+
+
+def parallel_dump(clients, workers, threads):
+    output = io.BytesIO()
+    dumper = ParallelDumpCM(MysqlClientCM(clients['mysql'], 'bench', 'bench'), clients['mysqldump'], 'bench',
+                            workers=workers, compress_threads=threads, binlog=True)
+    start = time.perf_counter()
+    manifest = dumper.dump(output)
+    return time.perf_counter() - start, dumper, manifest, output.getvalue()
+
+
+def check(schema, manifest, data):
+    """Every table restores alone from its member, the whole file has every table once"""
+    errors = []
+    tables = {member['name']: member for member in manifest['members'] if member['kind'] == 'table'}
+    if sorted(tables) != sorted(schema['tables']):
+        errors.append('tables in the manifest: {}'.format(sorted(tables)))
+    for name, member in sorted(tables.items()):
+        sql = gzip.decompress(data[member['offset']:member['offset'] + member['length']])
+        if len(sql) != member['size']:
+            errors.append('{}: {} bytes, {} in the manifest'.format(name, len(sql), member['size']))
+        expected = sum(1 for line in fake_mysql.table_data(name, schema['tables'][name]))
+        if not sql.startswith(b'-- MySQL dump') or sql.count(b'INSERT INTO `' + name.encode() + b'`') != expected:
+            errors.append('{}: incomplete member'.format(name))
+    full = gzip.decompress(data)
+    if full.count(b'-- Table structure for table') != len(schema['tables']) or not full.startswith(b'CREATE DATABASE'):
+        errors.append('the whole file is not a complete dump')
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--big-tables', type=int, default=3, help='number of big tables')
+    parser.add_argument('--big', type=int, default=40, help='size of a big table in MiB')
+    parser.add_argument('--small-tables', type=int, default=200, help='number of small tables')
+    parser.add_argument('--small', type=int, default=64, help='size of a small table in KiB')
+    parser.add_argument('--rate', type=float, default=5, help='MiB/s a connection of the server dumps')
+    parser.add_argument('--workers', type=int, default=4, help='connections of the parallel dump')
+    parser.add_argument('--threads', type=int, default=4, help='compression threads')
+    args = parser.parse_args()
+
+    schema = make_schema(args)
+    total = sum(schema['tables'].values())
+    print('{} tables, {:.1f} MiB of rows, {} MiB/s per connection'.format(len(schema['tables']),
+                                                                           total / 1024 / 1024, args.rate))
+    with tempfile.TemporaryDirectory() as directory:
+        clients = fake_mysql.install(directory, schema)
+        elapsed, size, data = single_dump(clients, args.threads)
+        print('single mysqldump:      {:7.2f} s  {:7.1f} MiB/s  {:.1f} MiB compressed'.format(
+            elapsed, size / elapsed / 1024 / 1024, len(data) / 1024 / 1024))
+        elapsed, dumper, manifest, data = parallel_dump(clients, args.workers, args.threads)
+        print('parallel ({} workers): {:7.2f} s  {:7.1f} MiB/s  {:.1f} MiB compressed, lock held {:.3f} s'.format(
+            manifest['workers'], elapsed, dumper.dump_size / elapsed / 1024 / 1024, len(data) / 1024 / 1024,
+            manifest['lock_seconds']))
+
+    errors = check(schema, manifest, data)
+    for error in errors:
+        print('ERROR', error)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# autobackup-dcm: throughput benchmark of the compression stage.
+# compares the single ``gzip -c`` process used before with :class:`core.stream_dcm.ParallelGzipWriter`
+# at several thread counts, and checks that every output is readable by ``gzip -d``.
+#
+# run from this directory like the scripts: PYTHONPATH=.. python bench_parallel_gzip.py --size 128 --threads 1 4 16
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import argparse
+import hashlib
+import os
+import random
+import subprocess
+import tempfile
+import time
+
+# Modules included in our package.
+from core.stream_dcm import DEFAULT_BLOCK_SIZE, ParallelGzipWriter
+
+
+def synthetic_dump(size_mb, seed=42):
+    """Build ``size_mb`` MiB of SQL-like rows with enough entropy to make compression do real work."""
+    rnd = random.Random(seed)
+    words = [bytes(rnd.choice(b'abcdefghijklmnopqrstuvwxyz') for _ in range(rnd.randint(3, 10))) for _ in range(2000)]
+    rows = []
+    size = 0
+    while size < size_mb * 1024 * 1024:
+        row = b"INSERT INTO `t` VALUES (%d,'%s',%d);\n" % (
+            rnd.randint(1, 10 ** 9), b' '.join(rnd.choice(words) for _ in range(8)), rnd.randint(0, 10 ** 6))
+        rows.append(row)
+        size += len(row)
+    return b''.join(rows)
+
+
+def feed(sink, data, chunk_size=1024 * 1024):
+    view = memoryview(data)
+    for offset in range(0, len(data), chunk_size):
+        sink.write(view[offset:offset + chunk_size])
+
+
+def run_gzip_process(data, output, level):
+    with open(output, 'wb') as f:
+        subprocess.run(['gzip', '-c', '-{}'.format(level)], input=data, stdout=f, check=True)
+
+
+def run_parallel(data, output, level, threads, block_size):
+    with open(output, 'wb') as f, ParallelGzipWriter(f, threads=threads, compress_level=level,
+                                                      block_size=block_size) as gzip_writer:
+        feed(gzip_writer, data)
+
+
+def check(output, digest):
+    decompressed = subprocess.run(['gzip', '-d', '-c', output], stdout=subprocess.PIPE, check=True).stdout
+    return hashlib.md5(decompressed).hexdigest() == digest
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=128, help='uncompressed size in MiB')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--level', type=int, default=6)
+    parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE)
+    args = parser.parse_args()
+
+    data = synthetic_dump(args.size)
+    digest = hashlib.md5(data).hexdigest()
+    runs = [('gzip -c', None)] + [('parallel x{}'.format(t), t) for t in args.threads]
+
+    print('host cpus: {}  input: {} MiB  level: {}'.format(os.cpu_count(), args.size, args.level))
+    print('{:<14} {:>9} {:>10} {:>9} {:>6}'.format('path', 'seconds', 'MiB/s', 'ratio', 'valid'))
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, 'bench.gz')
+        for name, threads in runs:
+            start = time.perf_counter()
+            if threads is None:
+                run_gzip_process(data, output, args.level)
+            else:
+                run_parallel(data, output, args.level, threads, args.block_size)
+            elapsed = time.perf_counter() - start
+            print('{:<14} {:>9.3f} {:>10.1f} {:>9.3f} {:>6}'.format(
+                name, elapsed, args.size / elapsed, os.path.getsize(output) / len(data), str(check(output, digest))))
+
+
+if __name__ == '__main__':
+    main()
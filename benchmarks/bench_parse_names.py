@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# autobackup-dcm: benchmark of the filename parsing and include/exclude matching of collect_backups().
+# compares the previous TIMESTAMP_PATTERN search plus one fnmatch() call per pattern with
+# :func:`core.rotate_dcm.parse_backup_name()` and a matcher from :func:`core.rotate_dcm.compile_patterns()`,
+# and checks that both find the same timestamps and the same included names.
+#
+# run from this directory like the scripts: PYTHONPATH=.. python bench_parse_names.py --names 100000
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import argparse
+import datetime
+import fnmatch
+import random
+import time
+
+# Modules included in our package.
+from core.rotate_dcm import TIMESTAMP_PATTERN, compile_patterns, parse_backup_name
+
+TYPES = ('hourly', 'daily', 'weekly', 'monthly', 'yearly')
+
+
+def make_names(count, seed):
+    rng = random.Random(seed)
+    start = datetime.datetime(2000, 1, 1)
+    names = []
+    for i in range(count):
+        stamp = start + datetime.timedelta(minutes=rng.randrange(20 * 365 * 24 * 60))
+        app = rng.choice(['jom', 'shop_db', 'wiki'])
+        if rng.random() < 0.05:
+            names.append('{}-{:%Y%m%d%H%M%S}.tar'.format(app, stamp))  # other naming, parsed by the regex
+        else:
+            names.append('{}_{:%Y-%m-%d_%H-%M}_{}.gz'.format(app, stamp, rng.choice(TYPES)))
+    return names
+
+
+def legacy(names, include_list, exclude_list):
+    result = []
+    for entry in names:
+        match = TIMESTAMP_PATTERN.search(entry)
+        if match:
+            timestamp = datetime.datetime(*(int(group, 10) for group in match.groups('0')))
+            if exclude_list and any(fnmatch.fnmatch(entry, p) for p in exclude_list):
+                continue
+            elif include_list and not any(fnmatch.fnmatch(entry, p) for p in include_list):
+                continue
+            result.append((entry, timestamp))
+    return result
+
+
+def current(names, include_list, exclude_list):
+    include, exclude = compile_patterns(include_list), compile_patterns(exclude_list)
+    result = []
+    for entry in names:
+        parsed = parse_backup_name(entry)
+        if parsed:
+            if exclude and exclude(entry):
+                continue
+            elif include and not include(entry):
+                continue
+            result.append((entry, parsed.timestamp))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--names', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--include', nargs='*', default=['jom_*', 'shop_db_*', 'wiki-*'])
+    parser.add_argument('--exclude', nargs='*', default=['*_hourly.gz', '*1999*', '*.tmp'])
+    args = parser.parse_args()
+
+    names = make_names(args.names, args.seed)
+    results = []
+    print('{:<8} {:>9} {:>10}'.format('parser', 'seconds', 'included'))
+    for name, function in (('legacy', legacy), ('current', current)):
+        start = time.perf_counter()
+        result = function(names, args.include, args.exclude)
+        elapsed = time.perf_counter() - start
+        results.append(result)
+        print('{:<8} {:>9.3f} {:>10}'.format(name, elapsed, len(result)))
+    print('same result: {}'.format(results[0] == results[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# autobackup-dcm: benchmark of the streaming restore against the local fake Drive and the fake mysql client.
+# a synthetic dump of --size MiB is compressed like a backup and put on the fake Drive, then restored into the fake
+# ``mysql`` client for every number of parallel range requests: first from Drive (the cache is empty), then again
+# from the cache. The seconds of every stage of the restore (resolve, fetch, cache, decompress, import) are
+# reported with the time to restore.
+#
+# run from this directory like the scripts: PYTHONPATH=.. python bench_restore.py --size 256 --latency 0.02
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import argparse
+import hashlib
+import io
+import os
+import tempfile
+
+# Modules included in our package.
+from core.catalog_dcm import BackupCatalogCM
+from core.metrics_dcm import app_scope, stage, start_run
+from core.mysql_dcm import MysqlClientCM, MysqlImportWriter
+from core.ratelimit_dcm import configure_request_executor
+from core.restore_dcm import RESTORE_STAGES, ArtifactCacheCM, RestoreCM
+from core.rotate_dcm import parse_timestamp
+from core.stream_dcm import ParallelGzipWriter
+from fake_drive import FakeDrive, FakeDriveServer, fake_gdrivecm_class
+from fake_mysql import install, table_data
+
+BACKUP_NAME = 'jom_2016-01-03_03-00_weekly.gz'
+
+FOLDER = 'fake-folder'
+
+
+def make_backup(size_mb):
+    """Get a compressed synthetic dump of ``size_mb`` MiB"""
+    output = io.BytesIO()
+    with ParallelGzipWriter(output, threads=os.cpu_count() or 1) as writer:
+        for line in table_data('t', size_mb * 1024 * 1024):
+            writer.write(line.encode('utf-8'))
+    return output.getvalue()
+
+
+def restore(server, catalog, cache, mysql, downloads, range_size):
+    """Restore the backup into the fake mysql client, returns the stage records of the run"""
+    metrics = start_run()
+    gdrive = fake_gdrivecm_class()(server, remote_folder=FOLDER)
+    with tempfile.TemporaryDirectory() as local_dir:
+        restorecm = RestoreCM('jom', local_dir, remote_dir=FOLDER, catalog=catalog, gdrivecm=gdrive, cache=cache,
+                              range_size=range_size, workers=downloads)
+        with app_scope('jom'), stage('restore'):
+            restorecm.restore(MysqlImportWriter(MysqlClientCM(mysql, 'jom', 'jom'), 'jom'))
+    return metrics.report()['apps']['jom']['stages']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=256, help='size of the dump in MiB (before compression)')
+    parser.add_argument('--downloads', type=int, nargs='+', default=[1, 4, 8], help='parallel range requests')
+    parser.add_argument('--range-size', type=int, default=8 * 1024 * 1024)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per round-trip')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a 500 answer')
+    args = parser.parse_args()
+
+    configure_request_executor(rate=1000, burst=1000)
+    backup = make_backup(args.size)
+    print('dump of {} MiB, backup of {:.1f} MiB'.format(args.size, len(backup) / 1024 / 1024))
+    drive = FakeDrive(latency=args.latency, error_rate=args.error_rate)
+    with FakeDriveServer(drive) as server, tempfile.TemporaryDirectory() as tmp:
+        file_id = drive.add_file(BACKUP_NAME, FOLDER, backup)
+        catalog = BackupCatalogCM(':memory:')
+        catalog.add('remote', FOLDER, BACKUP_NAME, parse_timestamp(BACKUP_NAME), app='jom', file_id=file_id,
+                    size=len(backup), md5=hashlib.md5(backup).hexdigest())
+        mysql = install(tmp, {'database': 'jom', 'tables': {}, 'binary_logs': ['mysql-bin.000001']})['mysql']
+
+        print('{:<6} {:>9} {:>9} {:>8}'.format('from', 'downloads', 'seconds', 'MiB/s') +
+              ''.join(' {:>10}'.format(name) for name in RESTORE_STAGES))
+        for downloads in args.downloads:
+            cache = ArtifactCacheCM(os.path.join(tmp, 'cache-{}'.format(downloads)), max_size=len(backup) * 2)
+            for source in ('drive', 'cache'):
+                stages = restore(server, catalog, cache, mysql, downloads, args.range_size)
+                seconds = stages['restore']['seconds']
+                print('{:<6} {:>9} {:>9.3f} {:>8.1f}'.format(source, downloads, seconds, args.size / seconds) +
+                      ''.join(' {:>10.3f}'.format(stages[name]['seconds'] if name in stages else 0)
+                              for name in RESTORE_STAGES))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# autobackup-dcm: equivalence check and scaling benchmark of RotateBackupsCM.apply_rotation_scheme().
+# the previous implementation is kept here (legacy_apply_rotation_scheme). First randomized rotation schemes
+# and backup sets (duplicated timestamps, unsorted input, 'always' and 0 retention periods) are rotated with
+# both and the preserved backups compared; then both are timed from 1k to 1M hourly backups (the legacy one
+# only up to --legacy-limit). The exit code is 1 when a difference is found, so it can gate a change.
+#
+# run from this directory like the scripts: PYTHONPATH=.. python bench_rotation_scheme.py --cases 500
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import argparse
+import datetime
+import random
+import sys
+import time
+
+# Modules included in our package.
+from core.rotate_dcm import SUPPORTED_FREQUENCIES, Backup, RotateBackupsCM
+
+
+def legacy_apply_rotation_scheme(rotation_scheme, backups_by_frequency, most_recent_backup):
+    """The implementation before the single pass rewrite, with the same mutations of ``backups_by_frequency``."""
+    if not rotation_scheme:
+        raise ValueError("Refusing to use empty rotation scheme! (all backups would be deleted)")
+    for frequency, backups in backups_by_frequency.items():
+        if frequency not in rotation_scheme:
+            backups.clear()
+        else:
+            for period, backups_in_period in backups.items():
+                first_backup = sorted(backups_in_period)[0]
+                backups[period] = [first_backup]
+            retention_period = rotation_scheme[frequency]
+            if retention_period != 'always':
+                minimum_date = most_recent_backup - SUPPORTED_FREQUENCIES[frequency] * retention_period
+                for period, backups_in_period in list(backups.items()):
+                    for backup in backups_in_period:
+                        if backup.datetime < minimum_date:
+                            backups_in_period.remove(backup)
+                    if not backups_in_period:
+                        backups.pop(period)
+                items_to_preserve = sorted(backups.items())[-retention_period:]
+                backups_by_frequency[frequency] = dict(items_to_preserve)
+
+
+def random_scheme(rng):
+    scheme = {}
+    for frequency in SUPPORTED_FREQUENCIES:
+        choice = rng.random()
+        if choice < 0.15:
+            scheme[frequency] = 'always'
+        elif choice < 0.25:
+            scheme[frequency] = 0
+        elif choice < 0.8:
+            scheme[frequency] = rng.randint(1, 30)
+    return scheme or {'daily': rng.randint(1, 10)}
+
+
+def random_backups(rng, count):
+    start = datetime.datetime(rng.randint(2000, 2020), 1, 1)
+    span = rng.choice([48, 24 * 60, 24 * 800, 24 * 365 * 6])  # hours
+    stamps = [start + datetime.timedelta(hours=rng.randrange(span), minutes=rng.choice([0, 0, 30]))
+              for i in range(count)]
+    stamps += rng.sample(stamps, count // 10)  # backups with the same timestamp
+    backups = [Backup('/backups/b{:06d}.gz'.format(i), stamp, file_type='file') for i, stamp in enumerate(stamps)]
+    if rng.random() < 0.7:
+        backups.sort()  # collect_backups() gives them sorted, group_backups() accepts any order
+    return backups
+
+
+def preserved(rotate, backups, apply):
+    """Rotate ``backups`` with ``apply`` and get the preserved pathnames with the frequencies of each one."""
+    backups_by_frequency = rotate.group_backups(backups)
+    apply(backups_by_frequency, max(backups).datetime)
+    return dict((backup.pathname, frequencies)
+                for backup, frequencies in rotate.find_preservation_criteria(backups_by_frequency).items())
+
+
+def check_equivalence(cases, seed):
+    rng = random.Random(seed)
+    for case in range(cases):
+        scheme = random_scheme(rng)
+        backups = random_backups(rng, rng.choice([1, 2, 10, 100, 1000]))
+        rotate = RotateBackupsCM(scheme)
+        current = preserved(rotate, backups, rotate.apply_rotation_scheme)
+        legacy = preserved(rotate, backups, lambda groups, most_recent: legacy_apply_rotation_scheme(
+            scheme, groups, most_recent))
+        if current != legacy:
+            print('case {}: scheme {} with {} backups preserves {} backups, the legacy implementation {}'.format(
+                case, scheme, len(backups), len(current), len(legacy)))
+            return False
+    return True
+
+
+def scaling(sizes, legacy_limit):
+    scheme = {'hourly': 24 * 7, 'daily': 30, 'weekly': 8, 'monthly': 12, 'yearly': 'always'}
+    rotate = RotateBackupsCM(scheme)
+    start = datetime.datetime(2000, 1, 1)
+    print('{:>9} {:>12} {:>12}'.format('backups', 'current s', 'legacy s'))
+    for size in sizes:
+        backups = [Backup('/backups/b{:07d}.gz'.format(i), start + datetime.timedelta(hours=i), file_type='file')
+                   for i in range(size)]
+        times = []
+        for legacy, apply in ((False, rotate.apply_rotation_scheme),
+                              (True, lambda groups, most_recent: legacy_apply_rotation_scheme(scheme, groups,
+                                                                                              most_recent))):
+            if legacy and size > legacy_limit:
+                times.append(None)
+                continue
+            backups_by_frequency = rotate.group_backups(backups)
+            begin = time.perf_counter()
+            apply(backups_by_frequency, backups[-1].datetime)
+            times.append(time.perf_counter() - begin)
+        print('{:>9} {:>12.3f} {:>12}'.format(size, times[0], '-' if times[1] is None else '{:.3f}'.format(times[1])))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cases', type=int, default=500, help='randomized equivalence cases')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--legacy-limit', type=int, default=100000, help='largest size timed with the legacy code')
+    args = parser.parse_args()
+
+    equivalent = check_equivalence(args.cases, args.seed)
+    print('equivalent to the legacy implementation in {} random cases: {}'.format(args.cases, equivalent))
+    scaling(args.sizes, args.legacy_limit)
+    sys.exit(0 if equivalent else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# autobackup-dcm: benchmark of the cold start of the modules the scripts import.
+# every module is imported in a new interpreter with ``python -X importtime``, its cumulative import time is
+# compared to a budget and the modules it pulls in are checked: the google client libraries must not be loaded
+# until Google drive is used, and importing must not configure logging. The exit code is 1 when a module is over
+# its budget or has import side effects, so a cron job or a CI step can enforce it.
+#
+# run from this directory like the scripts: PYTHONPATH=.. python bench_startup.py --budget 150 --repeat 5
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+MODULES = ('core', 'core.stream_dcm', 'core.catalog_dcm', 'core.rotate_dcm', 'core.gdrive_dcm',
+           'core.generic_backup')
+
+GOOGLE_MODULES = ('httplib2', 'apiclient', 'googleapiclient', 'oauth2client')
+
+IMPORTTIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+# imports the module, then prints the google modules loaded and the handlers of the program loggers
+PROBE = '''
+import logging, sys
+import {module}
+print(' '.join(name for name in sys.modules if name.split('.')[0] in {google!r}))
+print(len(logging.getLogger('dacopancm').handlers) + len(logging.getLogger().handlers))
+'''
+
+
+def import_module(module):
+    """Import ``module`` in a new interpreter
+
+    :return: a tuple with the cumulative import time of the module in milliseconds, the google modules loaded and
+             the number of logging handlers configured by the import
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                              PROBE.format(module=module, google=GOOGLE_MODULES)],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode:
+        raise RuntimeError('import {} failed:\n{}'.format(module, process.stderr[-2000:]))
+    cumulative = 0
+    for line in process.stderr.splitlines():
+        match = IMPORTTIME.match(line)
+        if match and match.group(4) == module:
+            cumulative = int(match.group(2))
+    google, handlers = process.stdout.splitlines()
+    return cumulative / 1000.0, google.split(), int(handlers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--budget', type=float, default=150, help='import time budget of a module in milliseconds')
+    parser.add_argument('--repeat', type=int, default=5, help='imports of every module, the best one counts')
+    parser.add_argument('modules', nargs='*', default=MODULES, help='modules to import')
+    args = parser.parse_args()
+
+    # the modules open their files relative to the scripts directory, like the scripts
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+    errors = []
+    print('{:24s} {:>10s}  {}'.format('module', 'import ms', 'google modules loaded'))
+    for module in args.modules:
+        results = [import_module(module) for _ in range(max(args.repeat, 1))]
+        best = min(elapsed for elapsed, google, handlers in results)
+        elapsed, google, handlers = results[0]
+        print('{:24s} {:10.1f}  {}'.format(module, best, ' '.join(sorted(google)) or '-'))
+        if best > args.budget:
+            errors.append('{} imports in {:.1f} ms, the budget is {:.1f} ms'.format(module, best, args.budget))
+        if google:
+            errors.append('{} loads the google libraries: {}'.format(module, ' '.join(sorted(google))))
+        if handlers:
+            errors.append('{} configures logging when it is imported'.format(module))
+
+    for error in errors:
+        print('ERROR', error)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
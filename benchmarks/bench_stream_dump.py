@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# autobackup-dcm: benchmark of the peak memory used to dump and compress a database.
+# compares the old buffered path (whole dump captured in memory, then piped to gzip) with the
+# streaming path of :mod:`core.stream_dcm`, using a fake mysqldump that writes N MiB of SQL.
+#
+# run from this directory like the scripts: PYTHONPATH=.. python bench_stream_dump.py --sizes 16 64 256
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+FAKE_MYSQLDUMP = r'''
+import sys
+size = int(sys.argv[1]) * 1024 * 1024
+row = b"INSERT INTO `t` VALUES (1,'lorem ipsum dolor sit amet',3.14159,'2016-04-02 10:00:00');\n"
+out = sys.stdout.buffer
+written = 0
+while written < size:
+    out.write(row * 1024)
+    written += len(row) * 1024
+'''
+
+
+def fake_mysqldump(size_mb):
+    return [sys.executable, '-c', FAKE_MYSQLDUMP, str(size_mb)]
+
+
+def run_buffered(size_mb, output):
+    dump = subprocess.run(fake_mysqldump(size_mb), stdout=subprocess.PIPE, check=True).stdout
+    with open(output, 'wb') as f:
+        subprocess.run(['gzip', '-c'], input=dump, stdout=f, check=True)
+
+
+def run_streaming(size_mb, output):
+    from core.stream_dcm import GzipWriter, stream_command
+
+    with open(output, 'wb') as f:
+        gzip_writer = GzipWriter(f)
+        stream_command(fake_mysqldump(size_mb), gzip_writer)
+        gzip_writer.close()
+
+
+def child(mode, size_mb):
+    """Run one dump in this (fresh) process and print its peak RSS in KiB."""
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, 'bench.gz')
+        start = time.perf_counter()
+        run_buffered(size_mb, output) if mode == 'buffered' else run_streaming(size_mb, output)
+        elapsed = time.perf_counter() - start
+        compressed = os.path.getsize(output)
+    print(json.dumps({'mode': mode, 'size_mb': size_mb, 'seconds': round(elapsed, 3), 'compressed': compressed,
+                      'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16, 64, 256], help='dump sizes in MiB')
+    parser.add_argument('--modes', nargs='+', default=['buffered', 'streaming'])
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'SIZE_MB'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], int(args.child[1]))
+        return
+
+    print('{:<10} {:>8} {:>10} {:>14}'.format('mode', 'MiB', 'seconds', 'peak RSS MiB'))
+    for mode in args.modes:
+        for size_mb in args.sizes:
+            # every measure runs in its own process so ru_maxrss is not shared between runs
+            out = subprocess.check_output([sys.executable, __file__, '--child', mode, str(size_mb)])
+            res = json.loads(out.decode().strip().splitlines()[-1])
+            print('{:<10} {:>8} {:>10} {:>14.1f}'.format(mode, size_mb, res['seconds'], res['peak_rss_kb'] / 1024))
+
+
+if __name__ == '__main__':
+    main()
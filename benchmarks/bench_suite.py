@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# autobackup-dcm: benchmark suite of the listing, rotation, upload and pruning paths, with results in JSON.
+# every scenario runs on synthetic backup folders (see synthetic_backups) of the sizes asked, the Google Drive ones
+# against the local fake Drive server with the latency, server errors and rate limits asked. The best of --repeat
+# runs is kept with the round-trips, requests and retries it took. --output writes the results with the commit they
+# were measured on and --compare reads the results of another commit: the exit code is 1 when a scenario is slower
+# than the baseline by more than --threshold, or when a scenario gave a wrong result.
+#
+# run from this directory like the scripts:
+#   PYTHONPATH=.. python bench_suite.py --sizes 1000 10000 100000 --output base.json
+#   PYTHONPATH=.. python bench_suite.py --sizes 1000 10000 100000 --compare base.json
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import argparse
+import collections
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+# Modules included in our package.
+from core.metrics_dcm import app_scope, start_run
+from core.ratelimit_dcm import configure_request_executor, request_stats
+from core.rotate_dcm import RotateBackupsCM
+from fake_drive import FakeDrive, FakeDriveServer, fake_gdrivecm_class
+from synthetic_backups import backup_count, backups, drive_folder, local_folder
+
+FOLDER = 'fake-folder'
+
+ROTATION_SCHEME = {'hourly': 24, 'daily': 7, 'weekly': 4, 'monthly': 12, 'yearly': 'always'}
+
+MIN_SECONDS = 0.01  # shorter runs are too noisy to be compared
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def drive_counters(drive):
+    """Get the counters of the fake Drive and of the request executor, and start them again from zero"""
+    stats = request_stats(reset=True)
+    counters = {'round_trips': drive.counters['round_trips'], 'requests': stats.get('requests', 0),
+                'retries': stats.get('retries', 0), 'failures': stats.get('failures', 0)}
+    drive.counters.clear()
+    return counters
+
+
+def new_drive(args):
+    return FakeDrive(latency=args.latency, error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                     seed=args.seed)
+
+
+def collect_backups(size, args):
+    """Scan a local folder of ``size`` entries"""
+    rotate = RotateBackupsCM(ROTATION_SCHEME)
+    with tempfile.TemporaryDirectory() as directory:
+        expected = local_folder(directory, size)
+        runs = [timed(rotate.collect_backups, directory, 'local') for _ in range(args.repeat)]
+    seconds, found = min(runs, key=lambda run: run[0])
+    return {'seconds': seconds, 'backups': len(found), 'ok': len(found) == expected}
+
+
+def apply_rotation_scheme(size, args):
+    """Apply the rotation scheme to ``size`` entries already grouped"""
+    rotate = RotateBackupsCM(ROTATION_SCHEME)
+    sorted_backups = backups(size)
+    runs = []
+    for _ in range(args.repeat):
+        backups_by_frequency = rotate.group_backups(sorted_backups)
+        elapsed, _ = timed(rotate.apply_rotation_scheme, backups_by_frequency, sorted_backups[-1].datetime)
+        runs.append((elapsed, len(rotate.find_preservation_criteria(backups_by_frequency))))
+    seconds, preserved = min(runs)
+    return {'seconds': seconds, 'preserved': preserved, 'ok': 0 < preserved <= len(sorted_backups)}
+
+
+def get_files(size, args):
+    """Page through a Drive folder of ``size`` entries"""
+    drive = new_drive(args)
+    drive_folder(drive, FOLDER, size)
+    with FakeDriveServer(drive) as server:
+        gdrive = fake_gdrivecm_class()(server, remote_folder=FOLDER)
+        gdrive.get_service()  # discovery and connection setup are not part of the measure
+        runs = []
+        for _ in range(args.repeat):
+            drive_counters(drive)
+            elapsed, files = timed(gdrive.get_files, FOLDER)
+            runs.append((elapsed, len(files), drive_counters(drive)))
+    seconds, listed, counters = min(runs, key=lambda run: run[0])
+    return dict(counters, seconds=seconds, ok=listed == size)
+
+
+def upload(size, args):
+    """Upload ``args.upload_files`` files of ``size`` MiB"""
+    drive = new_drive(args)
+    with tempfile.TemporaryDirectory() as directory, FakeDriveServer(drive) as server:
+        files = []
+        for index in range(args.upload_files):
+            files.append(os.path.join(directory, 'jom_2016-01-{:02d}_10-00_daily.gz'.format(index + 1)))
+            with open(files[-1], 'wb') as f:
+                f.write(os.urandom(size * 1024 * 1024))
+        gdrive = fake_gdrivecm_class()(server, remote_folder=FOLDER)
+        gdrive.get_service()
+        runs = []
+        for _ in range(args.repeat):
+            drive_counters(drive)
+            elapsed, results = timed(gdrive.upload_files, files, args.concurrency)
+            runs.append((elapsed, all(results.values()), drive_counters(drive)))
+    seconds, uploaded, counters = min(runs, key=lambda run: run[0])
+    total = size * args.upload_files
+    return dict(counters, seconds=seconds, mib_per_second=total / seconds, ok=uploaded)
+
+
+def prune(size, args):
+    """Rotate a Drive folder of ``size`` entries: list it, apply the scheme and delete the expired backups in
+    batches, a new folder for every run"""
+    runs = []
+    for _ in range(args.repeat):
+        drive = new_drive(args)
+        drive_folder(drive, FOLDER, size)
+        with FakeDriveServer(drive) as server:
+            gdrive = fake_gdrivecm_class()(server, remote_folder=FOLDER)
+            gdrive.get_service()
+            rotate = RotateBackupsCM(ROTATION_SCHEME, rotate_type='remote', gdrivecm=gdrive)
+            drive_counters(drive)
+            metrics = start_run()
+            with app_scope('bench'):
+                elapsed, _ = timed(rotate.rotate_backups, FOLDER)
+            counters = drive_counters(drive)
+        stages = metrics.report()['apps']['bench']['stages']
+        remaining = sum(1 for f in drive.files.values() if not f['name'].endswith(('.md5', '.txt')))
+        runs.append((elapsed, remaining, dict(counters, listing_seconds=stages['remote_listing']['seconds'],
+                                              delete_seconds=stages.get('remote_delete', {}).get('seconds', 0.0))))
+    seconds, remaining, counters = min(runs, key=lambda run: run[0])
+    preserved = apply_rotation_scheme(size, argparse.Namespace(repeat=1))['preserved']
+    return dict(counters, seconds=seconds, deleted=backup_count(size) - remaining, ok=remaining == preserved)
+
+
+SCENARIOS = collections.OrderedDict([
+    ('collect_backups', (collect_backups, 'entries')),
+    ('apply_rotation_scheme', (apply_rotation_scheme, 'entries')),
+    ('get_files', (get_files, 'entries')),
+    ('upload', (upload, 'MiB')),
+    ('prune', (prune, 'entries')),
+])
+
+
+def git_commit():
+    """Get the commit of the tree measured, with ``+`` when it has uncommitted changes"""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL)
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                        stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.decode().strip() + ('+' if dirty.strip() else '')
+
+
+def run_scenario(name, size, args):
+    function = SCENARIOS[name][0]
+    try:
+        result = function(size, args)
+    except ImportError as e:  # the google client libraries are needed by the fake Drive client
+        return {'skipped': str(e)}
+    result['seconds'] = round(result['seconds'], 6)
+    return result
+
+
+def compare(results, baseline, threshold):
+    """Print the results next to the ones of ``baseline``
+
+    :returns: the list of the scenarios slower than the baseline by more than ``threshold``
+    """
+    regressions = []
+    print('\ncompared to {} ({})'.format(baseline.get('commit'), baseline.get('started')))
+    print('{:24s} {:>9s} {:>12s} {:>12s} {:>8s}'.format('scenario', 'size', 'baseline s', 'current s', 'ratio'))
+    for name, sizes in results.items():
+        for size, result in sizes.items():
+            base = baseline.get('results', {}).get(name, {}).get(size)
+            if not base or 'seconds' not in base or 'seconds' not in result:
+                continue
+            ratio = result['seconds'] / base['seconds'] if base['seconds'] else float('inf')
+            slower = ratio > 1 + threshold and result['seconds'] > MIN_SECONDS
+            print('{:24s} {:>9s} {:12.4f} {:12.4f} {:7.2f}x{}'.format(name, size, base['seconds'], result['seconds'],
+                                                                    ratio, '  SLOWER' if slower else ''))
+            if slower:
+                regressions.append('{} {}'.format(name, size))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS), help='scenarios to run, all by default')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='entries of the synthetic folders, up to 1000000')
+    parser.add_argument('--upload-sizes', type=int, nargs='+', default=[1, 16], help='MiB of every uploaded file')
+    parser.add_argument('--upload-files', type=int, default=4, help='files uploaded at every size')
+    parser.add_argument('--concurrency', type=int, default=2, help='uploads at the same time')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every scenario, the best one counts')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every round-trip')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a 500 per call')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='probability of a 403 rate limit per call')
+    parser.add_argument('--drive-rate', type=float, default=1000.0, help='requests per second of the rate limiter')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the injected errors')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', metavar='BASELINE', help='JSON results of another commit to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slowdown over the baseline that fails')
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(', '.join(sorted(unknown))))
+
+    # the retries of the injected errors wait a little, the benchmark measures the code not the backoff
+    configure_request_executor(rate=args.drive_rate, burst=int(args.drive_rate), backoff_base=0.01, backoff_max=0.1)
+    report = collections.OrderedDict([
+        ('commit', git_commit()), ('started', datetime.datetime.now().isoformat()),
+        ('python', platform.python_version()), ('platform', platform.platform()),
+        ('options', dict((key, value) for key, value in vars(args).items() if key not in ('output', 'compare'))),
+        ('results', collections.OrderedDict()),
+    ])
+    failed = []
+    print('{:24s} {:>9s} {:>12s}  {}'.format('scenario', 'size', 'seconds', 'details'))
+    for name in args.scenarios:
+        unit = SCENARIOS[name][1]
+        results = report['results'][name] = collections.OrderedDict()
+        for size in args.upload_sizes if unit == 'MiB' else args.sizes:
+            result = results[str(size)] = run_scenario(name, size, args)
+            if 'skipped' in result:
+                print('{:24s} {:>9} {:>12s}  {}'.format(name, size, 'skipped', result['skipped']))
+                break
+            details = ', '.join('{}={}'.format(key, round(value, 3) if isinstance(value, float) else value)
+                                for key, value in sorted(result.items()) if key not in ('seconds', 'ok'))
+            print('{:24s} {:>9} {:12.4f}  {}{}'.format(name, size, result['seconds'], details,
+                                                       '' if result['ok'] else '  WRONG RESULT'))
+            if not result['ok']:
+                failed.append('{} {}'.format(name, size))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report['results'], json.load(f), args.threshold)
+    for name in failed:
+        print('ERROR {} gave a wrong result'.format(name))
+    for name in regressions:
+        print('ERROR {} is slower than the baseline'.format(name))
+    return 1 if failed or regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# autobackup-dcm: local stand-in for the Google Drive v3 API used by benchmarks.
+# it serves a minimal discovery document, files list/get/delete, the changes feed, resumable uploads, downloads
+# (``alt=media`` with range requests) and the batch endpoint, keeps the files in memory and counts every HTTP
+# round-trip, with configurable latency, server errors and rate limits, so :class:`core.gdrive_dcm.GDriveCM` can be exercised without Google credentials through
+# :class:`FakeGDriveCM`.
+#
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import collections
+import email.parser
+import hashlib
+import itertools
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+PAGE_SIZE = 100  # default page size of files().list in Drive v3
+
+PARENT_QUERY = re.compile(r"'([^']+)' in parents")
+
+CONTENT_RANGE = re.compile(r'bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)')
+
+RANGE = re.compile(r'bytes=(\d+)-(\d*)')
+
+HTTP_REASONS = {200: 'OK', 204: 'No Content', 308: 'Resume Incomplete', 400: 'Bad Request', 403: 'Forbidden',
+                404: 'Not Found', 410: 'Gone', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+def discovery_document(root_url):
+    """Build the subset of the Drive v3 discovery document used by :class:`~core.gdrive_dcm.GDriveCM`."""
+
+    def param(location='query', required=False, kind='string'):
+        desc = {'type': kind, 'location': location}
+        if required:
+            desc['required'] = True
+        return desc
+
+    return {
+        'kind': 'discovery#restDescription', 'discoveryVersion': 'v1', 'id': 'drive:v3', 'name': 'drive',
+        'version': 'v3', 'protocol': 'rest', 'rootUrl': root_url, 'servicePath': 'drive/v3/',
+        'batchPath': 'batch/drive/v3',
+        'parameters': {'alt': param(), 'fields': param(), 'prettyPrint': param(kind='boolean'),
+                       'quotaUser': param()},
+        'schemas': {'File': {'id': 'File', 'type': 'object'}, 'FileList': {'id': 'FileList', 'type': 'object'},
+                    'ChangeList': {'id': 'ChangeList', 'type': 'object'},
+                    'StartPageToken': {'id': 'StartPageToken', 'type': 'object'}},
+        'resources': {'changes': {'methods': {
+            'getStartPageToken': {'id': 'drive.changes.getStartPageToken', 'path': 'changes/startPageToken',
+                                  'httpMethod': 'GET', 'response': {'$ref': 'StartPageToken'}},
+            'list': {'id': 'drive.changes.list', 'path': 'changes', 'httpMethod': 'GET',
+                     'parameters': {'pageToken': param(required=True), 'spaces': param(),
+                                    'pageSize': param(kind='integer'), 'includeRemoved': param(kind='boolean')},
+                     'parameterOrder': ['pageToken'], 'response': {'$ref': 'ChangeList'}},
+        }}, 'files': {'methods': {
+            'list': {'id': 'drive.files.list', 'path': 'files', 'httpMethod': 'GET',
+                     'parameters': {'q': param(), 'spaces': param(), 'pageToken': param(),
+                                    'pageSize': param(kind='integer'), 'orderBy': param()},
+                     'response': {'$ref': 'FileList'}},
+            'get': {'id': 'drive.files.get', 'path': 'files/{fileId}', 'httpMethod': 'GET',
+                    'parameters': {'fileId': param('path', True)}, 'parameterOrder': ['fileId'],
+                    'response': {'$ref': 'File'}},
+            'delete': {'id': 'drive.files.delete', 'path': 'files/{fileId}', 'httpMethod': 'DELETE',
+                       'parameters': {'fileId': param('path', True)}, 'parameterOrder': ['fileId']},
+        }}},
+    }
+
+
+class FakeDrive(object):
+    """In memory state of the fake Drive: files, round-trip counters, latency and injected errors."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0, interrupt_at=None, rate_limit_rate=0.0):
+        """
+        :param latency: seconds added to every HTTP round-trip.
+        :param error_rate: probability (0-1) that a single API call answers ``500``, also inside batches.
+        :param seed: seed of the random generator used for the injected errors.
+        :param interrupt_at: an upload chunk that crosses this many received bytes is cut there and
+                             answered with ``503`` (only once), to simulate an upload interrupted by a crash.
+        :param rate_limit_rate: probability (0-1) that a single API call answers ``403 rateLimitExceeded``.
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.interrupt_at = interrupt_at
+        self.random = random.Random(seed)
+        self.root_url = None
+        self.files = collections.OrderedDict()
+        self.contents = {}
+        self.changes = []
+        self.oldest_token = 0
+        self.uploads = {}
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        # the listings of a folder are kept until the files change, paging through a big folder stays linear
+        self.version = 0
+        self.listings = {}
+
+    def add_file(self, name, parent, content=b''):
+        return self.add_files([name], parent, content)[0]
+
+    def add_files(self, names, parent, content=b''):
+        """Add a file with ``content`` for every name in ``names`` to the folder ``parent``, returns their ids."""
+        size, md5 = str(len(content)), hashlib.md5(content).hexdigest()
+        ids = []
+        with self.lock:
+            for name in names:
+                file_id = 'f{:08d}'.format(next(self.ids))
+                self.files[file_id] = {'id': file_id, 'name': name, 'parents': [parent], 'size': size,
+                                       'md5Checksum': md5}
+                if content:
+                    self.contents[file_id] = content
+                self.changes.append(file_id)
+                ids.append(file_id)
+            self.version += 1
+        return ids
+
+    def update_file(self, file_id, **metadata):
+        """Change the metadata of a file out of band (rename, move or trash it), it is logged as a change."""
+        with self.lock:
+            self.files[file_id].update(metadata)
+            self.changes.append(file_id)
+            self.version += 1
+
+    def expire_page_tokens(self):
+        """Make every page token given so far invalid, as Drive does with very old tokens."""
+        with self.lock:
+            self.oldest_token = len(self.changes)
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def fail(self):
+        """Draw the error injected in a call: ``500``, ``403`` (a rate limit) or ``None``."""
+        if not (self.error_rate or self.rate_limit_rate):
+            return None
+        with self.lock:
+            draw = self.random.random()
+        if draw < self.error_rate:
+            return 500
+        if draw < self.error_rate + self.rate_limit_rate:
+            return 403
+        return None
+
+    def call(self, method, url, headers, body):
+        """Answer one API call, returns a tuple ``(status, headers, body)``."""
+        parts = urlsplit(url)
+        path = parts.path
+        query = dict((k, v[0]) for k, v in parse_qs(parts.query).items())
+        self.count('calls')
+
+        if path.startswith('/discovery/'):
+            return 200, {}, self.json(self.discovery)
+        error = self.fail()
+        if error == 500:
+            self.count('injected_errors')
+            return 500, {}, self.json({'error': {'code': 500, 'message': 'injected error'}})
+        if error == 403:
+            self.count('injected_rate_limits')
+            return 403, {}, self.json({'error': {'code': 403, 'message': 'Rate Limit Exceeded', 'errors': [
+                {'domain': 'usageLimits', 'reason': 'rateLimitExceeded', 'message': 'Rate Limit Exceeded'}]}})
+
+        if path == '/upload/drive/v3/files' and method == 'POST':
+            return self.start_upload(query, headers, body)
+        if path == '/upload/drive/v3/files' and method == 'PUT':
+            return self.upload_chunk(query, headers, body)
+
+        if path == '/drive/v3/changes/startPageToken' and method == 'GET':
+            return self.start_page_token()
+        if path == '/drive/v3/changes' and method == 'GET':
+            return self.list_changes(query)
+
+        match = re.match(r'^/drive/v3/files(?:/([^/]+))?$', path)
+        if match and match.group(1) is None and method == 'GET':
+            return self.list_files(query)
+        if match and method == 'GET' and query.get('alt') == 'media':
+            return self.download_file(unquote(match.group(1)), headers.get('Range'))
+        if match and method == 'GET':
+            return self.get_file(unquote(match.group(1)))
+        if match and method == 'DELETE':
+            return self.delete_file(unquote(match.group(1)))
+        return 404, {}, self.json({'error': {'code': 404, 'message': 'unknown endpoint {} {}'.format(method, path)}})
+
+    def list_files(self, query):
+        self.count('list')
+        parent = PARENT_QUERY.search(query.get('q', ''))
+        key = (parent.group(1) if parent else None, 'trashed = false' in query.get('q', ''))
+        with self.lock:
+            version, files = self.listings.get(key, (None, None))
+            if version != self.version:
+                files = [f for f in self.files.values() if (not parent or parent.group(1) in f['parents']) and
+                         not (key[1] and f.get('trashed'))]
+                self.listings[key] = (self.version, files)
+        start = int(query.get('pageToken', 0))
+        size = int(query.get('pageSize', PAGE_SIZE))
+        response = {'files': files[start:start + size]}
+        if start + size < len(files):
+            response['nextPageToken'] = str(start + size)
+        return 200, {}, self.json(response)
+
+    def start_page_token(self):
+        self.count('changes_token')
+        with self.lock:
+            return 200, {}, self.json({'startPageToken': str(len(self.changes))})
+
+    def list_changes(self, query):
+        """Page through the change log, a page token is the position in the log."""
+        self.count('changes')
+        start = int(query.get('pageToken', 0))
+        size = int(query.get('pageSize', PAGE_SIZE))
+        with self.lock:
+            if start < self.oldest_token or start > len(self.changes):
+                return 400, {}, self.json({'error': {'code': 400, 'message': 'Invalid Value: pageToken'}})
+            changes = []
+            for file_id in self.changes[start:start + size]:
+                metadata = self.files.get(file_id)
+                if metadata is None:
+                    changes.append({'fileId': file_id, 'removed': True})
+                else:
+                    changes.append({'fileId': file_id, 'removed': False, 'file': dict(metadata)})
+            end = len(self.changes)
+        response = {'changes': changes}
+        if start + size < end:
+            response['nextPageToken'] = str(start + size)
+        else:
+            response['newStartPageToken'] = str(end)
+        return 200, {}, self.json(response)
+
+    def get_file(self, file_id):
+        self.count('get')
+        with self.lock:
+            metadata = self.files.get(file_id)
+        if metadata is None:
+            return 404, {}, self.json({'error': {'code': 404, 'message': 'File not found: ' + file_id}})
+        return 200, {}, self.json(metadata)
+
+    def download_file(self, file_id, range_header=None):
+        """Answer the content of a file, the part asked for with ``bytes=first-last`` in a range request."""
+        self.count('download')
+        with self.lock:
+            metadata = self.files.get(file_id)
+            content = self.contents.get(file_id, b'')
+        if metadata is None:
+            return 404, {}, self.json({'error': {'code': 404, 'message': 'File not found: ' + file_id}})
+        headers = {'Content-Type': 'application/octet-stream'}
+        match = RANGE.match(range_header or '')
+        if not match:
+            return 200, headers, content
+        first = int(match.group(1))
+        last = min(int(match.group(2)), len(content) - 1) if match.group(2) else len(content) - 1
+        if first > last:
+            return 416, {'Content-Range': 'bytes */{}'.format(len(content))}, b''
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(first, last, len(content))
+        return 206, headers, content[first:last + 1]
+
+    def delete_file(self, file_id):
+        self.count('delete')
+        with self.lock:
+            metadata = self.files.pop(file_id, None)
+            if metadata is not None:
+                self.changes.append(file_id)
+                self.version += 1
+        if metadata is None:
+            return 404, {}, self.json({'error': {'code': 404, 'message': 'File not found: ' + file_id}})
+        return 204, {}, b''
+
+    def start_upload(self, query, headers, body):
+        self.count('upload_sessions')
+        metadata = json.loads(body.decode('utf-8'))
+        upload_id = uuid.uuid4().hex
+        size = headers.get('X-Upload-Content-Length')
+        with self.lock:
+            self.uploads[upload_id] = {'metadata': metadata, 'size': int(size) if size else None, 'received': 0,
+                                       'md5': hashlib.md5(), 'fields': query.get('fields')}
+        location = '{}upload/drive/v3/files?uploadType=resumable&upload_id={}'.format(self.root_url, upload_id)
+        return 200, {'Location': location}, b''
+
+    def upload_chunk(self, query, headers, body):
+        """Receive one chunk (or a status query) of a resumable upload session."""
+        self.count('upload_chunks')
+        upload = self.uploads.get(query.get('upload_id'))
+        match = CONTENT_RANGE.match(headers.get('Content-Range', ''))
+        if upload is None:
+            return 404, {}, self.json({'error': {'code': 404, 'message': 'upload session not found'}})
+        if match is None:
+            return 400, {}, self.json({'error': {'code': 400, 'message': 'bad Content-Range'}})
+
+        start, end, total = match.groups()
+        if 'file' in upload:
+            return 200, {}, self.json(upload['file'])
+        if total != '*':
+            upload['size'] = int(total)
+        with self.lock:
+            self.counters['upload_bytes'] += len(body)
+        if start is not None and int(start) <= upload['received']:
+            # bytes already received (a chunk sent again) are skipped
+            data = body[upload['received'] - int(start):]
+            if self.interrupt_at is not None and upload['received'] + len(data) > self.interrupt_at:
+                data = data[:max(self.interrupt_at - upload['received'], 0)]
+                self.interrupt_at = None
+                self.accept(upload, data)
+                return 503, {}, self.json({'error': {'code': 503, 'message': 'injected interruption'}})
+            self.accept(upload, data)
+
+        if upload['size'] is not None and upload['received'] == upload['size']:
+            return 200, {}, self.json(self.finish_upload(upload))
+        headers = {'Range': 'bytes=0-{}'.format(upload['received'] - 1)} if upload['received'] else {}
+        return 308, headers, b''
+
+    @staticmethod
+    def accept(upload, data):
+        upload['md5'].update(data)
+        upload['received'] += len(data)
+
+    def finish_upload(self, upload):
+        with self.lock:
+            if 'file' not in upload:
+                file_id = 'f{:08d}'.format(next(self.ids))
+                metadata = dict(upload['metadata'], id=file_id, size=str(upload['received']),
+                                md5Checksum=upload['md5'].hexdigest())
+                self.files[file_id] = metadata
+                self.changes.append(file_id)
+                self.version += 1
+                fields = upload['fields']
+                upload['file'] = dict((k, v) for k, v in metadata.items() if not fields or k in fields.split(','))
+        return upload['file']
+
+    def expire_uploads(self):
+        """Forget every open upload session, as Drive does after a week."""
+        with self.lock:
+            self.uploads.clear()
+
+    def batch(self, content_type, body):
+        """Answer a ``multipart/mixed`` batch request calling :func:`call()` for every part."""
+        self.count('batches')
+        message = email.parser.BytesParser().parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        boundary = uuid.uuid4().hex
+        out = []
+        for part in message.get_payload():
+            request = part.get_payload(decode=False)
+            request_line, _, rest = request.partition('\n')
+            separator = '\r\n\r\n' if '\r\n\r\n' in rest else '\n\n'
+            headers_text, _, call_body = rest.partition(separator)
+            method, url, _ = request_line.strip().split(' ', 2)
+            status, headers, response = self.call(method, url, {}, call_body.encode())
+            out.append('--{}\r\nContent-Type: application/http\r\nContent-ID: <response-{}>\r\n\r\n'
+                       'HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n\r\n{}\r\n'.format(
+                           boundary, part['Content-ID'][1:-1], status, HTTP_REASONS.get(status, 'Unknown'),
+                           response.decode()))
+        out.append('--{}--\r\n'.format(boundary))
+        return 200, {'Content-Type': 'multipart/mixed; boundary=' + boundary}, ''.join(out).encode()
+
+    @staticmethod
+    def json(value):
+        return json.dumps(value).encode()
+
+
+class FakeDriveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_request(self):
+        drive = self.server.drive
+        drive.count('round_trips')
+        if drive.latency:
+            time.sleep(drive.latency)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.startswith('/batch/'):
+            status, headers, response = drive.batch(self.headers.get('Content-Type'), body)
+        else:
+            status, headers, response = drive.call(self.command, self.path, self.headers, body)
+        self.send_response(status)
+        headers.setdefault('Content-Type', 'application/json')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeDriveServer(object):
+    """Run a :class:`FakeDrive` on ``127.0.0.1`` in a background thread (usable as a context manager)."""
+
+    def __init__(self, drive=None, port=0):
+        self.drive = drive or FakeDrive()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), FakeDriveHandler)
+        self.httpd.drive = self.drive
+        self.root_url = 'http://127.0.0.1:{}/'.format(self.httpd.server_address[1])
+        self.drive.root_url = self.root_url
+        self.drive.discovery = discovery_document(self.root_url)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def fake_gdrivecm_class():
+    """Get a :class:`~core.gdrive_dcm.GDriveCM` subclass that talks to a :class:`FakeDriveServer`."""
+    import httplib2
+    from apiclient import discovery
+    from core.gdrive_dcm import CachedService, GDriveCM
+
+    class FakeGDriveCM(GDriveCM):
+        def __init__(self, server, remote_folder='fake-folder', **kwargs):
+            super().__init__(google_credentials_name='fake-drive-' + server.root_url, google_authorized=True,
+                             remote_folder=remote_folder, **kwargs)
+            self.server = server
+            self.upload_url = server.root_url + 'upload/drive/v3/files'
+            self.download_url = server.root_url + 'drive/v3/files/{}?alt=media'
+
+        def build_service(self):
+            credentials, http = self.build_http()
+            service = discovery.build_from_document(self.server.drive.discovery, http=http)
+            return CachedService(service, credentials, http)
+
+        def build_http(self):
+            return None, self.authorize_http(None)
+
+    return FakeGDriveCM
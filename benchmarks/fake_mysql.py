@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# autobackup-dcm: local stand-in for the ``mysql`` and ``mysqldump`` command line clients used by benchmarks.
+# the database is described by a JSON file (tables and their size, views, binary logs) named by the FAKE_MYSQL_DB
+# environment variable. ``mysqldump`` writes output in the layout of the real one at a limited rate per connection
+# (the server), ``mysql`` answers the queries of :mod:`core.mysql_dcm` and counts the statements it is fed.
+# ``FLUSH BINARY LOGS`` (and ``mysqldump --flush-logs``) open a new binary log and ``PURGE BINARY LOGS TO`` drops
+# the older ones, saved in the JSON file, and ``mysqlbinlog`` writes the position and names it is asked for.
+# :func:`install()` writes the ``mysql``, ``mysqldump`` and ``mysqlbinlog`` executables that run this script.
+#
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import json
+import os
+import re
+import stat
+import sys
+import time
+
+HEADER = '''-- MySQL dump 10.13  Distrib 5.7.99, for Linux (x86_64)
+--
+-- Host: localhost    Database: {database}
+-- ------------------------------------------------------
+-- Server version\t5.7.99-log
+
+/*!40101 SET @OLD_CHARACTER_SET_CLIENT=@@CHARACTER_SET_CLIENT */;
+/*!40101 SET NAMES utf8 */;
+/*!40103 SET @OLD_TIME_ZONE=@@TIME_ZONE */;
+/*!40103 SET TIME_ZONE='+00:00' */;
+/*!40014 SET @OLD_UNIQUE_CHECKS=@@UNIQUE_CHECKS, UNIQUE_CHECKS=0 */;
+/*!40014 SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0 */;
+'''
+
+FOOTER = '''/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
+/*!40014 SET FOREIGN_KEY_CHECKS=@OLD_FOREIGN_KEY_CHECKS */;
+/*!40014 SET UNIQUE_CHECKS=@OLD_UNIQUE_CHECKS */;
+/*!40101 SET CHARACTER_SET_CLIENT=@OLD_CHARACTER_SET_CLIENT */;
+
+-- Dump completed
+'''
+
+TABLE = '''
+--
+-- Table structure for table `{name}`
+--
+
+DROP TABLE IF EXISTS `{name}`;
+CREATE TABLE `{name}` (
+  `id` int(11) NOT NULL,
+  `payload` varchar(255) DEFAULT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+--
+-- Dumping data for table `{name}`
+--
+
+LOCK TABLES `{name}` WRITE;
+'''
+
+ROW = "({},'{}-row-{:08d}-abcdefghijklmnopqrstuvwxyz0123456789')"
+
+BINLOG_POSITION = '''
+--
+-- Position to start replication or point-in-time recovery from
+--
+
+-- CHANGE MASTER TO MASTER_LOG_FILE='{}', MASTER_LOG_POS={};
+'''
+
+STATEMENT = re.compile(r'^(?:DROP|CREATE|INSERT|LOCK|UNLOCK|USE|SET|/\*!)', re.IGNORECASE)
+
+PURGE = re.compile(r"^PURGE (?:BINARY|MASTER) LOGS TO '([^']+)'$", re.IGNORECASE)
+
+NEW_BINLOG_POSITION = 154
+"""The position after the format description event that starts a binary log (5.7)."""
+
+BLOCK_SIZE = 64 * 1024
+
+
+def load():
+    with open(os.environ['FAKE_MYSQL_DB'], 'r') as f:
+        return json.load(f)
+
+
+def save(database):
+    with open(os.environ['FAKE_MYSQL_DB'], 'w') as f:
+        json.dump(database, f)
+
+
+def flush_binary_logs(database):
+    """Close the current binary log and open the next one, like ``FLUSH BINARY LOGS``"""
+    prefix, number = database['binary_logs'][-1].rsplit('.', 1)
+    database['binary_logs'].append('{}.{:0{}d}'.format(prefix, int(number) + 1, len(number)))
+    database['position'] = NEW_BINLOG_POSITION
+    save(database)
+
+
+def install(directory, database):
+    """Write the ``mysql``, ``mysqldump`` and ``mysqlbinlog`` executables to ``directory``
+
+    :param directory: an existing directory
+    :param database: :class:`dict` describing the database: ``database`` (its name), ``tables`` (name to size in
+                     bytes), ``views`` (names), ``rate`` (bytes per second of a connection), ``binary_logs`` and
+                     ``position`` (the current binary log coordinates)
+    :return: :class:`dict` with the client names as keys and their paths as values
+    """
+    description = os.path.join(directory, 'database.json')
+    with open(description, 'w') as f:
+        json.dump(database, f)
+    clients = {}
+    for client in ('mysql', 'mysqldump', 'mysqlbinlog'):
+        path = clients[client] = os.path.join(directory, client)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nFAKE_MYSQL_DB={} exec {} {} {} "$@"\n'.format(
+                description, sys.executable, os.path.abspath(__file__), client))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return clients
+
+
+def table_data(name, size):
+    """Generate the rows of a table, ``size`` bytes of ``INSERT`` statements"""
+    written, row = 0, 0
+    while written < size:
+        rows = []
+        line_size = 0
+        while line_size < BLOCK_SIZE and written + line_size < size:
+            value = ROW.format(row, name, row)
+            rows.append(value)
+            line_size += len(value) + 1
+            row += 1
+        line = 'INSERT INTO `{}` VALUES {};\n'.format(name, ','.join(rows))
+        written += len(line)
+        yield line
+
+
+def mysqldump(database, args):
+    positional = [arg for arg in args if not arg.startswith('--')]
+    tables = positional[1:] if '--databases' not in args else []
+    names = tables or sorted(database['tables'])
+    out = sys.stdout
+    rate = database.get('rate') or 0
+    started = time.time()
+    sent = 0
+
+    if '--flush-logs' in args:
+        flush_binary_logs(database)
+    out.write(HEADER.format(**database))
+    if '--master-data=2' in args or '--source-data=2' in args:
+        out.write(BINLOG_POSITION.format(database['binary_logs'][-1], database.get('position', 4)))
+    if '--databases' in args:
+        out.write('\nCREATE DATABASE /*!32312 IF NOT EXISTS*/ `{0}`;\n\nUSE `{0}`;\n'.format(database['database']))
+    for name in names:
+        if name in database.get('views', []):
+            out.write('\n--\n-- Temporary view structure for view `{}`\n--\n'.format(name))
+            out.write('\nCREATE VIEW `{0}` AS SELECT 1 AS `id`;\n'.format(name))
+            continue
+        if '--no-create-info' in args:
+            continue
+        out.write(TABLE.format(name=name))
+        if '--no-data' in args:
+            continue
+        for line in table_data(name, database['tables'][name]):
+            out.write(line)
+            sent += len(line)
+            if rate:
+                delay = started + sent / rate - time.time()
+                if delay > 0:
+                    out.flush()
+                    time.sleep(delay)
+        out.write('UNLOCK TABLES;\n')
+    if '--routines' in args:
+        out.write('\n--\n-- Dumping routines for database \'{}\'\n--\n'.format(database['database']))
+    out.write(FOOTER)
+
+
+def mysql(database, args):
+    execute = args[args.index('--execute') + 1] if '--execute' in args else None
+    statements = [execute] if execute else (line.strip() for line in sys.stdin)
+    counts = {}
+    for statement in statements:
+        if not statement:
+            continue
+        upper = statement.upper().rstrip(';')
+        if upper.startswith('SELECT TABLE_NAME'):
+            for name, size in sorted(database['tables'].items()):
+                print('{}\tBASE TABLE\t{}'.format(name, size))
+            for name in database.get('views', []):
+                print('{}\tVIEW\t0'.format(name))
+        elif upper in ('SHOW MASTER STATUS', 'SHOW BINARY LOG STATUS'):
+            print('{}\t{}'.format(database['binary_logs'][-1], database.get('position', 4)))
+        elif upper == 'SHOW BINARY LOGS':
+            for name in database['binary_logs']:
+                print('{}\t1024'.format(name))
+        elif upper in ('FLUSH BINARY LOGS', 'FLUSH LOGS'):
+            flush_binary_logs(database)
+        elif PURGE.match(statement.rstrip(';')):
+            name = PURGE.match(statement.rstrip(';')).group(1)
+            if name in database['binary_logs']:
+                database['binary_logs'] = database['binary_logs'][database['binary_logs'].index(name):]
+                save(database)
+        elif upper.startswith("SELECT '"):
+            print(statement.split("'")[1])
+        else:
+            match = STATEMENT.match(statement)
+            kind = match.group(0).upper() if match else 'OTHER'
+            counts[kind] = counts.get(kind, 0) + 1
+        sys.stdout.flush()
+    if os.environ.get('FAKE_MYSQL_COUNTS'):
+        with open(os.environ['FAKE_MYSQL_COUNTS'], 'a') as f:
+            f.write(json.dumps(counts) + '\n')
+
+
+def mysqlbinlog(database, args):
+    positional = [arg for arg in args if not arg.startswith('--')]
+    start = [int(arg.split('=', 1)[1]) for arg in args if arg.startswith('--start-position=')]
+    for index, name in enumerate(positional):
+        if name not in database['binary_logs']:
+            sys.stderr.write("ERROR: Could not find first log file name in binary log index file: {}\n".format(name))
+            sys.exit(1)
+        # the start position applies to the first file only
+        position = start[0] if start and index == 0 else 4
+        sys.stdout.write('# at {}\n#{} fake binary log {}\nBEGIN;\nCOMMIT;\n'.format(position, time.strftime('%y%m%d'),
+                                                                                      name))
+
+
+if __name__ == '__main__':
+    {'mysql': mysql, 'mysqldump': mysqldump, 'mysqlbinlog': mysqlbinlog}[sys.argv[1]](load(), sys.argv[2:])
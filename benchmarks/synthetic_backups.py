@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# autobackup-dcm: synthetic backup folders for the benchmarks, from a thousand to a million entries.
+# a folder holds the hourly backups of an app named like the scripts name them (the first backup of a day is its
+# daily one) plus the files rotation must skip: the checksum sidecars of some backups and unrelated files without
+# a timestamp. The same arguments always give the same names, so the results of two commits can be compared.
+#
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import datetime
+import itertools
+import os
+
+# Modules included in our package.
+from core.rotate_dcm import Backup
+
+START = datetime.datetime(2000, 1, 1)
+"""Timestamp of the first backup of a synthetic folder."""
+
+EXTRA_EVERY = 10
+"""One entry in this many is not a backup (a checksum sidecar or an unrelated file), 0 for none."""
+
+
+def backup_name(app, timestamp, extension='gz'):
+    backup_type = 'daily' if timestamp.hour == 0 else 'hourly'
+    return '{}_{:%Y-%m-%d_%H-%M}_{}.{}'.format(app, timestamp, backup_type, extension)
+
+
+def folder_entries(count, app='jom', start=START, step=datetime.timedelta(hours=1), extra_every=EXTRA_EVERY):
+    """Generate the names of a synthetic backup folder
+
+    :param count: the number of entries of the folder
+    :param app: the app name of the backups
+    :param start: the timestamp of the first backup, the next ones are ``step`` later each
+    :param extra_every: one entry in this many is not a backup, 0 for a folder with backups only
+    :returns: a generator of tuples ``(name, timestamp)``, the timestamp is ``None`` for the entries that are not
+              backups
+    """
+    timestamp = start
+    previous = None
+    for index in range(count):
+        if extra_every and index % extra_every == extra_every - 1:
+            extra = index // extra_every
+            if extra % 2 and previous:
+                yield previous + '.md5', None
+            else:
+                yield 'notes-{}.txt'.format(extra), None
+            continue
+        previous = backup_name(app, timestamp)
+        yield previous, timestamp
+        timestamp += step
+
+
+def backup_count(count, extra_every=EXTRA_EVERY):
+    """Get the number of backups among the ``count`` entries of :func:`folder_entries()`"""
+    return count - count // extra_every if extra_every else count
+
+
+def backups(count, **kwargs):
+    """Get the :class:`~core.rotate_dcm.Backup` objects of a synthetic folder, like ``collect_backups()`` does"""
+    return [Backup('/backups/' + name, timestamp, file_type='file')
+            for name, timestamp in folder_entries(count, **kwargs) if timestamp is not None]
+
+
+def local_folder(directory, count, **kwargs):
+    """Create the entries of a synthetic folder as empty files in ``directory``
+
+    :returns: the number of backups created
+    """
+    created = 0
+    for name, timestamp in folder_entries(count, **kwargs):
+        open(os.path.join(directory, name), 'wb').close()
+        created += timestamp is not None
+    return created
+
+
+def drive_folder(drive, folder, count, batch=10000, **kwargs):
+    """Add the entries of a synthetic folder to the folder ``folder`` of a :class:`~fake_drive.FakeDrive`
+
+    :returns: the ids of the files added
+    """
+    ids = []
+    entries = (name for name, timestamp in folder_entries(count, **kwargs))
+    while True:
+        names = list(itertools.islice(entries, batch))
+        if not names:
+            return ids
+        ids.extend(drive.add_files(names, folder))
@@ -9,9 +9,27 @@
 
 # Standard library modules.
 import json
-import logging.config
 
-# Initialize a logger for this module.
-with open('../config/logging.json', 'rt') as f:
-    config = json.load(f)
+LOGGING_FILE = '../config/logging.json'
+"""The :func:`logging.config.dictConfig()` configuration of the scripts."""
+
+
+def setup_logging(path=LOGGING_FILE):
+    """Configure the loggers of the program, the scripts call it first thing in their ``main``. Importing the
+    package has no side effects, a program that only imports it keeps its own logging configuration
+
+    With ``"queue": true`` in the configuration the handlers run on a listener thread, see
+    :func:`core.logging_dcm.start_queue_logging()`
+
+    :param path: the json file with the logging configuration
+    """
+    # logging.config pulls in socketserver and more, only the programs that configure logging pay for it
+    import logging.config
+
+    with open(path, 'rt') as f:
+        config = json.load(f)
+    use_queue = config.pop('queue', False)
     logging.config.dictConfig(config)
+    if use_queue:
+        from core.logging_dcm import start_queue_logging
+        start_queue_logging()
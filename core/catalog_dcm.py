@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# autobackup-dcm: local catalog (SQLite) of the backups created, on disk and on Google Drive.
+# rotation reads the backups of a directory with one indexed query instead of listing the local directory
+# or paging through the Google Drive folder on every run; a full listing is only needed to reconcile
+# changes made out of band (a changed local directory, or a periodic audit of the remote folder)
+# it also records the chunks of deduplicated backups uploaded to Google Drive and which backups use them, the
+# manifests of the remote backups are not read again to collect the unused chunks
+#
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import collections
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# Semi-standard module versioning.
+__version__ = '1.0'
+
+# Initialize a logger for this module.
+log = logging.getLogger('dacopancm.' + __name__)
+
+CATALOG_FILE = '../data/catalog.sqlite'
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS backups (
+    location TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    name TEXT NOT NULL,
+    app TEXT,
+    file_id TEXT,
+    timestamp TEXT NOT NULL,
+    size INTEGER,
+    md5 TEXT,
+    sha256 TEXT,
+    frequency TEXT,
+    base TEXT,
+    binlog_file TEXT,
+    binlog_position INTEGER
+);
+CREATE INDEX IF NOT EXISTS backups_by_time ON backups (location, directory, timestamp);
+CREATE INDEX IF NOT EXISTS backups_by_name ON backups (location, directory, name);
+CREATE INDEX IF NOT EXISTS backups_by_file_id ON backups (location, directory, file_id);
+CREATE TABLE IF NOT EXISTS directories (
+    location TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    mtime REAL,
+    audited_at REAL,
+    page_token TEXT,
+    PRIMARY KEY (location, directory)
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    location TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    file_id TEXT,
+    size INTEGER,
+    PRIMARY KEY (location, directory, digest)
+);
+CREATE TABLE IF NOT EXISTS chunk_refs (
+    location TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    name TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (location, directory, name, digest)
+);
+'''
+
+MIGRATIONS = (
+    ('directories', 'page_token', 'TEXT'),
+    ('backups', 'base', 'TEXT'),
+    ('backups', 'binlog_file', 'TEXT'),
+    ('backups', 'binlog_position', 'INTEGER'),
+)
+"""Columns added after the first version of the catalog: ``(table, column, type)``."""
+
+BACKUPS_COLUMNS = ('location, directory, name, app, file_id, timestamp, size, md5, sha256, frequency, base, '
+                   'binlog_file, binlog_position')
+
+
+class CatalogEntry(object):
+    """One backup of the catalog, the columns of the ``backups`` table are its attributes.
+
+    ``base`` is the name of the full backup an incremental backup depends on, ``binlog_file`` and
+    ``binlog_position`` the binary log coordinates where the backup ends (an incremental backup of the
+    same chain starts there).
+    """
+
+    __slots__ = ('location', 'directory', 'name', 'app', 'file_id', 'timestamp', 'size', 'md5', 'sha256',
+                 'frequency', 'base', 'binlog_file', 'binlog_position')
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @property
+    def datetime(self):
+        return datetime.datetime.strptime(self.timestamp, TIMESTAMP_FORMAT)
+
+
+class BackupCatalogCM(object):
+    """Python API of the backup catalog, safe to share between threads."""
+
+    def __init__(self, path=CATALOG_FILE):
+        """
+        Construct a :class:`BackupCatalogCM` object, the database is created if it does not exist.
+
+        :param path: the SQLite file of the catalog, ``':memory:'`` for a temporary catalog.
+        """
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+            for table, column, kind in MIGRATIONS:
+                columns = [row[1] for row in self.connection.execute('PRAGMA table_info({})'.format(table))]
+                if column not in columns:  # catalogs created by an older version
+                    self.connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, kind))
+            if any(row[5] for row in self.connection.execute('PRAGMA table_info(backups)')):
+                self.drop_name_key()
+
+    def drop_name_key(self):
+        """Move the backups of a catalog created by an older version to a table without the primary key on the
+        name, two Google Drive files of a folder can have the same name. Called with :attr:`lock` held."""
+        for index in ('time', 'name', 'file_id'):
+            self.connection.execute('DROP INDEX IF EXISTS backups_by_' + index)
+        self.connection.execute('ALTER TABLE backups RENAME TO backups_by_name_key')
+        self.connection.executescript(SCHEMA)
+        self.connection.execute('INSERT INTO backups ({0}) SELECT {0} FROM backups_by_name_key'.format(
+            BACKUPS_COLUMNS))
+        self.connection.execute('DROP TABLE backups_by_name_key')
+
+    def add(self, location, directory, name, timestamp, app=None, file_id=None, size=None, md5=None, sha256=None,
+            frequency=None, base=None, binlog_file=None, binlog_position=None):
+        """Record a new backup (or replace the record of the same file: the same name and Google Drive file id).
+
+        :param location: ``'local'`` or ``'remote'``.
+        :param directory: the local directory or the Google Drive folder id of the backup.
+        :param name: the file name of the backup.
+        :param timestamp: the :class:`~datetime.datetime` encoded in the name.
+        """
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM backups WHERE location = ? AND directory = ? AND name = ? AND '
+                                    'file_id IS ?', (location, directory, name, file_id))
+            self.connection.execute('INSERT INTO backups ({}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(
+                BACKUPS_COLUMNS), (location, directory, name, app, file_id, timestamp.strftime(TIMESTAMP_FORMAT),
+                                   size, md5, sha256, frequency, base, binlog_file, binlog_position))
+
+    def remove(self, location, directory, names):
+        """Forget the backups ``names`` of a directory (they were deleted)."""
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM backups WHERE location = ? AND directory = ? AND name = ?',
+                                        ((location, directory, name) for name in names))
+
+    def remove_files(self, location, directory, file_ids):
+        """Forget the backups of a remote folder by their Google Drive file ids (they were deleted)."""
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM backups WHERE location = ? AND directory = ? AND file_id = ?',
+                                        ((location, directory, file_id) for file_id in file_ids))
+
+    def backups(self, location, directory):
+        """Get the backups of a directory sorted by timestamp.
+
+        :returns: :class:`list` of :class:`CatalogEntry`.
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT * FROM backups WHERE location = ? AND directory = ? '
+                                           'ORDER BY timestamp, name, file_id', (location, directory)).fetchall()
+        return [CatalogEntry(*row) for row in rows]
+
+    def get(self, location, directory, name):
+        with self.lock:
+            row = self.connection.execute('SELECT * FROM backups WHERE location = ? AND directory = ? AND name = ?',
+                                          (location, directory, name)).fetchone()
+        return CatalogEntry(*row) if row else None
+
+    def chain_head(self, location, directory):
+        """Get the most recent backup of a directory when an incremental backup can continue from it.
+
+        :returns: a :class:`CatalogEntry` or ``None`` if the most recent backup has no binary log coordinates
+                  (or there is no backup).
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT * FROM backups WHERE location = ? AND directory = ? '
+                                          'ORDER BY timestamp DESC, name DESC LIMIT 1',
+                                          (location, directory)).fetchone()
+        entry = CatalogEntry(*row) if row else None
+        return entry if entry is not None and entry.binlog_file else None
+
+    def chunks(self, location, directory):
+        """Get the chunks of deduplicated backups stored in a directory.
+
+        :returns: :class:`dict` with the digests of the chunks as keys and their file ids as values.
+        """
+        with self.lock:
+            return dict(self.connection.execute('SELECT digest, file_id FROM chunks WHERE location = ? AND '
+                                                'directory = ?', (location, directory)))
+
+    def add_chunks(self, location, directory, chunks):
+        """Record chunks stored in a directory.
+
+        :param chunks: iterable of tuples ``(digest, file_id, size)``.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?)',
+                                        ((location, directory, digest, file_id, size)
+                                         for digest, file_id, size in chunks))
+
+    def remove_chunks(self, location, directory, digests):
+        """Forget chunks of a directory (they were deleted)."""
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM chunks WHERE location = ? AND directory = ? AND digest = ?',
+                                        ((location, directory, digest) for digest in digests))
+
+    def add_chunk_refs(self, location, directory, name, digests):
+        """Record the chunks the deduplicated backup ``name`` of a directory is made of."""
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO chunk_refs VALUES (?, ?, ?, ?)',
+                                        ((location, directory, name, digest) for digest in set(digests)))
+
+    def unreferenced_chunks(self, location, directory, extension):
+        """Get the chunks of a directory no backup of the directory is made of.
+
+        The references of the backups that were forgotten are dropped first.
+
+        :param extension: the extension of the deduplicated backups, the chunks are only known to be unreferenced
+                          if every such backup of the directory has its references recorded.
+        :returns: :class:`dict` with the digests as keys and the file ids as values, ``None`` when a deduplicated
+                  backup has no references recorded.
+        """
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM chunk_refs WHERE location = ? AND directory = ? AND name NOT IN '
+                                    '(SELECT name FROM backups WHERE location = ? AND directory = ?)',
+                                    (location, directory, location, directory))
+            unknown = self.connection.execute(
+                'SELECT COUNT(*) FROM backups b WHERE location = ? AND directory = ? AND name LIKE ? AND NOT EXISTS '
+                '(SELECT 1 FROM chunk_refs r WHERE r.location = b.location AND r.directory = b.directory AND '
+                'r.name = b.name)', (location, directory, '%.' + extension)).fetchone()[0]
+            if unknown:
+                return None
+            return dict(self.connection.execute(
+                'SELECT digest, file_id FROM chunks c WHERE location = ? AND directory = ? AND NOT EXISTS '
+                '(SELECT 1 FROM chunk_refs r WHERE r.location = c.location AND r.directory = c.directory AND '
+                'r.digest = c.digest)', (location, directory)))
+
+    def sync(self, location, directory, entries, mtime=None, page_token=None):
+        """Make the catalog of a directory match a full listing of it.
+
+        The backups of a remote folder are its Google Drive files: a file uploaded again with the name of a
+        cataloged backup gets the record of that backup (with its new file id), a renamed file gets its new name and
+        timestamp and two files with the same name are two backups. Backups missing from the listing are forgotten
+        and new ones are added, the recorded details (size, checksums, ...) of the backups that are still there are
+        kept.
+
+        :param entries: iterable of tuples ``(name, file_id, timestamp)`` with all the backups of the directory.
+        :param mtime: the modification time of a local directory when it was listed.
+        :param page_token: the Google Drive changes feed token taken before a remote folder was listed.
+        :returns: a tuple with the number of backups added and removed.
+        """
+        new = collections.OrderedDict(((name, file_id), timestamp) for name, file_id, timestamp in entries)
+        with self.lock, self.connection:
+            known = {}
+            for rowid, name, file_id in self.connection.execute(
+                    'SELECT rowid, name, file_id FROM backups WHERE location = ? AND directory = ?',
+                    (location, directory)):
+                if new.pop((name, file_id), None) is None:
+                    known[(name, file_id)] = rowid
+            # what is left of both sides changed: files uploaded again, renamed, added or deleted
+            stale_names = collections.defaultdict(list)
+            stale_ids = {}
+            for (name, file_id), rowid in known.items():
+                stale_names[name].append(rowid)
+                if file_id is not None:
+                    stale_ids[file_id] = rowid
+            updated = set()
+            added = 0
+            for (name, file_id), timestamp in new.items():
+                rowid = stale_ids.get(file_id) if file_id is not None else None
+                if rowid is None or rowid in updated:
+                    rowid = next((rowid for rowid in stale_names[name] if rowid not in updated), None)
+                if rowid is None:
+                    self.connection.execute('INSERT INTO backups (location, directory, name, file_id, timestamp) '
+                                            'VALUES (?, ?, ?, ?, ?)', (location, directory, name, file_id,
+                                                                       timestamp.strftime(TIMESTAMP_FORMAT)))
+                    added += 1
+                else:
+                    self.connection.execute('UPDATE backups SET name = ?, file_id = ?, timestamp = ? WHERE rowid = ?',
+                                            (name, file_id, timestamp.strftime(TIMESTAMP_FORMAT), rowid))
+                    updated.add(rowid)
+            removed = [(rowid,) for rowid in known.values() if rowid not in updated]
+            self.connection.executemany('DELETE FROM backups WHERE rowid = ?', removed)
+            self.connection.execute('INSERT OR REPLACE INTO directories (location, directory, mtime, audited_at, '
+                                    'page_token) VALUES (?, ?, ?, ?, ?)',
+                                    (location, directory, mtime, time.time(), page_token))
+        if added or removed or updated:
+            log.info("catalog of %s %s reconciled: %i backups added, %i updated, %i removed", location, directory,
+                     added, len(updated), len(removed))
+        return added, len(removed)
+
+    def apply_changes(self, location, directory, upserts, removed_ids, page_token):
+        """Apply to the catalog of a remote folder the changes reported by the Google Drive changes feed.
+
+        :param upserts: iterable of tuples ``(name, file_id, timestamp)`` of backups created or renamed in the folder.
+        :param removed_ids: the file ids deleted, trashed or moved out of the folder.
+        :param page_token: the token to read the next changes from.
+        :returns: a tuple with the number of backups added and removed.
+        """
+        added = removed = 0
+        with self.lock, self.connection:
+            for file_id in removed_ids:
+                removed += self.connection.execute(
+                    'DELETE FROM backups WHERE location = ? AND directory = ? AND file_id = ?',
+                    (location, directory, file_id)).rowcount
+            for name, file_id, timestamp in upserts:
+                row = self.connection.execute(
+                    'SELECT name FROM backups WHERE location = ? AND directory = ? AND file_id = ?',
+                    (location, directory, file_id)).fetchone()
+                if row is not None and row[0] == name:
+                    continue  # already known (for example uploaded by us), keep its details
+                if row is not None:
+                    # renamed, the details of the file are kept
+                    self.connection.execute('UPDATE backups SET name = ?, timestamp = ? WHERE location = ? AND '
+                                            'directory = ? AND file_id = ?',
+                                            (name, timestamp.strftime(TIMESTAMP_FORMAT), location, directory, file_id))
+                    continue
+                self.connection.execute('INSERT INTO backups (location, directory, name, file_id, timestamp) '
+                                        'VALUES (?, ?, ?, ?, ?)',
+                                        (location, directory, name, file_id, timestamp.strftime(TIMESTAMP_FORMAT)))
+                added += 1
+            self.connection.execute('UPDATE directories SET page_token = ? WHERE location = ? AND directory = ?',
+                                    (page_token, location, directory))
+        if added or removed:
+            log.info("catalog of %s %s updated from the changes feed: %i backups added, %i removed", location,
+                     directory, added, removed)
+        return added, removed
+
+    def page_token(self, location, directory):
+        """Get the changes feed token saved for a remote folder, ``None`` if it must be listed completely."""
+        with self.lock:
+            row = self.connection.execute('SELECT page_token FROM directories WHERE location = ? AND directory = ?',
+                                          (location, directory)).fetchone()
+        return row[0] if row else None
+
+    def directory_changed(self, location, directory, mtime):
+        """Check if a local directory changed since it was last synced (its mtime is different)."""
+        with self.lock:
+            row = self.connection.execute('SELECT mtime FROM directories WHERE location = ? AND directory = ?',
+                                          (location, directory)).fetchone()
+        return row is None or row[0] != mtime
+
+    def audit_due(self, location, directory, interval):
+        """Check if a directory was never synced or its last full listing is older than ``interval`` seconds."""
+        with self.lock:
+            row = self.connection.execute('SELECT audited_at FROM directories WHERE location = ? AND directory = ?',
+                                          (location, directory)).fetchone()
+        return row is None or row[0] is None or time.time() - row[0] >= interval
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# autobackup-dcm: long-running scheduler that replaces the cron invoked one-shot runs.
+# the daemon reads the config, the catalog and the Google credentials once, then runs the backups of every app
+# from its timetable ("schedule" in the app config) on worker threads that live as long as the daemon, so the
+# Drive connections of the threads stay open between runs. Every run of an app writes its own metrics report, like a
+# cron invocation did. A Unix socket answers ``status`` and ``trigger`` commands (see :func:`send_command()`), one JSON
+# object per line.
+#
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import collections
+import datetime
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Modules included in our package.
+from core.metrics_dcm import app_scope, start_run
+from core.ratelimit_dcm import request_stats
+
+# Semi-standard module versioning.
+__version__ = '1.0'
+
+# Initialize a logger for this module.
+log = logging.getLogger('dacopancm.' + __name__)
+
+DAEMON_SOCKET = '../data/autobackup.sock'
+"""Path of the Unix socket of the control interface."""
+
+DEFAULT_SCHEDULE = {'time': '03:00', 'hourly': False}
+"""Timetable of the apps without a ``schedule`` in their config."""
+
+MAX_SLEEP = 60
+"""Seconds the scheduler sleeps at most before it looks at the clock again (it may be changed meanwhile)."""
+
+BACKUP_TYPES = ('hourly', 'daily', 'weekly', 'monthly', 'yearly')
+
+
+class Timetable(object):
+    """When the backups of an app run: every day at ``time``, or every hour at its minute when ``hourly``."""
+
+    def __init__(self, schedule=None):
+        """
+        :param schedule: :class:`dict` with ``time`` (``'HH:MM'``) and ``hourly`` (``True`` to run every hour,
+                         the first run of a day is its daily backup), :data:`DEFAULT_SCHEDULE` by default
+        """
+        schedule = dict(DEFAULT_SCHEDULE, **(schedule or {}))
+        self.hourly = bool(schedule['hourly'])
+        hour, minute = schedule['time'].split(':')
+        self.hour = int(hour)
+        self.minute = int(minute)
+        if not (0 <= self.hour < 24 and 0 <= self.minute < 60):
+            raise ValueError("invalid schedule time {!r}".format(schedule['time']))
+
+    def next_run(self, after):
+        """Get the first run of this timetable later than the :class:`~datetime.datetime` ``after``"""
+        if self.hourly:
+            candidate = after.replace(minute=self.minute, second=0, microsecond=0)
+            step = datetime.timedelta(hours=1)
+        else:
+            candidate = after.replace(hour=self.hour, minute=self.minute, second=0, microsecond=0)
+            step = datetime.timedelta(days=1)
+        while candidate <= after:
+            candidate += step
+        return candidate
+
+    def describe(self):
+        if self.hourly:
+            return 'hourly at :{:02d}'.format(self.minute)
+        return 'daily at {:02d}:{:02d}'.format(self.hour, self.minute)
+
+
+class ScheduledApp(object):
+    """The timetable and the state of the runs of one app."""
+
+    def __init__(self, app):
+        self.app = app
+        self.name = app['cfg']['app_name']
+        self.timetable = Timetable(app.get('schedule'))
+        self.next_run = datetime.datetime.now()  # what is due since the last run is done when the daemon starts
+        self.forced = []
+        self.running = False
+        self.runs = 0
+        self.last_start = None
+        self.last_seconds = None
+        self.last_result = None
+
+    def status(self):
+        return {'app': self.name, 'schedule': self.timetable.describe(), 'running': self.running,
+                'next_run': self.next_run.isoformat(), 'queued': list(self.forced), 'runs': self.runs,
+                'last_start': self.last_start.isoformat() if self.last_start else None,
+                'last_seconds': self.last_seconds, 'last_result': self.last_result}
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """Answer the commands of one client of the control socket, a JSON object per line each way."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                response = self.server.daemon.command(request.get('command'), **request.get('args', {}))
+            except Exception as ex:
+                response = {'ok': False, 'error': str(ex)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, daemon):
+        self.daemon = daemon
+        if os.path.exists(path):
+            os.remove(path)  # left by a daemon that did not stop cleanly
+        socketserver.UnixStreamServer.__init__(self, path, ControlHandler)
+        os.chmod(path, 0o600)
+
+
+class BackupDaemonCM(object):
+    """
+    Run the backups of the apps of a :class:`~core.generic_backup.GenericBackupCM` from their timetables until
+    it is stopped, the config is read once and kept in memory (the state of an app is saved after its backups).
+
+    A run of an app does what one cron invocation did: :func:`~core.generic_backup.GenericBackupCM.backup_app()`
+    creates the backup that is due, if any, and rotates. Up to ``apps`` of the scheduler limits run at the same
+    time, an app never runs twice at the same time.
+    """
+
+    def __init__(self, backup, socket_path=DAEMON_SOCKET):
+        """
+        :param backup: the :class:`~core.generic_backup.GenericBackupCM` that creates the backups
+        :param socket_path: path of the Unix socket of the control interface, ``None`` for no control interface
+        """
+        self.backup = backup
+        self.socket_path = socket_path
+        self.cfg = backup.read_config()
+        self.apps = [ScheduledApp(app) for app in self.cfg]
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, backup.limits.apps))
+        self.stopping = False
+        self.started = None
+        self.server = None
+        self.reports = collections.OrderedDict()
+        self.report_lock = threading.Lock()
+
+    def find(self, name):
+        for scheduled in self.apps:
+            if scheduled.name == name:
+                return scheduled
+        raise ValueError("unknown app '{}'".format(name))
+
+    def serve_forever(self):
+        """Run the scheduler in this thread until :func:`stop()` is called or SIGTERM/SIGINT is received"""
+        self.started = datetime.datetime.now()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: self.stop())
+        if self.socket_path:
+            self.server = ControlServer(self.socket_path, self)
+            threading.Thread(target=self.server.serve_forever, name='control', daemon=True).start()
+        log.info("daemon started with %i apps, control socket %s", len(self.apps), self.socket_path)
+        for scheduled in self.apps:
+            log.info("'%s' runs %s", scheduled.name, scheduled.timetable.describe())
+
+        try:
+            with self.condition:
+                while not self.stopping:
+                    now = datetime.datetime.now()
+                    for scheduled in self.apps:
+                        if not scheduled.running and (scheduled.forced or scheduled.next_run <= now):
+                            self.start(scheduled)
+                    timeout = MAX_SLEEP
+                    waiting = [s.next_run for s in self.apps if not s.running]
+                    if waiting:
+                        timeout = min(timeout, (min(waiting) - now).total_seconds())
+                    self.condition.wait(max(timeout, 0.1))
+                while any(scheduled.running for scheduled in self.apps):
+                    self.condition.wait()
+        finally:
+            if self.server:
+                self.server.shutdown()
+                self.server.server_close()
+                os.remove(self.socket_path)
+            self.executor.shutdown()
+            self.backup.limits.shutdown()
+            log.info("daemon stopped")
+
+    def stop(self):
+        """Stop scheduling, the running backups finish before :func:`serve_forever()` returns"""
+        # called from a signal handler too, it must not wait for the condition held by the scheduler loop
+        self.stopping = True
+        threading.Thread(target=self.notify).start()
+
+    def notify(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def start(self, scheduled):
+        """Submit the next run of an app to the worker threads, called with :attr:`condition` held"""
+        backup_type = scheduled.forced.pop(0) if scheduled.forced else None
+        scheduled.running = True
+        scheduled.last_start = datetime.datetime.now()
+        self.executor.submit(self.run, scheduled, backup_type)
+
+    def run(self, scheduled, backup_type=None):
+        start = time.time()
+        # every run has its own metrics and report, like a cron invocation
+        metrics = start_run()
+        try:
+            with app_scope(scheduled.name, metrics):
+                result = self.run_app(scheduled.app, backup_type)
+        except Exception:
+            log.exception("unexpected error running backups of '%s'", scheduled.name)
+            result = None
+        metrics.end_app(scheduled.name, result)
+        # the Drive counters are shared by the apps running at the same time
+        self.backup.log_drive_stats()
+        with self.report_lock:
+            # the textfile keeps the last run of every app
+            others = [report for name, report in self.reports.items() if name != scheduled.name]
+            report = self.backup.write_run_report(metrics, name=scheduled.name, others=others)
+            if report is not None:
+                self.reports[scheduled.name] = report
+        with self.condition:
+            scheduled.running = False
+            scheduled.runs += 1
+            scheduled.last_seconds = round(time.time() - start, 1)
+            scheduled.last_result = result
+            if backup_type is None:
+                scheduled.next_run = scheduled.timetable.next_run(datetime.datetime.now())
+            self.condition.notify_all()
+        log.info("'%s' finished in %.1f seconds, %s, next run at %s", scheduled.name, scheduled.last_seconds,
+                 'backup created' if result else 'no backup created', scheduled.next_run)
+
+    def run_app(self, app, backup_type=None):
+        """Create the backup of ``app`` that is due now, or a backup of ``backup_type`` when it is given
+
+        :return: True if a backup was created
+        """
+        if backup_type is None:
+            return self.backup.backup_app(app, datetime.datetime.now())
+        created = self.backup.do_backup(app, backup_type)
+        if created:
+            self.backup.rotate_backups(app)
+            self.backup.save_state(app)
+        return created
+
+    def command(self, name, **args):
+        """Run a command of the control interface
+
+        :param name: ``status`` or ``trigger`` (arguments ``app``, and ``type`` to force a backup of that type
+                     instead of the one that is due, a daily backup is forced when none is due)
+        :return: :class:`dict` with the answer, ``ok`` is False when the command failed, the answer to a
+                 ``trigger`` has the ``type`` of the backup queued (the result of the run is logged and given by
+                 ``last_result`` in the ``status``)
+        """
+        if name == 'status':
+            with self.condition:
+                return {'ok': True, 'pid': os.getpid(), 'started': self.started.isoformat(),
+                        'apps': [scheduled.status() for scheduled in self.apps], 'drive_requests': request_stats()}
+        if name == 'trigger':
+            backup_type = args.get('type')
+            if backup_type is not None and backup_type not in BACKUP_TYPES:
+                raise ValueError("unknown backup type '{}'".format(backup_type))
+            with self.condition:
+                scheduled = self.find(args['app'])
+                due = self.backup.due_backup_type(scheduled.app, datetime.datetime.now())
+                if backup_type is None and due is None:
+                    # the backups are up to date, a trigger still creates one
+                    backup_type = 'daily'
+                # a run triggered while the app is running starts when it ends, None runs the backup that is due
+                if backup_type not in scheduled.forced:
+                    scheduled.forced.append(backup_type)
+                self.condition.notify_all()
+                log.info("%s backup of '%s' triggered from the control socket", backup_type or due, scheduled.name)
+                return {'ok': True, 'app': scheduled.name, 'queued': True, 'type': backup_type or due,
+                        'running': scheduled.running}
+        raise ValueError("unknown command '{}'".format(name))
+
+
+def send_command(command, socket_path=DAEMON_SOCKET, timeout=10, **args):
+    """Send a command to a running daemon through its control socket
+
+    :param command: the command, see :func:`BackupDaemonCM.command()`
+    :param socket_path: path of the Unix socket of the daemon
+    :param timeout: seconds to wait for the answer
+    :return: :class:`dict` with the answer of the daemon
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socket_path)
+        client.sendall(json.dumps({'command': command, 'args': args}).encode('utf-8') + b'\n')
+        with client.makefile('rb') as f:
+            return json.loads(f.readline().decode('utf-8'))
+    finally:
+        client.close()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# autobackup-dcm: deduplicated storage of backups in content-defined chunks.
+# consecutive dumps of a database share most of their bytes, so instead of a new ``.gz`` every run the dump is
+# cut in chunks at boundaries chosen by its content (the end of a line or of a row whose last bytes hash to a
+# given value), and every chunk is stored once, compressed, under its sha256. A backup is then a small manifest
+# ``app_DATE_HOUR_TYPE.chunks.json`` with the list of its chunks; only the chunks no other backup has are written
+# and uploaded, and the chunks no manifest references any more are garbage collected after rotation.
+# The chunks are gzip members: concatenated in the order of the manifest they are the ``.gz`` of the dump.
+#
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import collections
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Modules included in our package.
+from core.stream_dcm import DEFAULT_COMPRESS_LEVEL, compress_member
+
+# Semi-standard module versioning.
+__version__ = '1.0'
+
+# Initialize a logger for this module.
+log = logging.getLogger('dacopancm.' + __name__)
+
+CHUNKS_EXTENSION = 'chunks.json'
+"""Extension of the manifest of a deduplicated backup, it is the backup file rotation sees."""
+
+CHUNK_DIR = 'chunks'
+"""Directory of the chunk store, inside the local backup directory (a folder of the remote one on Google Drive)."""
+
+DEFAULT_AVERAGE_CHUNK = 256 * 1024
+"""Average size in bytes of a chunk, chunks are between a quarter and four times this size."""
+
+SEPARATORS = re.compile(br'\n|\),\(')
+"""Where a chunk may end: after a line or after a row of an extended ``INSERT``."""
+
+SEPARATOR_SPACING = 128
+"""Expected bytes between two separators in a dump, to turn the average chunk size into a cut probability."""
+
+WINDOW = 48
+"""Bytes before a separator whose hash decides if the chunk ends there."""
+
+GC_GRACE = 24 * 60 * 60
+"""Seconds a chunk written or reused is kept even if no manifest references it (a backup may be running)."""
+
+MANIFEST_VERSION = 1
+
+
+def is_dedup_backup(path):
+    return path.endswith('.' + CHUNKS_EXTENSION)
+
+
+def read_chunk_manifest(path):
+    """Read the manifest of a deduplicated backup
+
+    :param path: the ``.chunks.json`` file
+    :return: :class:`dict` with the ``chunks`` of the backup as a list of ``[digest, size]``
+    """
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+class ContentChunker(object):
+    """
+    Cut the data written to it in content-defined chunks handed to ``emit`` in order.
+
+    A chunk ends after a separator (:data:`SEPARATORS`) when the crc32 of the :data:`WINDOW` bytes before it has
+    its low bits clear, so an insertion in the data only changes the chunks around it, the following boundaries
+    are found again at the same content. The mask is stricter before the average size and looser after it to
+    keep the sizes near the average, and there is a hard minimum and maximum size.
+    """
+
+    def __init__(self, emit, average=DEFAULT_AVERAGE_CHUNK):
+        """
+        :param emit: function called with every chunk (:class:`bytes`)
+        :param average: the average chunk size in bytes
+        """
+        self.emit = emit
+        self.average = average
+        self.min_size = max(average // 4, WINDOW)
+        self.max_size = average * 4
+        bits = max(2, (average // SEPARATOR_SPACING).bit_length() - 1)
+        self.strict_mask = (1 << (bits + 2)) - 1
+        self.loose_mask = (1 << (bits - 2)) - 1
+        self.buffer = bytearray()
+        self.scanned = 0
+
+    def write(self, data):
+        self.buffer += data
+        self._cut()
+
+    def close(self):
+        self._cut()
+        if self.buffer:
+            self.emit(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def _cut(self):
+        buffer = self.buffer
+        start = 0
+        scan = self.scanned
+        while True:
+            limit = min(len(buffer), start + self.max_size)
+            cut = None
+            for match in SEPARATORS.finditer(buffer, max(scan, start + self.min_size), limit):
+                position = match.end()
+                mask = self.strict_mask if position - start < self.average else self.loose_mask
+                if not zlib.crc32(buffer[position - WINDOW:position]) & mask:
+                    cut = position
+                    break
+            if cut is None:
+                if limit - start < self.max_size:
+                    # a separator may continue in the next write, it is searched again from its start
+                    scan = max(start, limit - 2)
+                    break
+                cut = limit
+            self.emit(bytes(buffer[start:cut]))
+            start = scan = cut
+        del buffer[:start]
+        self.scanned = scan - start
+
+
+class ChunkStoreCM(object):
+    """A directory of compressed chunks named by the sha256 of their uncompressed data."""
+
+    def __init__(self, directory, compress_level=DEFAULT_COMPRESS_LEVEL):
+        """
+        :param directory: the directory of the store, created when the first chunk is written
+        :param compress_level: the gzip compression level of the chunks (1-9)
+        """
+        self.directory = directory
+        self.compress_level = compress_level
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def put(self, data):
+        """Store a chunk unless it is already there
+
+        :param data: the uncompressed chunk
+        :return: a tuple ``(digest, size, stored)``, ``stored`` is the compressed size written, 0 if the chunk was
+                 already in the store (it is touched so garbage collection keeps it while the backup runs)
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        try:
+            os.utime(path)
+            return digest, len(data), 0
+        except FileNotFoundError:
+            pass
+        compressed = compress_member(data, self.compress_level)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written under a temporary name, a chunk file is always complete
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + digest[:8])
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(compressed)
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+        return digest, len(data), len(compressed)
+
+    def read(self, digest):
+        """Get the uncompressed data of a chunk"""
+        with open(self.path(digest), 'rb') as f:
+            return zlib.decompress(f.read(), 31)
+
+    def digests(self):
+        """Get the digests of all the chunks of the store"""
+        if not os.path.isdir(self.directory):
+            return []
+        return [entry.name for prefix in os.scandir(self.directory) if prefix.is_dir()
+                for entry in os.scandir(prefix.path) if not entry.name.startswith('.')]
+
+    def size(self):
+        """Get the bytes used by the chunks of the store"""
+        return sum(os.path.getsize(self.path(digest)) for digest in self.digests())
+
+    def collect_garbage(self, referenced, grace=GC_GRACE, dry_run=False):
+        """Delete the chunks no manifest references
+
+        :param referenced: the :class:`set` of digests to keep
+        :param grace: seconds since their last use during which unreferenced chunks are kept
+        :param dry_run: ``True`` to only count the chunks that would be deleted
+        :return: a tuple with the number of chunks deleted and their compressed size
+        """
+        deleted = freed = 0
+        limit = time.time() - grace
+        for digest in self.digests():
+            if digest in referenced:
+                continue
+            path = self.path(digest)
+            stat = os.stat(path)
+            if stat.st_mtime > limit:
+                continue
+            if not dry_run:
+                os.remove(path)
+            deleted += 1
+            freed += stat.st_size
+        return deleted, freed
+
+    def restore(self, manifest, output):
+        """Write the uncompressed data of a backup to ``output``
+
+        :param manifest: the manifest returned by :func:`read_chunk_manifest()`
+        :param output: a binary file-like object
+        """
+        for digest, size in manifest['chunks']:
+            output.write(self.read(digest))
+
+
+def referenced_chunks(directory):
+    """Get the digests of the chunks referenced by the manifests of a local backup directory"""
+    referenced = set()
+    for entry in os.scandir(directory):
+        if entry.is_file() and is_dedup_backup(entry.name):
+            referenced.update(digest for digest, size in read_chunk_manifest(entry.path)['chunks'])
+    return referenced
+
+
+class DedupWriter(object):
+    """
+    Sink that cuts the data written to it in chunks (see :class:`ContentChunker`) and stores the new ones in a
+    :class:`ChunkStoreCM`, the chunks are hashed and compressed on a thread pool. :func:`manifest()` lists
+    the chunks of the data once the writer is closed.
+    """
+
+    def __init__(self, store, average=DEFAULT_AVERAGE_CHUNK, threads=1, executor=None):
+        """
+        :param store: the :class:`ChunkStoreCM` of the chunks
+        :param average: the average chunk size in bytes
+        :param threads: number of chunks stored at the same time
+        :param executor: an optional :class:`~concurrent.futures.Executor` shared with other writers
+        """
+        self.store = store
+        self.chunker = ContentChunker(self._submit, average)
+        self.max_pending = max(threads, 1) * 2
+        self.own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max(threads, 1))
+        self.pending = collections.deque()
+        self.chunks = []
+        self.new_chunks = []
+        self.size = 0
+        self.stored = 0
+
+    def write(self, data):
+        self.chunker.write(data)
+
+    def close(self):
+        self.chunker.close()
+        while self.pending:
+            self._store_next()
+        self._shutdown()
+
+    def manifest(self):
+        return {'version': MANIFEST_VERSION, 'size': self.size, 'chunks': self.chunks}
+
+    def _submit(self, chunk):
+        self.pending.append(self.executor.submit(self.store.put, chunk))
+        while len(self.pending) >= self.max_pending:
+            self._store_next()
+
+    def _store_next(self):
+        digest, size, stored = self.pending.popleft().result()
+        self.chunks.append([digest, size])
+        self.size += size
+        if stored:
+            self.new_chunks.append(digest)
+            self.stored += stored
+
+    def _shutdown(self):
+        if self.own_executor:
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for future in self.pending:
+                future.cancel()
+            self.pending.clear()
+            self._shutdown()
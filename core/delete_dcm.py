@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# autobackup-dcm: delete local backups in-process.
+# rotation used to fork ``rm -Rf`` (wrapped in ``ionice``) for every expired backup, which costs more than the
+# unlink itself when thousands of backups expire. Files are unlinked and directory trees removed here, on
+# worker threads whose I/O scheduling class is set once with the ``ioprio_set`` system call, so the threads of
+# the backups running in the same process keep their own priority.
+#
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import ctypes
+import errno
+import logging
+import os
+import platform
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Semi-standard module versioning.
+__version__ = '1.0'
+
+# Initialize a logger for this module.
+log = logging.getLogger('dacopancm.' + __name__)
+
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+"""The I/O scheduling classes accepted by ``ionice --class`` and their numbers in the kernel."""
+
+IOPRIO_SYSCALLS = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314, 'ppc64le': 273}
+"""Number of the ``ioprio_set`` system call on the architectures we know of."""
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_DEFAULT_LEVEL = 4
+
+
+def set_io_priority(io_scheduling_class):
+    """Set the I/O scheduling class of the calling thread, like ``ionice --class`` does for a command
+
+    :param io_scheduling_class: one of the strings 'idle', 'best-effort' or 'realtime'
+    :return: ``True`` if the class was set, ``False`` if it is not supported here (it is logged)
+    """
+    syscall_number = IOPRIO_SYSCALLS.get(platform.machine())
+    if io_scheduling_class not in IOPRIO_CLASSES or syscall_number is None:
+        log.warning("can't set I/O scheduling class %r on %s", io_scheduling_class, platform.machine())
+        return False
+    level = 0 if io_scheduling_class == 'idle' else IOPRIO_DEFAULT_LEVEL
+    value = (IOPRIO_CLASSES[io_scheduling_class] << IOPRIO_CLASS_SHIFT) | level
+    libc = ctypes.CDLL(None, use_errno=True)
+    # with who=0 the kernel changes the calling thread only, the other threads keep their class
+    if libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, 0, value) != 0:
+        error = ctypes.get_errno()
+        log.warning("can't set I/O scheduling class %r: %s", io_scheduling_class, os.strerror(error))
+        return False
+    return True
+
+
+def delete_path(pathname):
+    """Delete a file, a symbolic link or a directory tree, a path that does not exist is ignored (``rm -Rf``)
+
+    :param pathname: the path to delete
+    :raises: :exc:`OSError` if the path exists and can't be deleted
+    """
+    try:
+        os.unlink(pathname)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return
+        if e.errno not in (errno.EISDIR, errno.EPERM) or not os.path.isdir(pathname) or os.path.islink(pathname):
+            raise
+        shutil.rmtree(pathname)
+
+
+class LocalDeleterCM(object):
+    """Delete local backups (with their sidecar files) on a small pool of threads with a lowered I/O priority."""
+
+    def __init__(self, io_scheduling_class=None, threads=1):
+        """
+        :param io_scheduling_class: the I/O scheduling class of the deleting threads ('idle', 'best-effort' or
+                                    'realtime'), ``None`` to keep the default one
+        :param threads: number of paths deleted at the same time, more than one helps on network filesystems
+        """
+        self.io_scheduling_class = io_scheduling_class
+        self.threads = max(1, threads)
+        self.local = threading.local()
+
+    def delete(self, pathname, *sidecars):
+        """Delete a backup and its sidecar files from the calling thread, see :func:`delete_all()`"""
+        if self.io_scheduling_class and not getattr(self.local, 'io_priority_set', False):
+            set_io_priority(self.io_scheduling_class)
+            self.local.io_priority_set = True  # only once per thread, even if it failed
+        for path in (pathname,) + sidecars:
+            delete_path(path)
+
+    def delete_all(self, items):
+        """Delete many backups
+
+        :param items: iterable of tuples ``(pathname, sidecar, ...)``
+        :return: a list of tuples ``(item, error)`` in the order of ``items``, error is ``None`` when the
+                 backup was deleted or the :exc:`OSError` that stopped it
+        """
+
+        def run(item):
+            try:
+                self.delete(*item)
+                return item, None
+            except OSError as e:
+                return item, e
+
+        items = list(items)
+        if not items:
+            return []
+        # the deletions never run on the calling thread, so its I/O priority is left alone
+        with ThreadPoolExecutor(max_workers=min(self.threads, len(items))) as executor:
+            return list(executor.map(run, items))
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# autobackup-dcm: parallel ranged downloads from Google Drive.
+# the content of a Drive file (``alt=media``) is fetched with HTTP range requests sent on several connections at
+# the same time and written in order to a sink, so a restore can decompress and import a backup while the rest
+# of it is still downloading. A range that fails is downloaded again, the ranges already received are kept.
+#
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import collections
+import hashlib
+import http.client
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Modules included in our package.
+from core.metrics_dcm import bind
+from core.ratelimit_dcm import classify_error, classify_status, get_request_executor
+
+# Semi-standard module versioning.
+__version__ = '1.0'
+
+# Initialize a logger for this module.
+log = logging.getLogger('dacopancm.' + __name__)
+
+DOWNLOAD_URL = 'https://www.googleapis.com/drive/v3/files/{}?alt=media'
+
+DEFAULT_RANGE_SIZE = 8 * 1024 * 1024
+"""Bytes asked for in every range request."""
+
+DEFAULT_DOWNLOADS = 4
+"""Range requests of one file sent at the same time."""
+
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+class DownloadFailed(Exception):
+    """Raised by :class:`RangedDownloadCM` when Drive refuses a range, the retries are exhausted or the downloaded
+    file does not have the expected checksum."""
+
+    def __init__(self, message, status=None, content=None):
+        self.status = status
+        self.content = content
+        super().__init__(message)
+
+
+def download_error_reason(exception):
+    """Tell why a failed range request should be retried, see :func:`~core.ratelimit_dcm.classify_error()`"""
+    if isinstance(exception, DownloadFailed):
+        return classify_status(exception.status, exception.content) if exception.status else None
+    return classify_error(exception)
+
+
+def split_ranges(size, range_size):
+    """Get the ranges ``(first, last)`` (both included, like the ``Range`` header) of a file of ``size`` bytes,
+    one range ``(0, None)`` for the whole file when the size is not known"""
+    if size is None:
+        return [(0, None)]
+    return [(offset, min(offset + range_size, size) - 1) for offset in range(0, size, range_size)]
+
+
+class RangedDownloadCM(object):
+    """
+    Download Drive files with ``workers`` range requests at the same time and write their bytes in order.
+
+    Every worker thread sends its requests on its own connection: ``http_factory`` is called in the thread (like
+    :func:`~core.gdrive_dcm.GDriveCM.get_http()`, that keeps one ``httplib2.Http`` per thread). At most
+    ``workers * 2`` ranges are downloaded ahead of the one being written, a slow writer holds the downloads back
+    and the memory used is bounded by the range size.
+    """
+
+    def __init__(self, http_factory, download_url=DOWNLOAD_URL, range_size=DEFAULT_RANGE_SIZE,
+                 workers=DEFAULT_DOWNLOADS, retries=None):
+        """
+        Construct a :class:`RangedDownloadCM` object.
+
+        :param http_factory: function without arguments that returns the authorized ``httplib2.Http`` of the
+                             calling thread.
+        :param download_url: the Drive download endpoint, ``{}`` is replaced by the file id.
+        :param range_size: bytes asked for in every request.
+        :param workers: number of requests sent at the same time.
+        :param retries: how many times a failed range is retried, the ``download`` retry budget of the shared
+                        :class:`~core.ratelimit_dcm.RequestExecutorCM` by default.
+        """
+        self.http_factory = http_factory
+        self.download_url = download_url
+        self.range_size = max(range_size, 1)
+        self.workers = max(workers, 1)
+        self.executor = get_request_executor()
+        self.retries = self.executor.budget('download') if retries is None else retries
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_received = 0
+        self.wait = 0.0
+
+    def download(self, file_id, size, output, md5=None):
+        """Write the content of a Drive file to ``output``.
+
+        :param file_id: the Google drive file id.
+        :param size: the size in bytes of the file, from its metadata, ``None`` to download a small file in one
+                     request.
+        :param output: a binary file-like object, it gets the ranges in order.
+        :param md5: the ``md5Checksum`` of the file to verify the download, not verified when ``None``.
+        :returns: the number of bytes written.
+        :raises: :exc:`DownloadFailed` when a range can't be downloaded or the checksum does not match, part of
+                 the file may have been written to ``output`` already.
+        """
+        url = self.download_url.format(file_id)
+        digest = hashlib.md5() if md5 else None
+        ranges = split_ranges(size, self.range_size)
+        if len(ranges) > 1:
+            self._download_ranges(url, ranges, output, digest)
+        elif ranges:
+            # one request is sent from this thread, without a pool (the chunks of a deduplicated backup)
+            start = time.perf_counter()
+            data = self.fetch(url, *ranges[0])
+            with self.lock:
+                self.wait += time.perf_counter() - start
+            self._write(data, output, digest)
+            size = len(data)
+        if digest is not None and digest.hexdigest() != md5:
+            raise DownloadFailed('md5 of the download of {} is {}, expected {}'.format(file_id, digest.hexdigest(),
+                                                                                         md5))
+        return size
+
+    def _download_ranges(self, url, ranges, output, digest):
+        pending = collections.deque()
+        with ThreadPoolExecutor(self.workers) as executor:
+            try:
+                # the requests of the download threads count for the stage of the caller
+                fetch = bind(self.fetch)
+                for first, last in ranges:
+                    pending.append(executor.submit(fetch, url, first, last))
+                    while len(pending) >= self.workers * 2:
+                        self._write_next(pending, output, digest)
+                while pending:
+                    self._write_next(pending, output, digest)
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+
+    def _write_next(self, pending, output, digest):
+        start = time.perf_counter()
+        data = pending.popleft().result()
+        with self.lock:
+            self.wait += time.perf_counter() - start
+        self._write(data, output, digest)
+
+    @staticmethod
+    def _write(data, output, digest):
+        if digest is not None:
+            digest.update(data)
+        output.write(data)
+
+    def fetch(self, url, first, last):
+        """Download the bytes ``first`` to ``last`` (included, ``None`` for the end of the file) of ``url``,
+        retrying the request when it fails because of the rate, on the server side or the network
+
+        :returns: the bytes of the range.
+        """
+        connection = self.http_factory()
+        attempt = 0
+        while True:
+            self.executor.acquire('download')
+            with self.lock:
+                self.requests += 1
+            try:
+                headers = {'Range': 'bytes={}-{}'.format(first, last)} if last is not None else {}
+                resp, content = connection.request(url, 'GET', headers=headers)
+                data = self.parse_range(resp, content, first, last)
+            except Exception as e:
+                reason = download_error_reason(e)
+                if reason is None or attempt >= self.retries:
+                    self.executor.count('download', 'failures')
+                    if isinstance(e, DownloadFailed):
+                        raise
+                    raise DownloadFailed('download of bytes {}-{} failed: {}'.format(first, last, e))
+                self.executor.backoff('download', attempt, reason, e)
+                attempt += 1
+                continue
+            with self.lock:
+                self.bytes_received += len(data)
+            return data
+
+    @staticmethod
+    def parse_range(resp, content, first, last):
+        """Get the bytes ``first`` to ``last`` out of the answer to a range request.
+
+        :raises: :exc:`DownloadFailed` when Drive refused the request, ``http.client.IncompleteRead`` (retried as
+                 a network error) when the answer has less bytes than asked for.
+        """
+        if last is None:
+            if resp.status != 200:
+                raise DownloadFailed('unexpected Drive answer {}: {}'.format(resp.status, content[:200]),
+                                     resp.status, content)
+            return content
+        if resp.status == 206:
+            match = CONTENT_RANGE_PATTERN.match(resp.get('content-range', ''))
+            if not match or int(match.group(1)) != first:
+                raise DownloadFailed('unexpected range {!r}, asked for bytes {}-{}'.format(
+                    resp.get('content-range'), first, last), resp.status, content)
+        elif resp.status == 200:
+            content = content[first:last + 1]  # the server ignored the range and sent the whole file
+        else:
+            raise DownloadFailed('unexpected Drive answer {}: {}'.format(resp.status, content[:200]), resp.status,
+                                 content)
+        if len(content) != last - first + 1:
+            raise http.client.IncompleteRead(content, last - first + 1 - len(content))
+        return content
@@ -6,24 +6,22 @@
 
 from __future__ import print_function
 # Standard library modules.
+import collections
+import functools
 import os
-import sys
 import logging
-import httplib2
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-# google library
-from apiclient import discovery
-import oauth2client
-from oauth2client import client
-from oauth2client import tools
-from apiclient.http import MediaFileUpload
+# Modules included in our package.
+from core.download_dcm import DOWNLOAD_URL, RangedDownloadCM
+from core.metrics_dcm import bind
+from core.ratelimit_dcm import classify_error, get_request_executor
+from core.stream_dcm import read_checksum
+from core.upload_dcm import DEFAULT_CHUNK_SIZE, UPLOAD_URL, ResumableUploadCM, StreamingUploadCM, pending_uploads
 
-try:
-    import argparse
-
-    flags = argparse.ArgumentParser(parents=[tools.argparser]).parse_args()
-except ImportError:
-    flags = None
+# the google libraries (httplib2, apiclient, oauth2client) take longer to import than the rest of the program,
+# they are imported the first time Google drive is used, see :func:`google_libraries()`
 
 # Semi-standard module versioning.
 __version__ = '1.0'
@@ -34,12 +32,108 @@ log = logging.getLogger('dacopancm.' + __name__)
 SCOPES = 'https://www.googleapis.com/auth/drive'
 CLIENT_SECRET_FILE = '../config/google-client_secret.json'
 APPLICATION_NAME = 'Autobackup DCM'
+BATCH_SIZE = 100  # maximum number of calls the Drive API accepts in one batch request
+
+# process wide cache of authorized Drive services, see :func:`GDriveCM.get_service()`
+_service_cache = {}
+_service_cache_lock = threading.Lock()
+_service_build_lock = threading.Lock()
+
+SERVICE_STATS = collections.Counter()
+"""Counters of this run: Drive services ``built``, cached services ``reused``, per-thread HTTP ``connections``
+and ``token_refreshes``."""
+
+GoogleLibraries = collections.namedtuple('GoogleLibraries', 'httplib2 discovery client file tools HttpError')
+
+_flags = None
+_flags_lock = threading.Lock()
+
+
+def google_libraries():
+    """Import the google client libraries, the imports after the first are a lookup in :data:`sys.modules`
+
+    :returns: a namespace with the modules ``httplib2``, ``discovery``, ``client``, ``file`` and ``tools`` and
+              the exception ``HttpError``
+    """
+    import httplib2
+    from apiclient import discovery
+    from apiclient.errors import HttpError
+    from oauth2client import client, file, tools
+    return GoogleLibraries(httplib2, discovery, client, file, tools, HttpError)
+
+
+def get_flags():
+    """Get the arguments of the Google authorization flow given in the command line, parsed once
+
+    The scripts that use this module have their own arguments, the ones that are not flags of the
+    authorization flow are ignored.
+    """
+    global _flags
+    with _flags_lock:
+        if _flags is None:
+            import argparse
+            parser = argparse.ArgumentParser(parents=[google_libraries().tools.argparser], add_help=False)
+            _flags = parser.parse_known_args()[0]
+        return _flags
+
+
+class InvalidPageToken(Exception):
+    """Raised by :func:`GDriveCM.list_changes()` when Google drive does not accept the saved page token."""
+
+
+class CachedService(object):
+    """
+    An authorized Drive service together with its credentials, shared by every thread of the process. The
+    requests are sent on a persistent HTTP connection of the calling thread (``httplib2.Http`` is not thread
+    safe), kept in a :class:`threading.local` so it is closed when the thread finishes.
+    """
+
+    def __init__(self, service, credentials=None, http=None):
+        self.service = service
+        self.credentials = credentials
+        self.local = threading.local()
+        self.local.http = http  # the connection of the thread that built the service
+        self.lock = threading.Lock()
+
+
+def count_service_stat(name, amount=1):
+    with _service_cache_lock:
+        SERVICE_STATS[name] += amount
+
+
+def service_stats(reset=False):
+    """Get the counters of :data:`SERVICE_STATS` as a :class:`dict`.
+
+    :param reset: if ``True`` the counters start again from zero after reading them.
+    """
+    with _service_cache_lock:
+        stats = dict(SERVICE_STATS)
+        if reset:
+            SERVICE_STATS.clear()
+    return stats
+
+
+def clear_service_cache():
+    """Forget all cached services, the next API call of every :class:`GDriveCM` builds a new one."""
+    with _service_cache_lock:
+        _service_cache.clear()
+
+
+def no_redirect_308(http):
+    """Stop ``httplib2`` from following ``308`` answers, Drive uses them to report resumable upload progress."""
+    if hasattr(http, 'redirect_codes'):
+        http.redirect_codes = http.redirect_codes - {308}
+    return http
 
 
 class GDriveCM(object):
     """Python API for the ``GDriveCM`` program."""
 
-    def __init__(self, google_credentials_name, google_authorized, remote_folder=None):
+    upload_url = UPLOAD_URL
+    download_url = DOWNLOAD_URL
+
+    def __init__(self, google_credentials_name, google_authorized, remote_folder=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
         """
         Construct a :class:`RotateBackups` object.
 
@@ -51,10 +145,13 @@ class GDriveCM(object):
                                   the script will be paused until the user logged on google.
 
         :param remote_folder: de folder_id of Google drive
+
+        :param chunk_size: bytes sent on every request of a resumable upload (multiple of 256 KiB)
         """
         self.google_credentials_name = google_credentials_name
         self.remote_folder = remote_folder
         self.google_authorized = google_authorized
+        self.chunk_size = chunk_size
 
     def get_credentials(self):
         """Gets valid user credentials from storage.
@@ -72,30 +169,104 @@ class GDriveCM(object):
         credential_path = os.path.join(credential_dir,
                                        self.google_credentials_name)
 
-        store = oauth2client.file.Storage(credential_path)
+        google = google_libraries()
+        store = google.file.Storage(credential_path)
         credentials = store.get()
         if (not credentials or credentials.invalid) and not self.google_authorized:
             log.info("requesting credentials to Google Drive")
-            flow = client.flow_from_clientsecrets(CLIENT_SECRET_FILE, SCOPES)
+            flow = google.client.flow_from_clientsecrets(CLIENT_SECRET_FILE, SCOPES)
             flow.user_agent = APPLICATION_NAME
             flow.params['access_type'] = 'offline'
-            if flags:
-                credentials = tools.run_flow(flow, store, flags)
-            else:  # Needed only for compatibility with Python 2.6
-                credentials = tools.run(flow, store)
+            credentials = google.tools.run_flow(flow, store, get_flags())
             log.info('Storing credentials to ' + credential_path)
         return credentials
 
     def get_service(self):
         """Gets service Google Drive.
 
-                Returns:
-                    Service, the current Gdrive service ready to use.
-                """
+        The service is built once per credentials name and then reused by every :class:`GDriveCM`
+        and every thread of the process, so the credential file is read and the discovery document
+        fetched only once. ``httplib2.Http`` is not thread safe, so the requests are executed on the
+        connection of the calling thread, see :func:`get_http()`. The access token is refreshed only
+        when it is expired.
+
+        Returns:
+            Service, the current Gdrive service ready to use.
+        """
+        return self.get_cached_service().service
+
+    def get_http(self):
+        """Gets the authorized persistent ``httplib2.Http`` of the calling thread, it is opened the first time
+        the thread sends a request with the credentials of the cached service and dropped when the thread
+        finishes."""
+        cached = self.get_cached_service()
+        http = getattr(cached.local, 'http', None)
+        if http is None:
+            http = cached.local.http = self.authorize_http(cached.credentials)
+            count_service_stat('connections')
+        return http
+
+    def get_cached_service(self):
+        key = self.google_credentials_name
+        with _service_cache_lock:
+            cached = _service_cache.get(key)
+
+        if cached is None:
+            with _service_build_lock:
+                # another thread may have built it while this one waited
+                with _service_cache_lock:
+                    cached = _service_cache.get(key)
+                if cached is None:
+                    cached = self.build_service()
+                    with _service_cache_lock:
+                        _service_cache[key] = cached
+                    count_service_stat('built')
+                    log.debug("built Drive service for %s", self.google_credentials_name)
+                    return cached
+
+        count_service_stat('reused')
+        if cached.credentials is not None and cached.credentials.access_token_expired:
+            with cached.lock:
+                if cached.credentials.access_token_expired:
+                    cached.credentials.refresh(google_libraries().httplib2.Http())
+                    count_service_stat('token_refreshes')
+        return cached
+
+    def build_service(self):
+        """Build a new authorized Drive service, used by :func:`get_service()` when nothing is cached.
+
+        :returns: a :class:`CachedService`.
+        """
+        credentials, http = self.build_http()
+        service = google_libraries().discovery.build('drive', 'v3', http=http)
+        return CachedService(service, credentials, http)
+
+    def build_http(self):
+        """Read the credentials and build a new ``httplib2.Http`` authorized with them.
+
+        :returns: a tuple with the credentials and the authorized ``httplib2.Http``.
+        """
         credentials = self.get_credentials()
-        http = credentials.authorize(httplib2.Http())
-        service = discovery.build('drive', 'v3', http=http)
-        return service
+        return credentials, self.authorize_http(credentials)
+
+    @staticmethod
+    def authorize_http(credentials):
+        """Build a new ``httplib2.Http`` authorized with ``credentials``, not shared with other threads.
+
+        :param credentials: the credentials of a cached service, ``None`` for an unauthorized connection.
+        """
+        http = no_redirect_308(google_libraries().httplib2.Http())
+        return credentials.authorize(http) if credentials is not None else http
+
+    def execute(self, operation, request):
+        """Execute an API request through the rate limiter shared by the process, it is retried when Drive
+        answers with a rate limit or a server error, see :class:`~core.ratelimit_dcm.RequestExecutorCM`
+
+        :param operation: the kind of request, it selects the retry budget: list, get, create, delete, ...
+        :param request: the API request, for example ``service.files().list(...)``
+        :returns: the answer of the request
+        """
+        return get_request_executor().execute(operation, functools.partial(request.execute, http=self.get_http()))
 
     def get_folders(self, parent_id='root'):
         """Gets the child folders of  the given folder id
@@ -109,12 +280,12 @@ class GDriveCM(object):
         page_token = None
         folders = []
         while True:
-            response = service.files().list(
+            response = self.execute('list', service.files().list(
                 q="mimeType='application/vnd.google-apps.folder' and '{}' in parents and trashed = false".format(
                     parent_id),
                 spaces='drive',
                 fields='nextPageToken, files(id, name)',
-                pageToken=page_token).execute()
+                pageToken=page_token))
             files = response.get('files', [])
             for file in files:
                 # Process change
@@ -126,83 +297,231 @@ class GDriveCM(object):
 
         return folders
 
+    def get_folder(self, name, parent_id=None, create=True):
+        """Get the id of the child folder ``name`` of the given folder id, it is created when it does not exist
+
+        :param name: the name of the folder
+        :param parent_id: the Google drive folder id of the parent, the folder of this object by default
+        :param create: False to return None instead of creating a missing folder
+        :returns: the Google drive folder id
+        """
+        parent_id = parent_id or self.remote_folder
+        service = self.get_service()
+        executor = get_request_executor()
+        attempt = 0
+        while True:
+            response = self.execute('list', service.files().list(
+                q="mimeType='application/vnd.google-apps.folder' and name = '{}' and '{}' in parents and "
+                  "trashed = false".format(name.replace("'", "\\'"), parent_id),
+                spaces='drive',
+                fields='files(id)'))
+            folders = response.get('files', [])
+            if folders:
+                return folders[0]['id']
+            if not create:
+                return None
+            try:
+                folder = self.execute('create', service.files().create(
+                    body={'name': name, 'mimeType': 'application/vnd.google-apps.folder', 'parents': [parent_id]},
+                    fields='id'))
+            except Exception as e:
+                # the folder may have been created before the connection broke, it is looked up again first
+                if classify_error(e) != 'network' or attempt >= executor.budget('create'):
+                    raise
+                executor.backoff('create', attempt, 'network', e)
+                attempt += 1
+                continue
+            log.info('created folder "%s" (%s)', name, folder['id'])
+            return folder['id']
+
     def upload_file(self, file):
         """ Upload new backup file to google drive folder id specified in class construct
 
             :param file: the path to local file to upload
 
         """
-        service = self.get_service()
         filename = os.path.basename(file)
-        return self.insert_file(service, filename, file)
+        return self.insert_file(filename, file)
 
-    def insert_file(self, service, filename, file, mime_type=None, description=None):
-        """Insert new file.
+    def upload_files(self, files, concurrency=1):
+        """ Upload several backup files at the same time to the google drive folder of this object
+
+            :param files: the paths of the local files to upload
+            :param concurrency: maximum number of uploads running at the same time
+            :returns: :class:`dict` with every path as key and the new file metadata if it was uploaded,
+                      ``False`` otherwise
+        """
+        if concurrency <= 1 or len(files) <= 1:
+            return dict((file, self.upload_file(file)) for file in files)
+        with ThreadPoolExecutor(min(concurrency, len(files))) as executor:
+            # the requests of the upload threads count for the stage of the caller
+            return dict(zip(files, executor.map(bind(self.upload_file), files)))
+
+    def open_streaming_upload(self, filename, max_buffer=None, fields='id,md5Checksum'):
+        """ Start uploading a new file to the google drive folder of this object while it is being written
+
+            :param filename: Filename of the file to insert.
+            :param max_buffer: maximum bytes queued before the writer is throttled, see :class:`StreamingUploadCM`
+            :param fields: the fields of the created file returned when the upload is closed
+            :returns: a :class:`StreamingUploadCM` sink, its ``close()`` returns the new file metadata or None
+        """
+        # the upload thread gets its own connection
+        http = self.authorize_http(self.get_cached_service().credentials)
+        return StreamingUploadCM(http, {'name': filename, 'parents': [self.remote_folder]},
+                                 upload_url=self.upload_url, chunk_size=self.chunk_size, max_buffer=max_buffer,
+                                 fields=fields)
+
+    def pending_uploads(self):
+        """Get the local files of this folder whose upload was interrupted in a previous run."""
+        return pending_uploads(parents=[self.remote_folder])
+
+    def insert_file(self, filename, file, mime_type=None, description=None):
+        """Insert new file with a resumable upload, an interrupted upload of the same file is resumed.
 
         Args:
-          service: Drive API service instance.
           description: Description of the file to insert.
           mime_type: MIME type of the file to insert.
           filename: Filename of the file to insert.
           file: backup file to upload
         Returns:
-          Inserted file metadata if successful, None otherwise.
+          The new file metadata (id and md5Checksum) if successful, False otherwise.
         """
         try:
             metadata = {'name': filename, 'parents': [self.remote_folder]}
 
             if mime_type:
                 metadata['mimeType'] = mime_type
+            if description:
+                metadata['description'] = description
 
-            media = MediaFileUpload(file, mime_type, resumable=True)
-
-            res = service.files().create(body=metadata, media_body=media, fields='id').execute()
+            uploader = ResumableUploadCM(self.get_http(), upload_url=self.upload_url, chunk_size=self.chunk_size)
+            res = uploader.upload(file, metadata, fields='id,md5Checksum')
 
             if res:
-                log.info('Uploaded "%s" (%s)' % (filename, res['id']))
-                return True
+                log.info('Uploaded "%s" (%s) in %i requests' % (filename, res['id'], uploader.requests))
+                return res if self.verify_upload(file, res) else False
+
+        except Exception as e:
+            log.error('could not upload "%s": %s', filename, e)
+            return False
 
-                # Uncomment the following line to print the File ID
-                # print 'File ID: %s' % file['id']
+    def verify_upload(self, file, metadata):
+        """Compare the md5Checksum computed by Google drive with the one saved next to the local file while it
+        was written, a corrupted remote copy is deleted
 
-        except:
-            e = sys.exc_info()[0]
-            log.error('An error occurred: %s', e)
+        :param file: the local path of the uploaded file
+        :param metadata: the metadata of the new remote file with the ``id`` and ``md5Checksum`` fields
+        :returns: True if the checksums match or there is no local checksum, False otherwise
+        """
+        expected = read_checksum(file, 'md5')
+        if expected is None:
+            return True
+        if metadata.get('md5Checksum') != expected:
+            log.error('md5 of "%s" on Google drive is %s, expected %s: deleting the remote copy',
+                      os.path.basename(file), metadata.get('md5Checksum'), expected)
+            self.delete_file(metadata['id'])
             return False
+        log.debug('verified md5 of "%s": %s', os.path.basename(file), expected)
+        return True
+
+    def get_file(self, file_id, fields='id, name, size, md5Checksum'):
+        """Get the metadata of a file, errors are raised to the caller
+
+        :param file_id: the Google drive file id
+        :param fields: the fields of the file to get
+        :returns: :class:`dict` with the ``fields`` of the file
+        """
+        return self.execute('get', self.get_service().files().get(fileId=file_id, fields=fields))
+
+    def get_downloader(self, **kwargs):
+        """Get a :class:`~core.download_dcm.RangedDownloadCM` for the files of this Drive, every download thread
+        uses the connection this object keeps for it
+
+        :param kwargs: the ``range_size``, ``workers`` and ``retries`` of the downloader
+        """
+        return RangedDownloadCM(self.get_http, download_url=self.download_url, **kwargs)
+
+    def download_file(self, file_id, output, size=None, md5=None, downloader=None):
+        """Download the content of a file with parallel range requests, errors are raised to the caller
+
+        :param file_id: the Google drive file id
+        :param output: a binary file-like object where the content is written in order
+        :param size: the size of the file (see :func:`get_file()`), ``None`` to download a small file in one request
+        :param md5: the md5Checksum the content is verified against
+        :param downloader: the :class:`~core.download_dcm.RangedDownloadCM` to use, :func:`get_downloader()` by
+                           default
+        :returns: the number of bytes written
+        """
+        downloader = downloader or self.get_downloader()
+        downloaded = downloader.download(file_id, size, output, md5=md5)
+        log.debug('downloaded %s (%i bytes)', file_id, downloaded)
+        return downloaded
 
     def get_files(self, folder_id):
-        """Get list of all files contained in the folder_id
+        """Get list of all files contained in the folder_id, errors are raised to the caller (an empty list
+        would make rotation think the folder has no backups)
 
         :param folder_id: the folder id to list files contained in
-        :returns: list of files in this folder
+        :returns: list of files in this folder as ``id_name``
+        """
+        return ['{}_{}'.format(file.get('id'), file.get('name')) for file in self.list_files(folder_id)]
 
+    def list_files(self, folder_id, fields='id, name'):
+        """Get the metadata of all files contained in the folder_id, errors are raised to the caller
+
+        :param folder_id: the folder id to list files contained in
+        :param fields: the fields of every file to get
+        :returns: list of :class:`dict` with the ``fields`` of every file in this folder
         """
+        service = self.get_service()
+        page_token = None
+        backupfiles = []
+        while True:
+            response = self.execute('list', service.files().list(
+                q="'{}' in parents and trashed = false".format(folder_id),
+                spaces='drive',
+                fields='nextPageToken, files({})'.format(fields),
+                pageToken=page_token))
+            backupfiles.extend(response.get('files', []))
 
-        try:
-            service = self.get_service()
-            page_token = None
-            backupfiles = []
-            while True:
-                response = service.files().list(
-                    q="'{}' in parents and trashed = false".format(folder_id),
-                    spaces='drive',
-                    fields='nextPageToken, files(id, name)',
-                    pageToken=page_token).execute()
-                files = response.get('files', [])
-                for file in files:
-                    # Process change
-                    backupfiles.append('{}_{}'.format(file.get('id'), file.get('name')))
-
-                page_token = response.get('nextPageToken', None)
-                if page_token is None:
-                    break
-
-            return backupfiles
-
-        except:
-            e = sys.exc_info()[0]
-            log.error('An error occurred: %s', e)
-            return []
+            page_token = response.get('nextPageToken', None)
+            if page_token is None:
+                break
+
+        return backupfiles
+
+    def get_start_page_token(self):
+        """Get the token of the current position of the Google drive changes feed
+
+        :returns: the page token to give to :func:`list_changes()` in the next run
+        """
+        return self.execute('changes', self.get_service().changes().getStartPageToken())['startPageToken']
+
+    def list_changes(self, page_token, fields='id, name, parents, trashed'):
+        """Get all the changes of the Google drive since ``page_token``, errors are raised to the caller
+
+        :param page_token: a token returned by :func:`get_start_page_token()` or by a previous call
+        :param fields: the fields of the changed files to get
+        :returns: a tuple with the list of changes (:class:`dict` with ``fileId``, ``removed`` and ``file``)
+                  and the token to read the next changes from
+        :raises: :exc:`InvalidPageToken` when the token is not valid anymore, a full listing is needed
+        """
+        service = self.get_service()
+        HttpError = google_libraries().HttpError
+        changes = []
+        while True:
+            try:
+                response = self.execute('changes', service.changes().list(
+                    pageToken=page_token, spaces='drive', pageSize=1000,
+                    fields='nextPageToken, newStartPageToken, changes(fileId, removed, file({}))'.format(fields)))
+            except HttpError as e:
+                if e.resp.status in (400, 404, 410):
+                    raise InvalidPageToken('page token {} refused: {}'.format(page_token, e))
+                raise
+            changes.extend(response.get('changes', []))
+            if 'newStartPageToken' in response:
+                return changes, response['newStartPageToken']
+            page_token = response['nextPageToken']
 
     def delete_file(self, file_id):
         """Delete file with file_id from Google drive
@@ -212,13 +531,73 @@ class GDriveCM(object):
         """
         try:
             service = self.get_service()
-            response = service.files().delete(fileId=file_id).execute()
+            response = self.execute('delete', service.files().delete(fileId=file_id))
             if response:
                 return False
             else:
                 return True
 
-        except:
-            e = sys.exc_info()[0]
-            log.error('An error occurred: %s', e)
+        except Exception as e:
+            log.error('could not delete %s: %s', file_id, e)
             return False
+
+    def delete_files(self, file_ids, batch_size=BATCH_SIZE, retries=None):
+        """Delete many files from Google drive grouping the calls in batch requests
+
+        Every batch request carries up to ``batch_size`` deletions, so pruning hundreds of files costs
+        a few round-trips, each deletion takes a token of the shared rate limiter. Only the deletions that
+        failed because of the rate, on the server side or the network are sent again after a backoff, up to
+        ``retries`` times. A file that does not exist anymore counts as deleted.
+
+        :param file_ids: the Google drive file ids to delete
+        :param batch_size: maximum number of deletions in each batch request
+        :param retries: how many times the failed deletions are retried, the ``delete`` retry budget by default
+        :returns: :class:`dict` with every file id as key and ``True`` if it was deleted, ``False`` otherwise
+        """
+        results = collections.OrderedDict((file_id, False) for file_id in file_ids)
+        errors = {}
+        pending = list(results)
+        HttpError = google_libraries().HttpError
+        executor = get_request_executor()
+        if retries is None:
+            retries = executor.budget('delete')
+
+        def callback(request_id, response, exception):
+            if exception is None or (isinstance(exception, HttpError) and exception.resp.status == 404):
+                results[request_id] = True
+                errors.pop(request_id, None)
+            else:
+                errors[request_id] = exception
+
+        for attempt in range(retries + 1):
+            if not pending:
+                break
+            if attempt:
+                reasons = set(classify_error(errors[file_id]) for file_id in pending)
+                executor.backoff('delete', attempt - 1, 'rate_limited' if 'rate_limited' in reasons else
+                                 'server_error' if 'server_error' in reasons else 'network')
+                log.info('retrying %i failed deletions (attempt %i of %i)', len(pending), attempt + 1, retries + 1)
+
+            service = self.get_service()
+            for offset in range(0, len(pending), batch_size):
+                batch = service.new_batch_http_request(callback=callback)
+                for file_id in pending[offset:offset + batch_size]:
+                    executor.acquire('delete')
+                    batch.add(service.files().delete(fileId=file_id), request_id=file_id)
+                try:
+                    batch.execute(http=self.get_http())
+                except Exception as e:
+                    # the whole batch failed, its items without an answer are retried with the failed ones
+                    log.error('An error occurred: %s', e)
+                    for file_id in pending[offset:offset + batch_size]:
+                        errors.setdefault(file_id, e)
+
+            # a deletion refused for another reason (forbidden, ...) would be refused again
+            pending = [file_id for file_id in pending
+                       if not results[file_id] and classify_error(errors.get(file_id)) is not None]
+
+        for file_id, deleted in results.items():
+            if not deleted:
+                executor.count('delete', 'failures')
+                log.error('could not delete %s: %s', file_id, errors.get(file_id))
+        return results
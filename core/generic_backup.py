@@ -10,46 +10,61 @@
 # Standard library modules.
 import datetime
 import json
-import time
+import os
 
 # External dependencies.
 
 # Modules included in our package.
 
 # Semi-standard module version.
-from core.rotate_dcm import RotateBackupsCM
-from core.gdrive_dcm import GDriveCM
+from core.catalog_dcm import CATALOG_FILE, BackupCatalogCM
+from core.daemon_dcm import DAEMON_SOCKET, BackupDaemonCM
+from core.dedup_dcm import CHUNK_DIR, ChunkStoreCM, is_dedup_backup, read_chunk_manifest
+from core.rotate_dcm import AUDIT_INTERVAL, RotateBackupsCM, parse_timestamp
+from core.gdrive_dcm import GDriveCM, service_stats
+from core.metrics_dcm import app_scope, log_report, run_metrics, stage, start_run, write_reports
+from core.ratelimit_dcm import configure_request_executor, request_stats
+from core.scheduler_dcm import SCHEDULER_FILE, ResourceLimitsCM, log_timings, read_limits, run_apps
+from core.state_dcm import STATE_DIR, AppStateStoreCM
+from core.upload_dcm import DEFAULT_CHUNK_SIZE
 
 
 class GenericBackupCM:
-    def __init__(self, log, config_file):
+    def __init__(self, log, config_file, catalog_file=CATALOG_FILE, scheduler_file=SCHEDULER_FILE,
+                 state_dir=STATE_DIR):
         self.log = log
         self.CONFIG_FILE = config_file
+        self.catalog = BackupCatalogCM(catalog_file)
+        # the config file is only read, what changes on every run is saved per app in the state store
+        self.state = AppStateStoreCM(state_dir)
+        limits = read_limits(scheduler_file)
+        self.limits = ResourceLimitsCM.from_config(limits)
+        # the Drive requests of all the apps share one rate limiter
+        configure_request_executor(rate=limits['drive_rate'], burst=limits['drive_burst'])
+        self.metrics_textfile = limits['metrics_textfile']
 
     def read_config(self):
-        """Read configuration of app to backup from json file defined by `~CONFIG_FILE`
+        """Read configuration of app to backup from json file defined by `~CONFIG_FILE`, with the state of every
+        app (``bk``, ``last_backup``) from the state store
 
         :return: :class:`list` with all apps to backup loaded from json
         """
         with open(self.CONFIG_FILE, 'r') as f:
             cfg = json.load(f)
-            return cfg
+            return [self.state.apply(app) for app in cfg]
 
-    def save_last_backup_datetime(self, app, cfg):
+    def save_state(self, app):
         """
-        Save in the app config file the timestamp of the last successful backup
+        Save the state of the app (the timestamp of the last successful backup of every type and the last
+        backup created) to its file in the state store, the config file is not written
 
         :param app: :class:`dict` with configuration returned by :func:`read_config()` modified by
-        :param cfg: the modified version of cfg returned by :func:`~read_config()`.
+                    :func:`backup_app()`
         """
-        self.log.info("starting save_last_backup_datetime to '{}'".format(app['cfg']['app_name']))
+        with stage('save_state'):
+            self.state.save_app(app)
 
-        filestamp = time.strftime('%Y-%m-%d_%H-%M')
-
-        with open(self.CONFIG_FILE, 'w') as f:
-            json.dump(cfg, f, indent=2, sort_keys=False)
-
-        self.log.info("finish save_last_backup_datetime to '{}': {}".format(app['cfg']['app_name'], filestamp))
+        self.log.info("saved state of '{}': {}".format(app['cfg']['app_name'], app['bk']))
 
     def rotate_backups(self, app):
         """ Rotate backups in local and remote directories of this app
@@ -58,112 +73,336 @@ class GenericBackupCM:
         """
         self.log.info("starting rotate_backups to '{}'".format(app['cfg']['app_name']))
 
-        RotateBackupsCM(
-            rotation_scheme=app['rotate']['local'],
-            include_list=app['rotate']['include_list'],
-            exclude_list=app['rotate']['exclude_list'],
-            dry_run=app['rotate']['dry_run'],
-            io_scheduling_class=app['rotate']['ionice'],
-            rotate_type='local'
-        ).rotate_backups(app['cfg']['local_backup_dir'])
-
-        RotateBackupsCM(
-            rotation_scheme=app['rotate']['remote'],
-            include_list=app['rotate']['include_list'],
-            exclude_list=app['rotate']['exclude_list'],
-            dry_run=app['rotate']['dry_run'],
-            io_scheduling_class=app['rotate']['ionice'],
-            rotate_type='remote',
-            gdrivecm=GDriveCM(google_credentials_name=app['cfg']['google_credentials_name'],
-                              google_authorized=app['cfg']['google_authorized'],
-                              remote_folder=app['cfg']['remote_backup_dir'])
-        ).rotate_backups(app['cfg']['remote_backup_dir'])
+        with stage('rotate_local'):
+            RotateBackupsCM(
+                rotation_scheme=app['rotate']['local'],
+                include_list=app['rotate']['include_list'],
+                exclude_list=app['rotate']['exclude_list'],
+                dry_run=app['rotate']['dry_run'],
+                io_scheduling_class=app['rotate']['ionice'],
+                rotate_type='local',
+                catalog=self.catalog,
+                delete_threads=app['rotate'].get('delete_threads', 1)
+            ).rotate_backups(app['cfg']['local_backup_dir'])
+
+        try:
+            with stage('rotate_remote'):
+                RotateBackupsCM(
+                    rotation_scheme=app['rotate']['remote'],
+                    include_list=app['rotate']['include_list'],
+                    exclude_list=app['rotate']['exclude_list'],
+                    dry_run=app['rotate']['dry_run'],
+                    io_scheduling_class=app['rotate']['ionice'],
+                    rotate_type='remote',
+                    gdrivecm=self.get_gdrivecm(app),
+                    catalog=self.catalog,
+                    audit_interval=app['rotate'].get('audit_days', AUDIT_INTERVAL / 86400) * 86400
+                ).rotate_backups(app['cfg']['remote_backup_dir'])
+        except Exception as e:
+            # nothing is deleted when the remote folder can't be listed, the next run rotates it
+            self.log.error("error rotating remote backups of '%s', skipped: %s", app['cfg']['app_name'], e)
 
         self.log.info("finish rotate_backups to '{}'".format(app['cfg']['app_name']))
 
-    def upload_backup(self, app, backup_file):
-        """ Upload backup_file to Google Drive
+    def get_gdrivecm(self, app, remote_folder=None):
+        """ Get the :class:`GDriveCM` of this app, the authorized Drive service behind it is cached
+        per credentials name so upload and rotation share the same connection
+
+        :param app: :class:`dict` with configuration returned by :func:`read_config()`
+        :param remote_folder: the Google Drive folder id of the object, the remote backup dir of the app by default
+        """
+        upload = app.get('upload', {})
+        return GDriveCM(google_credentials_name=app['cfg']['google_credentials_name'],
+                        google_authorized=app['cfg']['google_authorized'],
+                        remote_folder=remote_folder or app['cfg']['remote_backup_dir'],
+                        chunk_size=upload.get('chunk_size', DEFAULT_CHUNK_SIZE))
+
+    def open_streaming_upload(self, app, backup_file):
+        """ Start uploading backup_file to Google Drive while it is written, when the upload mode of the app
+        is ``tee``, so the upload ends shortly after the backup. The returned sink throttles the writer when
+        the network is slower than the backup
+
+        :param app: :class:`dict` with configuration returned by :func:`read_config()`
+        :param backup_file: the local path of backup_file that will be written
+        :return: a :class:`~core.upload_dcm.StreamingUploadCM` or None if the upload is done after the backup
+        """
+        upload = app.get('upload', {})
+        if upload.get('mode') != 'tee' or is_dedup_backup(backup_file):
+            return None  # the chunks of a deduplicated backup must be uploaded before it
+        try:
+            return self.get_gdrivecm(app).open_streaming_upload(os.path.basename(backup_file),
+                                                                max_buffer=upload.get('max_buffer'))
+        except:
+            self.log.error("Error starting streaming upload of %s, it will be uploaded after the backup", backup_file)
+            return None
+
+    def upload_backup(self, app, backup_file, streamed=None):
+        """ Upload backup_file to Google Drive, together with the backups of this app whose upload was
+        interrupted in a previous run (they are resumed from the last offset acknowledged by Drive)
 
         :param app: :class:`dict` with configuration returned by :func:`read_config()`
         :param backup_file: the local path of backup_file to upload
+        :param streamed: the file metadata returned by a streaming upload of backup_file that succeeded
+                         (see :func:`open_streaming_upload()`), in that case it is not uploaded again
         :return: True if upload otherwise False
         """
         self.log.debug("uploading %s", backup_file)
         try:
-            res = GDriveCM(google_credentials_name=app['cfg']['google_credentials_name'],
-                           google_authorized=app['cfg']['google_authorized'],
-                           remote_folder=app['cfg']['remote_backup_dir']
-                           ).upload_file(backup_file)
-
-            if res:
-                self.log.info("uploaded %s", backup_file)
-            else:
-                self.log.info("error uploading %s", backup_file)
-
-            return res
-
+            with self.limits.slot('upload'), stage('upload') as scope:
+                result = self.upload_backup_files(app, backup_file, streamed)
+                if result and not streamed:
+                    scope.add_bytes(os.path.getsize(backup_file))
+                return result
         except:
             self.log.error("Error uploading %s", backup_file)
             return False
 
+    def upload_backup_files(self, app, backup_file, streamed):
+        """ Upload backup_file and the interrupted uploads of this app, see :func:`upload_backup()` """
+        gdrivecm = self.get_gdrivecm(app)
+        pending = [f for f in gdrivecm.pending_uploads() if os.path.abspath(f) != os.path.abspath(backup_file)]
+        if pending:
+            self.log.info("resuming %i interrupted uploads of '%s'", len(pending), app['cfg']['app_name'])
+
+        files = ([] if streamed else [backup_file]) + pending
+        # a deduplicated backup is uploaded after the chunks Google Drive does not have yet
+        files = [file for file in files if not is_dedup_backup(file) or self.upload_chunks(app, file)]
+        results = gdrivecm.upload_files(files, concurrency=app.get('upload', {}).get('concurrency', 1))
+        if streamed:
+            results[backup_file] = streamed if gdrivecm.verify_upload(backup_file, streamed) else False
+        for file, metadata in results.items():
+            if metadata:
+                self.record_upload(app, file, metadata)
+            elif file != backup_file:
+                self.log.error("error resuming upload of %s", file)
+
+        res = bool(results.get(backup_file))
+        if res:
+            self.log.info("uploaded %s", backup_file)
+        else:
+            self.log.info("error uploading %s", backup_file)
+
+        return res
+
+    def upload_chunks(self, app, backup_file):
+        """ Upload to the chunks folder of the app the chunks of a deduplicated backup that are not there yet
+
+        :param app: :class:`dict` with configuration returned by :func:`read_config()`
+        :param backup_file: the local path of the manifest of the backup
+        :return: True if Google Drive has all the chunks of the backup otherwise False
+        """
+        remote_dir = app['cfg']['remote_backup_dir']
+        known = self.catalog.chunks('remote', remote_dir)
+        missing = sorted(set(digest for digest, size in read_chunk_manifest(backup_file)['chunks']).difference(known))
+        if not missing:
+            return True
+        store = ChunkStoreCM(os.path.join(os.path.dirname(backup_file), CHUNK_DIR))
+        chunk_folder = self.get_gdrivecm(app).get_folder(CHUNK_DIR)
+        results = self.get_gdrivecm(app, remote_folder=chunk_folder).upload_files(
+            [store.path(digest) for digest in missing], concurrency=app.get('upload', {}).get('concurrency', 1))
+        uploaded = [(digest, results[store.path(digest)]['id'], os.path.getsize(store.path(digest)))
+                    for digest in missing if results[store.path(digest)]]
+        self.catalog.add_chunks('remote', remote_dir, uploaded)
+        self.log.info("uploaded %i of %i new chunks of %s", len(uploaded), len(missing), backup_file)
+        return len(uploaded) == len(missing)
+
+    def record_backup(self, app, backup_file, backup_type, checksums=None, base=None, binlog_position=None):
+        """ Record a new local backup in the backup catalog
+
+        :param app: :class:`dict` with configuration returned by :func:`read_config()`
+        :param backup_file: the local path of the new backup
+        :param backup_type: the frequency tier of the backup: daily, weekly, monthly, yearly
+        :param checksums: :class:`dict` with the ``md5`` and ``sha256`` hex digests of the backup
+        :param base: the name of the full backup an incremental backup depends on
+        :param binlog_position: the binary log coordinates ``(binlog_file, binlog_position)`` where the backup ends
+        """
+        checksums = checksums or {}
+        binlog_file, binlog_position = binlog_position or (None, None)
+        name = os.path.basename(backup_file)
+        # saved with the bk counters when the run of the app ends
+        app['last_backup'] = {'name': name, 'type': backup_type, 'size': os.path.getsize(backup_file),
+                              'sha256': checksums.get('sha256'), 'created': datetime.datetime.now().isoformat()}
+        self.catalog.add('local', os.path.abspath(app['cfg']['local_backup_dir']), name, parse_timestamp(name),
+                         app=app['cfg']['app_name'], size=os.path.getsize(backup_file), md5=checksums.get('md5'),
+                         sha256=checksums.get('sha256'), frequency=backup_type, base=base, binlog_file=binlog_file,
+                         binlog_position=binlog_position)
+
+    def record_upload(self, app, backup_file, metadata):
+        """ Record in the backup catalog the remote copy of a local backup
+
+        :param app: :class:`dict` with configuration returned by :func:`read_config()`
+        :param backup_file: the local path of the uploaded backup
+        :param metadata: the metadata of the new Google Drive file (``id`` and ``md5Checksum``)
+        """
+        name = os.path.basename(backup_file)
+        local = self.catalog.get('local', os.path.abspath(app['cfg']['local_backup_dir']), name)
+        self.catalog.add('remote', app['cfg']['remote_backup_dir'], name, parse_timestamp(name),
+                         app=app['cfg']['app_name'], file_id=metadata['id'],
+                         size=os.path.getsize(backup_file) if os.path.exists(backup_file) else None,
+                         md5=metadata.get('md5Checksum'), sha256=local.sha256 if local else None,
+                         frequency=local.frequency if local else None, base=local.base if local else None,
+                         binlog_file=local.binlog_file if local else None,
+                         binlog_position=local.binlog_position if local else None)
+        if is_dedup_backup(backup_file) and os.path.exists(backup_file):
+            self.catalog.add_chunk_refs('remote', app['cfg']['remote_backup_dir'], name,
+                                        [digest for digest, size in read_chunk_manifest(backup_file)['chunks']])
+
     def run_backups(self):
         self.log.info('starting all backups')
+        metrics = start_run()
         cfg = self.read_config()
 
         # get current time to determinate type of backup
         now = datetime.datetime.now()
+
+        def job(app):
+            with app_scope(app['cfg']['app_name']):
+                return self.backup_app(app, now)
+
+        # the apps run at the same time, up to the limits of dumps, compression threads and uploads
+        timings, elapsed = run_apps(cfg, job, max_workers=self.limits.apps)
+        for name, (result, seconds) in timings.items():
+            metrics.end_app(name, result)
+        log_timings(timings, elapsed, self.limits)
+        self.limits.shutdown()
+
+        self.log_drive_stats()
+        self.write_run_report()
+        self.log.info('end all backups')
+
+    def write_run_report(self, metrics=None, name=None, others=()):
+        """ Write the per-stage metrics of the run as a JSON report and a node_exporter textfile, see
+        :mod:`core.metrics_dcm`
+
+        :param metrics: the :class:`~core.metrics_dcm.RunMetricsCM` of the run, the current one by default
+        :param name: the name of the app of the run, when it is the run of one app
+        :param others: the reports of the last runs of the other apps, kept in the textfile
+        :return: the report written, ``None`` if it could not be written
+        """
+        metrics = metrics or run_metrics()
+        metrics.finish()
+        try:
+            report = write_reports(metrics, textfile=self.metrics_textfile, name=name, others=others)
+        except OSError as e:
+            self.log.error("error writing the run metrics: %s", e)
+            return None
+        log_report(report)
+        return report
+
+    def log_drive_stats(self):
+        """ Log the counters of the Drive services and requests since the last time they were logged """
+        stats = service_stats(reset=True)
+        self.log.info("Drive services built: %i, reused: %i, connections: %i, token refreshes: %i",
+                      stats.get('built', 0), stats.get('reused', 0), stats.get('connections', 0),
+                      stats.get('token_refreshes', 0))
+        stats = request_stats(reset=True)
+        self.log.info("Drive requests: %i (%.1f per second), retries: %i (rate limited: %i, server errors: %i, "
+                      "network: %i), failed: %i, throttled %.1f seconds, backoff %.1f seconds",
+                      stats.get('requests', 0), stats['requests_per_second'], stats.get('retries', 0),
+                      stats.get('rate_limited', 0), stats.get('server_error', 0), stats.get('network', 0),
+                      stats.get('failures', 0), stats.get('throttle_wait', 0), stats.get('backoff_wait', 0))
+
+    def run_daemon(self, socket_path=DAEMON_SOCKET):
+        """ Run the backups of every app from its timetable until the process is stopped, see
+        :class:`~core.daemon_dcm.BackupDaemonCM`
+
+        :param socket_path: path of the Unix socket of the control interface
+        """
+        self.log.info('starting backup daemon')
+        BackupDaemonCM(self, socket_path).serve_forever()
+
+        self.log_drive_stats()
+
+    def backup_app(self, app, now):
+        """ Create the backup of this app that is due at ``now`` (if any), rotate and save its state
+
+        :param app: :class:`dict` with configuration returned by :func:`read_config()`
+        :param now: the :class:`~datetime.datetime` of this run
+        :return: True if a backup was created
+        """
         current_year = now.year
         current_month = now.month
         current_week = now.isocalendar()[1]
         current_day = now.day
+        current_hour = now.hour
+
+        rotate = False
+        # now determine type of backup and run it
+        backup_type = self.due_backup_type(app, now)
+        if backup_type == 'yearly':
+            backup_created = self.do_backup(app, 'yearly')  # now create backup to current app
+            # if yearly full backup was created so not need create full backup of this month and week and daily
+            if backup_created:
+                app['bk']['last_year'] = current_year
+                app['bk']['last_month'] = current_month
+                app['bk']['last_week'] = current_week
+                app['bk']['last_day'] = current_day
+                app['bk']['last_hour'] = current_hour
+                rotate = True
+
+        elif backup_type == 'monthly':
+            backup_created = self.do_backup(app, 'monthly')  # now create backup to current app
+            # if monthly full backup was created so not need create full backup of this week and daily
+            if backup_created:
+                app['bk']['last_month'] = current_month
+                app['bk']['last_week'] = current_week
+                app['bk']['last_day'] = current_day
+                app['bk']['last_hour'] = current_hour
+                rotate = True
+
+        elif backup_type == 'weekly':
+            backup_created = self.do_backup(app, 'weekly')  # now create backup to current app
+            # if weekly full backup was created so not need create daily backup of this day
+            if backup_created:
+                app['bk']['last_week'] = current_week
+                app['bk']['last_day'] = current_day
+                app['bk']['last_hour'] = current_hour
+                rotate = True
+
+        elif backup_type == 'daily':
+            backup_created = self.do_backup(app, 'daily')  # now create backup to current app
+            if backup_created:
+                app['bk']['last_day'] = current_day
+                app['bk']['last_hour'] = current_hour
+                rotate = True
+
+        elif backup_type == 'hourly':
+            backup_created = self.do_backup(app, 'hourly')  # now create backup to current app
+            if backup_created:
+                app['bk']['last_hour'] = current_hour
+                rotate = True
+
+        if rotate:
+            self.rotate_backups(app)  # now rotate backups after backup created and uploaded
+            #  if all are correctly now update the state of the app to save the last backup created
+            self.save_state(app)
+
+        else:
+            self.log.info("No rotate all backups to '{}' up to date".format(app['cfg']['app_name']))
+
+        self.log.info('end backups to \'{}\''.format(app['cfg']['app_name']))
+        return rotate
+
+    def due_backup_type(self, app, now):
+        """ Get the type of the backup of this app that is due at ``now``, the one :func:`backup_app()` creates
 
-        for app in cfg:
-            rotate = False
-            # now determine type of backup and run it
-            if current_year > app['bk']['last_year']:
-                backup_created = self.do_backup(app, 'yearly')  # now create backup to current app
-                # if yearly full backup was created so not need create full backup of this month and week and daily
-                if backup_created:
-                    app['bk']['last_year'] = current_year
-                    app['bk']['last_month'] = current_month
-                    app['bk']['last_week'] = current_week
-                    app['bk']['last_day'] = current_day
-                    rotate = True
-
-            elif current_month > app['bk']['last_month']:
-                backup_created = self.do_backup(app, 'monthly')  # now create backup to current app
-                # if monthly full backup was created so not need create full backup of this week and daily
-                if backup_created:
-                    app['bk']['last_month'] = current_month
-                    app['bk']['last_week'] = current_week
-                    app['bk']['last_day'] = current_day
-                    rotate = True
-
-            elif current_week > app['bk']['last_week']:
-                backup_created = self.do_backup(app, 'weekly')  # now create backup to current app
-                # if weekly full backup was created so not need create daily backup of this day
-                if backup_created:
-                    app['bk']['last_week'] = current_week
-                    app['bk']['last_day'] = current_day
-                    rotate = True
-
-            elif current_day > app['bk']['last_day']:
-                backup_created = self.do_backup(app, 'daily')  # now create backup to current app
-                if backup_created:
-                    app['bk']['last_day'] = current_day
-                    rotate = True
-
-            if rotate:
-                self.rotate_backups(app)  # now rotate backups after backup created and uploaded
-                #  if all are correctly now update config file to save the last backup created
-                self.save_last_backup_datetime(app, cfg)
-
-            else:
-                self.log.info("No rotate all backups to '{}' up to date".format(app['cfg']['app_name']))
-
-            self.log.info('end backups to \'{}\''.format(app['cfg']['app_name']))
-
-        self.log.info('end all backups')
+        :param app: :class:`dict` with configuration returned by :func:`read_config()`
+        :param now: the :class:`~datetime.datetime` of this run
+        :return: 'yearly', 'monthly', 'weekly', 'daily', 'hourly' or None if the backups are up to date
+        """
+        # hourly backups only for the apps whose timetable runs every hour
+        hourly = app.get('schedule', {}).get('hourly', False)
+        if now.year > app['bk']['last_year']:
+            return 'yearly'
+        elif now.month > app['bk']['last_month']:
+            return 'monthly'
+        elif now.isocalendar()[1] > app['bk']['last_week']:
+            return 'weekly'
+        elif now.day > app['bk']['last_day']:
+            return 'daily'
+        elif hourly and now.hour > app['bk'].get('last_hour', -1):
+            return 'hourly'
+        return None
 
     def do_backup(self, app, backup_type):
         return False
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# autobackup-dcm: non-blocking logging for the hot paths of the backups.
+# with ``"queue": true`` in the logging config the handlers of the program (console, rotating files) run on a
+# background listener thread: a log call only puts the record in a queue, the message is formatted and written by
+# the listener. The per-entry lines of a subsystem (every backup preserved or deleted by rotation, every entry
+# skipped by a listing) go to a logger under ``dacopancm.entries`` that a :class:`SummaryFilter` can limit: the
+# first debug lines of every kind are kept and the rest are counted and logged as one summary line, the lines at
+# INFO and above (which backups rotation preserved or deleted) are always logged.
+#
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import atexit
+import logging
+import queue
+import threading
+import time
+import weakref
+
+# Semi-standard module versioning.
+__version__ = '1.0'
+
+# Initialize a logger for this module.
+log = logging.getLogger('dacopancm.' + __name__)
+
+QUEUED_LOGGERS = ('dacopancm', '')
+"""Loggers whose handlers move to the listener thread, ``''`` is the root logger."""
+
+_listener = None
+_listener_lock = threading.Lock()
+_filters = weakref.WeakSet()
+
+
+def entry_logger(subsystem):
+    """Get the logger of the per-entry lines of a subsystem (``rotate``, ``listing``, ...)"""
+    return logging.getLogger('dacopancm.entries.' + subsystem)
+
+
+class lazy(object):
+    """A log argument computed only when the message is formatted: ``log.debug('%s', lazy(format_path, path))``"""
+
+    __slots__ = ('function', 'args')
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def __str__(self):
+        return str(self.function(*self.args))
+
+
+class DeferredQueueHandler(logging.Handler):
+    """
+    Put the records in a queue without formatting them, the listener thread formats them.
+
+    Unlike :class:`logging.handlers.QueueHandler` the message is not formatted by the thread that logs, only the
+    traceback of an exception is (its frames change once the ``except`` block ends). The arguments of a queued
+    record must not be modified after the log call.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+def start_queue_logging(logger_names=QUEUED_LOGGERS):
+    """Move the handlers of ``logger_names`` to a listener thread, once :func:`logging.config.dictConfig()`
+    configured them. The listener is stopped, and the queue flushed, when the process exits
+
+    :param logger_names: the names of the loggers whose handlers move to the listener
+    :return: the :class:`logging.handlers.QueueListener`
+    """
+    global _listener
+    import logging.handlers
+
+    with _listener_lock:
+        if _listener is not None:
+            return _listener
+        records = queue.Queue()
+        handlers = []
+        for name in logger_names:
+            logger = logging.getLogger(name)
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+                if handler not in handlers:
+                    handlers.append(handler)
+            logger.addHandler(DeferredQueueHandler(records))
+        # the level of every handler is still applied, on the listener thread
+        _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+        _listener.start()
+    atexit.register(stop_queue_logging)
+    return _listener
+
+
+def stop_queue_logging():
+    """Write the queued records and stop the listener thread, the summaries pending are logged first"""
+    global _listener
+    flush_summaries()
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+class SummaryFilter(logging.Filter):
+    """
+    Let through the first ``limit`` records of every message template in ``interval`` seconds and count the
+    rest, the count is logged in one line when the next interval starts or :func:`flush_summaries()` is called.
+    Only the records up to ``max_level`` are limited, the records above it always pass.
+
+    Used from the ``filters`` of a logger in the logging config (the filters of a logger are not applied to the
+    records of its children, every subsystem logger needs its own)::
+
+        "filters": {"entries": {"()": "core.logging_dcm.SummaryFilter", "limit": 20, "interval": 60}}
+    """
+
+    def __init__(self, name='', limit=20, interval=60, max_level=logging.DEBUG):
+        logging.Filter.__init__(self, name)
+        self.limit = limit
+        # a level name in the logging config, like the ``level`` of a logger
+        self.max_level = logging.getLevelName(max_level) if isinstance(max_level, str) else max_level
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.window = time.monotonic()
+        self.counts = {}
+        _filters.add(self)
+
+    def filter(self, record):
+        if record.levelno > self.max_level or getattr(record, 'summary', False):
+            return True
+        now = time.monotonic()
+        with self.lock:
+            expired = self.take_summaries() if now - self.window > self.interval else None
+            key = (record.name, record.levelno, record.msg)
+            count = self.counts[key] = self.counts.get(key, 0) + 1
+        if expired:
+            self.log_summaries(expired)
+        return count <= self.limit
+
+    def take_summaries(self):
+        """Get the suppressed counts of the window ending and start a new one, called with :attr:`lock` held"""
+        elapsed = time.monotonic() - self.window
+        summaries = [(key, count - self.limit, elapsed) for key, count in self.counts.items() if count > self.limit]
+        self.counts = {}
+        self.window = time.monotonic()
+        return summaries
+
+    def flush(self):
+        with self.lock:
+            summaries = self.take_summaries()
+        self.log_summaries(summaries)
+
+    @staticmethod
+    def log_summaries(summaries):
+        for (name, level, message), suppressed, elapsed in summaries:
+            logging.getLogger(name).log(level, "%i more lines like %r in %.1f seconds were not logged", suppressed,
+                                        message, elapsed, extra={'summary': True})
+
+
+def flush_summaries():
+    """Log the counts of the lines suppressed by every :class:`SummaryFilter`, at the end of a loop that logs
+    once per entry"""
+    for summary_filter in list(_filters):
+        summary_filter.flush()
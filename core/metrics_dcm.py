@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+# autobackup-dcm: per-stage metrics of the backup runs.
+# every stage of the backup of an app (dump, checksum, upload, listing, rotation, ...) is timed with
+# :func:`stage()`, together with the bytes it processed and the Drive requests and retries sent while it ran. At
+# the end of a run the metrics are written as a JSON report (the last runs are kept to compare them) and as a
+# textfile for the node_exporter textfile collector, so Prometheus can track where the nightly window goes.
+#
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import collections
+import contextlib
+import datetime
+import functools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+# Semi-standard module versioning.
+__version__ = '1.0'
+
+# Initialize a logger for this module.
+log = logging.getLogger('dacopancm.' + __name__)
+
+METRICS_DIR = '../data/metrics'
+"""Directory of the JSON reports of the runs."""
+
+LAST_REPORT = 'last_run.json'
+
+TEXTFILE = 'autobackup.prom'
+"""Name of the node_exporter textfile, in :data:`METRICS_DIR` unless another path is configured."""
+
+REPORT_HISTORY = 30
+"""JSON reports of previous runs kept in :data:`METRICS_DIR`."""
+
+_context = threading.local()
+
+
+def peak_rss():
+    """Get the peak resident memory in bytes of this process and of its finished children (the dumps)"""
+    if resource is None:
+        return None, None
+    # ru_maxrss is in KiB on linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+
+
+class StageRecord(object):
+    """The totals of one stage of one app: times it ran, seconds, bytes, Drive requests and retries.
+
+    ``max_rss`` and ``children_max_rss`` are the high-water marks of the resident memory of the process and of its
+    finished children (the dump commands) when the stage ended, since the process started: not the memory of the
+    stage, a stage that follows a bigger one reports the same values.
+    """
+
+    __slots__ = ('calls', 'seconds', 'bytes', 'requests', 'retries', 'max_rss', 'children_max_rss')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.requests = 0
+        self.retries = 0
+        self.max_rss = None
+        self.children_max_rss = None
+
+    def as_dict(self):
+        record = dict((name, getattr(self, name)) for name in self.__slots__)
+        record['seconds'] = round(self.seconds, 3)
+        record['throughput'] = round(self.bytes / self.seconds) if self.seconds > 0 and self.bytes else None
+        return record
+
+
+class StageScope(object):
+    """The stage running in a thread, what is counted while it runs goes to its record."""
+
+    def __init__(self, metrics, app, name, parent):
+        self.metrics = metrics
+        self.app = app
+        self.name = name
+        self.parent = parent
+        self.bytes = 0
+
+    def add_bytes(self, amount):
+        self.bytes += amount
+
+
+class RunMetricsCM(object):
+    """The stage records of the apps of a run, safe to use from any thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = collections.OrderedDict()
+        self.results = {}
+        self.started = time.time()
+        self.finished = None
+
+    def begin_app(self, app):
+        """Forget the records of a previous run of ``app``"""
+        with self.lock:
+            for key in [key for key in self.records if key[0] == app]:
+                del self.records[key]
+            self.results.pop(app, None)
+
+    def end_app(self, app, result):
+        with self.lock:
+            self.results[app] = result
+
+    def record(self, app, stage):
+        key = (app, stage)
+        record = self.records.get(key)
+        if record is None:
+            record = self.records[key] = StageRecord()
+        return record
+
+    def add(self, app, stage, seconds=0.0, calls=1, **counters):
+        """Add to the record of a stage measured by the caller
+
+        :param app: the name of the app, ``None`` for the work done out of the backup of an app
+        :param stage: the name of the stage
+        :param seconds: the duration to add
+        :param counters: amounts to add to ``bytes``, ``requests`` or ``retries``
+        """
+        with self.lock:
+            record = self.record(app, stage)
+            record.calls += calls
+            record.seconds += seconds
+            for name, amount in counters.items():
+                setattr(record, name, getattr(record, name) + amount)
+
+    def finish(self):
+        self.finished = time.time()
+
+    def report(self):
+        """Get the metrics as a :class:`dict` ready to be written as JSON"""
+        self_rss, children_rss = peak_rss()
+        with self.lock:
+            apps = collections.OrderedDict()
+            for (app, stage), record in self.records.items():
+                entry = apps.setdefault(app or '', {'result': self.results.get(app), 'stages': {}})
+                entry['stages'][stage] = record.as_dict()
+            results = dict(self.results)
+        finished = self.finished or time.time()
+        return {'started': datetime.datetime.fromtimestamp(self.started).isoformat(),
+                'seconds': round(finished - self.started, 3), 'peak_rss': self_rss,
+                'children_peak_rss': children_rss, 'apps': apps,
+                'failed_apps': sorted(app for app, result in results.items() if result is None)}
+
+
+_metrics = RunMetricsCM()
+_metrics_lock = threading.Lock()
+
+
+def start_run():
+    """Start the metrics of a new run, the records of the previous one are dropped"""
+    global _metrics
+    with _metrics_lock:
+        _metrics = RunMetricsCM()
+        return _metrics
+
+
+def run_metrics():
+    """Get the :class:`RunMetricsCM` of the current run"""
+    with _metrics_lock:
+        return _metrics
+
+
+def current_scope():
+    return getattr(_context, 'scope', None)
+
+
+@contextlib.contextmanager
+def app_scope(app, metrics=None):
+    """Count the stages of the ``with`` block, in this thread, as stages of ``app``
+
+    :param app: the name of the app
+    :param metrics: the :class:`RunMetricsCM` of the stages, the one of the current run by default
+    """
+    metrics = metrics or run_metrics()
+    metrics.begin_app(app)
+    previous = current_scope()
+    _context.scope = StageScope(metrics, app, None, None)
+    try:
+        yield
+    finally:
+        _context.scope = previous
+
+
+@contextlib.contextmanager
+def stage(name, app=None):
+    """Time the ``with`` block as the stage ``name`` of the app of the current thread
+
+    The time of a stage includes the stages nested in it, the Drive requests sent in the block count only for
+    the innermost stage. The bytes it processed are added by the block through the :class:`StageScope` it gets.
+
+    :param name: the name of the stage: dump, checksum, upload, listing, rotation, ...
+    :param app: the name of the app, the one of :func:`app_scope()` by default
+    """
+    parent = current_scope()
+    if app is None and parent is not None:
+        app = parent.app
+    metrics = parent.metrics if parent is not None else run_metrics()
+    scope = _context.scope = StageScope(metrics, app, name, parent)
+    start = time.perf_counter()
+    try:
+        yield scope
+    finally:
+        _context.scope = parent
+        metrics.add(app, name, time.perf_counter() - start, bytes=scope.bytes)
+        self_rss, children_rss = peak_rss()
+        with metrics.lock:
+            record = metrics.record(app, name)
+            record.max_rss, record.children_max_rss = self_rss, children_rss
+
+
+def count(name, amount=1):
+    """Add to the ``requests`` or ``retries`` of the stage running in this thread, if any (``other`` when the
+    thread is in an app but not in a stage)"""
+    scope = current_scope()
+    if scope is not None:
+        scope.metrics.add(scope.app, scope.name or 'other', calls=0, **{name: amount})
+
+
+def bind(function):
+    """Wrap ``function`` to run it in the stage of the current thread, for the work handed to other threads"""
+    scope = current_scope()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        previous = current_scope()
+        _context.scope = scope
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _context.scope = previous
+
+    return wrapper
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(report):
+    """Format a report of :func:`RunMetricsCM.report()` in the Prometheus text exposition format"""
+    metrics = [
+        ('autobackup_stage_seconds', 'Wall-clock seconds of a stage in the last run of the app.', 'seconds'),
+        ('autobackup_stage_bytes', 'Bytes processed by a stage in the last run of the app.', 'bytes'),
+        ('autobackup_stage_drive_requests', 'Google Drive requests sent by a stage in the last run.', 'requests'),
+        ('autobackup_stage_drive_retries', 'Google Drive requests retried by a stage in the last run.', 'retries'),
+        ('autobackup_stage_runs', 'Times a stage ran in the last run of the app.', 'calls'),
+    ]
+    lines = []
+    for metric, description, field in metrics:
+        lines.append('# HELP {} {}'.format(metric, description))
+        lines.append('# TYPE {} gauge'.format(metric))
+        for app, entry in report['apps'].items():
+            for stage_name, record in entry['stages'].items():
+                lines.append('{}{{app="{}",stage="{}"}} {}'.format(metric, escape_label(app), escape_label(stage_name),
+                                                                   record[field]))
+    lines.append('# HELP autobackup_app_success 1 if the last run of the app finished, 0 if it failed.')
+    lines.append('# TYPE autobackup_app_success gauge')
+    for app, entry in report['apps'].items():
+        if app:
+            lines.append('autobackup_app_success{{app="{}"}} {}'.format(escape_label(app),
+                                                                        0 if app in report['failed_apps'] else 1))
+    for metric, description, value in (
+            ('autobackup_run_seconds', 'Wall-clock seconds of the last run.', report['seconds']),
+            ('autobackup_run_peak_rss_bytes', 'Peak resident memory of the backup process since it started.',
+             report['peak_rss']),
+            ('autobackup_run_children_peak_rss_bytes', 'Peak resident memory of the dump commands since the process '
+             'started.',
+             report['children_peak_rss']),
+            ('autobackup_run_finished_timestamp_seconds', 'Unix time the last run finished.', time.time())):
+        if value is not None:
+            lines.append('# HELP {} {}'.format(metric, description))
+            lines.append('# TYPE {} gauge'.format(metric))
+            lines.append('{} {}'.format(metric, value))
+    return '\n'.join(lines) + '\n'
+
+
+def write_atomically(path, text):
+    """Write ``text`` to ``path`` through a temporary file, readers never see a half written file"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+def merge_reports(reports):
+    """Get one report with the apps of ``reports``, an app of a later report replaces the same app of the earlier
+    ones and the values of the run are the ones of the last report"""
+    merged = dict(reports[-1])
+    apps = collections.OrderedDict()
+    failed = set()
+    for report in reports:
+        failed.difference_update(report['apps'])
+        failed.update(report['failed_apps'])
+        apps.update(report['apps'])
+    merged['apps'] = apps
+    merged['failed_apps'] = sorted(failed)
+    return merged
+
+
+def write_reports(metrics=None, directory=METRICS_DIR, textfile=None, history=REPORT_HISTORY, name=None, others=()):
+    """Write the JSON report of a run and the node_exporter textfile
+
+    :param metrics: the :class:`RunMetricsCM`, the one of the current run by default
+    :param directory: the directory of the JSON reports, the last ``history`` of them are kept
+    :param textfile: the path of the node_exporter textfile, :data:`TEXTFILE` in ``directory`` by default
+    :param name: added to the file name of the JSON report, the runs of several apps may start in the same second
+    :param others: the reports of the last runs of other apps, their stages stay in the textfile
+    :return: the report written
+    """
+    metrics = metrics or run_metrics()
+    report = metrics.report()
+    text = json.dumps(report, indent=2)
+    write_atomically(os.path.join(directory, LAST_REPORT), text)
+    started = datetime.datetime.fromtimestamp(metrics.started)
+    filename = 'run_{:%Y-%m-%d_%H-%M-%S}{}.json'.format(started, '_' + name if name else '')
+    write_atomically(os.path.join(directory, filename), text)
+    reports = sorted(entry for entry in os.listdir(directory) if entry.startswith('run_') and entry.endswith('.json'))
+    for entry in reports[:-history] if history else []:
+        os.remove(os.path.join(directory, entry))
+    write_atomically(textfile or os.path.join(directory, TEXTFILE), prometheus_text(merge_reports(list(others) +
+                                                                                                 [report])))
+    return report
+
+
+def log_report(report):
+    """Log the stages of a report, the slowest first"""
+    stages = [(record['seconds'], app, name, record) for app, entry in report['apps'].items()
+              for name, record in entry['stages'].items()]
+    for seconds, app, name, record in sorted(stages, key=lambda item: item[0], reverse=True):
+        log.info("stage %s of '%s': %.1f seconds, %i bytes, %i Drive requests, %i retries", name, app, seconds,
+                 record['bytes'], record['requests'], record['retries'])
+    if report['peak_rss']:
+        log.info("peak memory since the process started: %.1f MiB (dump commands %.1f MiB)",
+                 report['peak_rss'] / 2 ** 20, (report['children_peak_rss'] or 0) / 2 ** 20)
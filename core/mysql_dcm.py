@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# autobackup-dcm: helpers to talk to a MySQL server with its command line clients.
+# queries go through the ``mysql`` client in batch mode (no python driver needed) and the binary log position of
+# a full dump is read from the ``CHANGE MASTER TO`` comment that ``mysqldump --master-data=2`` writes at the start
+# of the dump, on the way to the compressor, so incremental backups can continue from it. A restore streams the
+# decompressed dump into the stdin of the client.
+#
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import logging
+import re
+import subprocess
+import tempfile
+
+# Modules included in our package.
+from core.stream_dcm import StreamCommandFailed
+
+# Semi-standard module versioning.
+__version__ = '1.0'
+
+# Initialize a logger for this module.
+log = logging.getLogger('dacopancm.' + __name__)
+
+BINLOG_POSITION_PATTERN = re.compile(
+    br"CHANGE (?:MASTER|REPLICATION SOURCE) TO (?:MASTER|SOURCE)_LOG_FILE='([^']+)', (?:MASTER|SOURCE)_LOG_POS=(\d+)")
+"""Matches the binary log coordinates written by ``mysqldump --master-data=2`` (``--source-data`` in 8.0)."""
+
+SNIFF_LIMIT = 64 * 1024
+"""The coordinates are in the header of the dump, only this many bytes are searched."""
+
+BINLOG_START_POSITION = 4
+"""The position of the first event of a binary log (after its magic number)."""
+
+END_OF_RESULT = '__autobackup_dcm_end_of_result__'
+"""Selected by :class:`MysqlSessionCM` after every statement to find where its result ends."""
+
+
+def quote_identifier(name):
+    """Quote a database, table or column name for SQL: ``name`` between backticks"""
+    return '`{}`'.format(name.replace('`', '``'))
+
+
+def quote_string(value):
+    """Quote a string literal for SQL"""
+    return "'{}'".format(value.replace('\\', '\\\\').replace("'", "\\'"))
+
+
+class MysqlClientCM(object):
+    """Run SQL statements with the ``mysql`` command line client."""
+
+    def __init__(self, mysql_bin, user, password, host=None):
+        """
+        :param mysql_bin: the path of the ``mysql`` client
+        :param user: the user to connect as
+        :param password: the password of the user
+        :param host: the host of the server, the local server by default
+        """
+        self.mysql_bin = mysql_bin
+        self.user = user
+        self.password = password
+        self.host = host
+
+    def connection_args(self):
+        args = ['--user={}'.format(self.user), '--password={}'.format(self.password)]
+        if self.host:
+            args.append('--host={}'.format(self.host))
+        return args
+
+    def query(self, sql):
+        """Run ``sql`` and get the rows it returns
+
+        :param sql: one or more SQL statements separated by ``;``
+        :return: :class:`list` of rows, every row is a :class:`list` of strings
+        :raises: :exc:`~core.stream_dcm.StreamCommandFailed` when the client fails
+        """
+        command = [self.mysql_bin, '--batch', '--skip-column-names'] + self.connection_args() + ['--execute', sql]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, error = process.communicate()
+        if process.returncode != 0:
+            raise StreamCommandFailed(command, process.returncode, error.decode('utf-8', 'replace').strip())
+        return [line.split('\t') for line in output.decode('utf-8').splitlines() if line]
+
+    def flush_binary_logs(self):
+        """Close the current binary log and open a new one, so the closed ones can be read completely"""
+        self.query('FLUSH BINARY LOGS')
+
+    def binary_logs(self):
+        """Get the names of the binary logs the server keeps, oldest first"""
+        return [row[0] for row in self.query('SHOW BINARY LOGS')]
+
+    def master_status(self):
+        """Get the current binary log coordinates
+
+        :return: a tuple ``(binlog_file, binlog_position)``
+        """
+        try:
+            rows = self.query('SHOW MASTER STATUS')
+        except StreamCommandFailed:
+            rows = self.query('SHOW BINARY LOG STATUS')  # the new name, the old one was removed in 8.4
+        if not rows:
+            raise StreamCommandFailed([self.mysql_bin], 0, 'binary logging is disabled on the server')
+        return rows[0][0], int(rows[0][1])
+
+
+def binlog_files_since(binary_logs, start_file, current_file):
+    """Get the binary logs to ship in an incremental backup
+
+    :param binary_logs: the names returned by :func:`MysqlClientCM.binary_logs()`
+    :param start_file: the binary log the previous backup ended in
+    :param current_file: the binary log being written (not included, it is still open)
+    :return: :class:`list` of names from ``start_file`` to the one before ``current_file``, or ``None`` if
+             ``start_file`` was purged from the server (the chain can't continue)
+    """
+    if start_file not in binary_logs:
+        return None
+    files = binary_logs[binary_logs.index(start_file):]
+    if current_file in files:
+        files = files[:files.index(current_file)]
+    return files
+
+
+class BinlogPositionWriter(object):
+    """A sink that passes the dump through to ``fileobj`` and picks the binary log coordinates out of its header."""
+
+    def __init__(self, fileobj, limit=SNIFF_LIMIT):
+        self.fileobj = fileobj
+        self.limit = limit
+        self.header = bytearray()
+        self.binlog_file = None
+        self.binlog_position = None
+
+    def write(self, data):
+        if self.binlog_file is None and len(self.header) < self.limit:
+            self.header += data[:self.limit - len(self.header)]
+            match = BINLOG_POSITION_PATTERN.search(self.header)
+            if match:
+                self.binlog_file = match.group(1).decode('utf-8')
+                self.binlog_position = int(match.group(2))
+        return self.fileobj.write(data)
+
+    def close(self):
+        self.fileobj.close()
+
+    @property
+    def position(self):
+        """The coordinates found as a tuple ``(binlog_file, binlog_position)``, or ``None``"""
+        return (self.binlog_file, self.binlog_position) if self.binlog_file else None
+
+
+class MysqlImportWriter(object):
+    """
+    A sink that feeds the SQL written to it to a ``mysql`` client, to restore a dump while it is being read: the
+    dump is never written to disk uncompressed. The client runs the statements as they arrive, a write blocks
+    while the server is behind.
+    """
+
+    def __init__(self, client, database=None):
+        """
+        :param client: the :class:`MysqlClientCM` whose server and user are used
+        :param database: the default database of the session, the one the dump selects by default
+        """
+        self.command = [client.mysql_bin, '--batch'] + client.connection_args() + ([database] if database else [])
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                        stderr=self.stderr)
+        self.size = 0
+
+    def write(self, data):
+        try:
+            self.process.stdin.write(data)
+        except OSError:
+            # the client exited at a failing statement, its error is more useful than the broken pipe
+            self.close()
+            raise
+        self.size += len(data)
+
+    def close(self):
+        """Wait for the client to run the last statements
+
+        :raises: :exc:`~core.stream_dcm.StreamCommandFailed` when the client failed
+        """
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        returncode = self.process.wait()
+        self.stderr.seek(0)
+        error_message = self.stderr.read().decode('utf-8', 'replace').strip()
+        self.stderr.close()
+        if returncode != 0:
+            raise StreamCommandFailed(self.command, returncode, error_message)
+
+    def abort(self):
+        """Stop the client, the statements it did not run yet are lost"""
+        self.process.kill()
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+        self.stderr.close()
+
+
+class MysqlSessionCM(object):
+    """
+    A ``mysql`` client kept running to send it statements one by one, all of them in the same session. Needed for
+    what lasts between statements, like the global read lock of ``FLUSH TABLES WITH READ LOCK``. The client exits
+    at the first failing statement and the session ends with it.
+    """
+
+    def __init__(self, client):
+        """
+        :param client: the :class:`MysqlClientCM` whose server and user are used
+        """
+        self.command = [client.mysql_bin, '--batch', '--skip-column-names', '--unbuffered'] + client.connection_args()
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=self.stderr)
+
+    def query(self, sql):
+        """Run ``sql`` in the session and wait for its rows
+
+        :param sql: one SQL statement without the final ``;``
+        :return: :class:`list` of rows, every row is a :class:`list` of strings
+        :raises: :exc:`~core.stream_dcm.StreamCommandFailed` when the statement fails (the session is over)
+        """
+        try:
+            self.process.stdin.write("{};\nSELECT '{}';\n".format(sql, END_OF_RESULT).encode('utf-8'))
+            self.process.stdin.flush()
+        except OSError:
+            pass  # the client is gone, the error is read below
+        rows = []
+        for line in iter(self.process.stdout.readline, b''):
+            line = line.decode('utf-8').rstrip('\n')
+            if line == END_OF_RESULT:
+                return rows
+            rows.append(line.split('\t'))
+        self.stderr.seek(0)
+        raise StreamCommandFailed(self.command, self.process.wait(),
+                                  self.stderr.read().decode('utf-8', 'replace').strip())
+
+    def close(self):
+        """End the session, the locks it holds are released by the server"""
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.stdout.close()
+        self.process.wait()
+        self.stderr.close()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# autobackup-dcm: dump the tables of a database on several connections at once.
+# a control session holds ``FLUSH TABLES WITH READ LOCK`` while one ``mysqldump --single-transaction`` per worker
+# starts its transaction, so every worker reads the same snapshot, and the lock is released as soon as they all
+# have started. The tables are spread over the workers largest first, the output of every worker is split at the
+# "Table structure" comments into one compressed member per table, and the members are put together in a single
+# ``.gz`` with a manifest of their offsets, so one table can be restored alone or several tables at the same time.
+#
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import heapq
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Modules included in our package.
+from core.mysql_dcm import MysqlSessionCM, quote_identifier, quote_string
+from core.stream_dcm import DEFAULT_COMPRESS_LEVEL, GzipWriter, ParallelGzipWriter, StreamCommandFailed
+from core.stream_dcm import stream_command
+
+# Semi-standard module versioning.
+__version__ = '1.0'
+
+# Initialize a logger for this module.
+log = logging.getLogger('dacopancm.' + __name__)
+
+DEFAULT_WORKERS = 4
+"""Number of ``mysqldump`` connections of a parallel dump."""
+
+DEFAULT_LOCK_TIMEOUT = 60
+"""Seconds the global read lock may be waited for and held while the workers start their snapshot."""
+
+TABLE_MARKER = b'\n--\n-- Table structure for table `'
+"""The comment ``mysqldump`` writes before every table, the output of a worker is split there."""
+
+MANIFEST_SUFFIX = '.manifest.json'
+"""Suffix of the manifest saved next to a parallel dump, see :func:`write_manifest()`."""
+
+MANIFEST_VERSION = 1
+
+
+def manifest_file(path):
+    return path + MANIFEST_SUFFIX
+
+
+def write_manifest(path, manifest):
+    """Save the manifest of the parallel dump ``path`` next to it"""
+    with open(manifest_file(path), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=False)
+
+
+def read_manifest(path):
+    """Get the manifest saved next to ``path`` by :func:`write_manifest()`, ``None`` if there is none"""
+    try:
+        with open(manifest_file(path), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def remove_manifest(path):
+    if os.path.exists(manifest_file(path)):
+        os.remove(manifest_file(path))
+
+
+def spread_tables(tables, workers):
+    """Spread tables over workers so they all dump about the same amount of data
+
+    Largest tables first, every table goes to the worker with the least data so far.
+
+    :param tables: iterable of tuples ``(table_name, size_in_bytes)``
+    :param workers: the number of workers
+    :return: :class:`list` of lists of table names, one per worker that has tables, largest tables first
+    """
+    heap = [(0, index, []) for index in range(max(1, workers))]
+    for name, size in sorted(tables, key=lambda table: (-table[1], table[0])):
+        total, index, names = heapq.heappop(heap)
+        names.append(name)
+        heapq.heappush(heap, (total + size, index, names))
+    return [names for total, index, names in sorted(heap, key=lambda worker: worker[1]) if names]
+
+
+class OffsetWriter(object):
+    """Sink that passes the data through to ``fileobj`` and counts it, :attr:`offset` is where the next byte goes."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.offset = 0
+
+    def write(self, data):
+        self.offset += len(data)
+        self.fileobj.write(data)
+
+
+class TableSplitter(object):
+    """
+    Sink for the output of ``mysqldump`` that compresses every table into its own gzip member(s) in ``fileobj``.
+
+    What ``mysqldump`` writes before the first table (the session settings) is repeated at the start of every
+    table, so every table restores alone. :attr:`members` has the name, offset and sizes of every table.
+    """
+
+    def __init__(self, fileobj, command, started, cancelled, threads=1, compress_level=DEFAULT_COMPRESS_LEVEL,
+                 executor=None):
+        """
+        :param fileobj: a binary file-like object where the compressed tables are written
+        :param command: the ``mysqldump`` command whose output is split, for the errors
+        :param started: a :class:`threading.Event` set at the first table, when the snapshot of the dump is taken
+        :param cancelled: a :class:`threading.Event` that stops the dump at the next write when it is set
+        :param threads: number of blocks of a table compressed at the same time
+        :param compress_level: the gzip compression level (1-9)
+        :param executor: the :class:`~concurrent.futures.Executor` of the compression
+        """
+        self.fileobj = OffsetWriter(fileobj)
+        self.command = command
+        self.started = started
+        self.cancelled = cancelled
+        self.threads = threads
+        self.compress_level = compress_level
+        self.executor = executor
+        self.preamble = bytearray()
+        self.carry = b''
+        self.writer = None
+        self.table = None
+        self.table_offset = 0
+        self.members = []
+
+    def write(self, data):
+        if self.cancelled.is_set():
+            raise StreamCommandFailed(self.command, None, 'the dump was cancelled')
+        buffer = self.carry + bytes(data)
+        position = 0
+        while True:
+            start = buffer.find(TABLE_MARKER, position)
+            if start < 0:
+                keep = max(position, len(buffer) - len(TABLE_MARKER) + 1)
+                break
+            end = buffer.find(b'`\n', start + len(TABLE_MARKER))
+            if end < 0:
+                keep = start  # the name of the table is in the next write
+                break
+            self._write(buffer[position:start + 1])
+            self._start_table(buffer[start + len(TABLE_MARKER):end].replace(b'``', b'`').decode('utf-8'))
+            position = start + 1
+        # the end of the data may be the start of a marker, it is kept for the next write
+        self._write(buffer[position:keep])
+        self.carry = buffer[keep:]
+
+    def close(self):
+        self._write(self.carry)
+        self.carry = b''
+        self._end_table()
+        if not self.members:
+            raise StreamCommandFailed(self.command, 0, 'no table comments in the output, the dump options of a '
+                                                       'parallel dump must keep the comments')
+
+    def _write(self, data):
+        if self.writer is None:
+            self.preamble += data
+        elif data:
+            self.writer.write(data)
+
+    def _start_table(self, name):
+        self._end_table()
+        self.started.set()
+        self.table = name
+        self.table_offset = self.fileobj.offset
+        self.writer = ParallelGzipWriter(self.fileobj, threads=self.threads, compress_level=self.compress_level,
+                                         executor=self.executor)
+        self.writer.write(self.preamble)
+
+    def _end_table(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.members.append({'name': self.table, 'kind': 'table', 'offset': self.table_offset,
+                                 'length': self.fileobj.offset - self.table_offset, 'size': self.writer.bytes_in})
+            self.writer = None
+
+
+class ParallelDumpCM(object):
+    """Dump a database with ``mysqldump`` on several connections sharing one consistent snapshot."""
+
+    def __init__(self, client, mysqldump_bin, database, workers=DEFAULT_WORKERS, lock_timeout=DEFAULT_LOCK_TIMEOUT,
+                 dump_options=(), compress_threads=1, compress_level=DEFAULT_COMPRESS_LEVEL, executor=None,
+                 spool_dir=None, binlog=False):
+        """
+        :param client: the :class:`~core.mysql_dcm.MysqlClientCM` of the server and user
+        :param mysqldump_bin: the path of ``mysqldump``
+        :param database: the name of the database to dump
+        :param workers: maximum number of ``mysqldump`` connections
+        :param lock_timeout: seconds to wait for the global read lock, and for the workers to start their snapshot
+                             while it is held, before the dump is given up
+        :param dump_options: more options for the ``mysqldump`` of the workers
+        :param compress_threads: number of blocks of a worker compressed at the same time
+        :param compress_level: the gzip compression level (1-9)
+        :param executor: the :class:`~concurrent.futures.Executor` of the compression, a private one by default
+        :param spool_dir: the directory of the temporary files of the workers (each one holds its compressed
+                          tables until all of them end), the system temporary directory by default
+        :param binlog: ``True`` to read the binary log coordinates of the snapshot, see :attr:`position`
+        """
+        self.client = client
+        self.mysqldump_bin = mysqldump_bin
+        self.database = database
+        self.workers = max(1, workers)
+        self.lock_timeout = lock_timeout
+        self.dump_options = list(dump_options)
+        self.compress_threads = compress_threads
+        self.compress_level = compress_level
+        self.executor = executor
+        self.spool_dir = spool_dir
+        self.binlog = binlog
+        self.position = None
+        self.dump_size = 0
+        self.lock_seconds = None
+
+    def list_tables(self):
+        """Get the tables of the database with their size and its views
+
+        :return: a tuple ``(tables, views)``, ``tables`` is a :class:`list` of tuples ``(name, size_in_bytes)``
+                 (the estimate of the server) and ``views`` a :class:`list` of names
+        """
+        rows = self.client.query('SELECT TABLE_NAME, TABLE_TYPE, COALESCE(DATA_LENGTH, 0) + COALESCE(INDEX_LENGTH, 0) '
+                                 'FROM information_schema.TABLES WHERE TABLE_SCHEMA = {}'.format(
+                                     quote_string(self.database)))
+        tables = [(name, int(size)) for name, kind, size in rows if kind != 'VIEW']
+        views = [name for name, kind, size in rows if kind == 'VIEW']
+        return tables, views
+
+    def dump(self, output):
+        """Dump the database into ``output``
+
+        The result is a standard multi-member gzip stream (``gzip -d`` restores the whole database at once):
+        a member that creates and selects the database, the members of every table and a member with the views,
+        routines and events.
+
+        :param output: a binary file-like object where the compressed dump is written
+        :return: the manifest of the dump, a :class:`dict` with the ``members`` of the dump (their ``kind``,
+                 ``name``, ``offset`` and ``length`` in ``output`` and uncompressed ``size``)
+        :raises: :exc:`~core.stream_dcm.StreamCommandFailed` when a client fails or the snapshot can't be taken
+        """
+        tables, views = self.list_tables()
+        groups = spread_tables(tables, self.workers)
+        log.info("dumping %i tables of '%s' on %i connections", len(tables), self.database, len(groups))
+
+        own_executor = self.executor is None
+        executor = self.executor or ThreadPoolExecutor(max(1, self.compress_threads))
+        cancelled = threading.Event()
+        started = [threading.Event() for group in groups]
+        spools = []
+        try:
+            with ThreadPoolExecutor(max(1, len(groups))) as workers:
+                session = MysqlSessionCM(self.client)
+                try:
+                    session.query('SET SESSION lock_wait_timeout = {:d}'.format(int(self.lock_timeout)))
+                    session.query('FLUSH TABLES WITH READ LOCK')
+                    locked = time.time()
+                    # nothing is written while the lock is held, the coordinates are those of the snapshot
+                    self.position = self.client.master_status() if self.binlog else None
+                    futures = [workers.submit(self.dump_tables, group, event, cancelled, executor, spools)
+                               for group, event in zip(groups, started)]
+                    for event in started:
+                        if not event.wait(max(0, locked + self.lock_timeout - time.time())):
+                            raise StreamCommandFailed([self.mysqldump_bin], None,
+                                                      'the workers did not start their snapshot in {} seconds'.format(
+                                                          self.lock_timeout))
+                    session.query('UNLOCK TABLES')
+                    self.lock_seconds = time.time() - locked
+                    log.info("global read lock of '%s' held %.3f seconds", self.database, self.lock_seconds)
+                    results = [future.result() for future in futures]
+                except BaseException:
+                    cancelled.set()  # the other workers stop at their next write
+                    raise
+                finally:
+                    session.close()
+            return self.assemble(output, results, views, executor)
+        finally:
+            for spool in spools:
+                spool.close()
+            if own_executor:
+                executor.shutdown(wait=True)
+
+    def dump_tables(self, tables, started, cancelled, executor, spools):
+        """Dump some tables in one transaction, run by every worker
+
+        :return: a tuple ``(spool, members, size)``: the temporary file with the compressed tables, the members
+                 in it and the number of bytes dumped
+        """
+        command = ([self.mysqldump_bin, '--opt', '--single-transaction', '--triggers'] + self.dump_options +
+                   self.client.connection_args() + [self.database] + tables)
+        try:
+            spool = tempfile.TemporaryFile(dir=self.spool_dir)
+            spools.append(spool)
+            splitter = TableSplitter(spool, command, started, cancelled, threads=self.compress_threads,
+                                     compress_level=self.compress_level, executor=executor)
+            size = stream_command(command, splitter)
+            splitter.close()
+            spool.flush()
+            return spool, splitter.members, size
+        finally:
+            started.set()  # a worker that failed before its first table does not keep the lock waiting
+
+    def assemble(self, output, results, views, executor):
+        """Write the members of the dump to ``output``: database, tables of every worker, views and routines"""
+        output = OffsetWriter(output)
+        members = []
+
+        header = io.BytesIO()
+        sql = 'CREATE DATABASE /*!32312 IF NOT EXISTS*/ {0};\nUSE {0};\n'.format(quote_identifier(self.database))
+        with GzipWriter(header, compress_level=self.compress_level) as writer:
+            writer.write(sql.encode('utf-8'))
+        members.append({'name': self.database, 'kind': 'database', 'offset': output.offset,
+                        'length': len(header.getvalue()), 'size': len(sql.encode('utf-8'))})
+        output.write(header.getvalue())
+        self.dump_size = len(sql.encode('utf-8'))
+
+        for worker, (spool, worker_members, size) in enumerate(results):
+            base = output.offset
+            spool.seek(0)
+            shutil.copyfileobj(spool, output, 1024 * 1024)
+            for member in worker_members:
+                member.update(offset=base + member['offset'], worker=worker)
+                members.append(member)
+            self.dump_size += size
+
+        # views after the tables they select from, routines and events are not in the snapshot
+        command = ([self.mysqldump_bin, '--no-data', '--skip-triggers', '--routines', '--events'] +
+                   ([] if views else ['--no-create-info']) + self.dump_options + self.client.connection_args() +
+                   [self.database] + views)
+        offset = output.offset
+        with ParallelGzipWriter(output, threads=self.compress_threads, compress_level=self.compress_level,
+                                executor=executor) as writer:
+            size = stream_command(command, writer)
+        members.append({'name': self.database, 'kind': 'objects', 'offset': offset, 'length': output.offset - offset,
+                        'size': size})
+        self.dump_size += size
+
+        return {'version': MANIFEST_VERSION, 'database': self.database, 'workers': len(results),
+                'binlog_file': self.position[0] if self.position else None,
+                'binlog_position': self.position[1] if self.position else None,
+                'lock_seconds': round(self.lock_seconds, 3), 'members': members}
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# autobackup-dcm: rate limiting and retries of the Google Drive API requests.
+# every request of the process goes through one :class:`RequestExecutorCM`: a token bucket spaces the requests of
+# all the apps that run at the same time, and a request refused because of the rate (429, 403 rateLimitExceeded)
+# or failed on the server side (5xx, a broken connection) is retried after a jittered exponential backoff, up to
+# the retry budget of its operation (a create is not retried after a broken connection, Drive may have done it).
+# A rate limit answer also slows the bucket down, it speeds up again slowly while the requests succeed. The
+# counters of retries, waits and requests per second are in :func:`request_stats()`.
+#
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import collections
+import json
+import logging
+import random
+import threading
+import time
+
+# Modules included in our package.
+from core import metrics_dcm
+
+# Semi-standard module versioning.
+__version__ = '1.0'
+
+# Initialize a logger for this module.
+log = logging.getLogger('dacopancm.' + __name__)
+
+DEFAULT_RATE = 10.0
+"""Requests per second of the token bucket, the default Drive quota is 1000 requests per 100 seconds per user."""
+
+DEFAULT_BURST = 20
+"""Requests that can be sent at once after an idle period."""
+
+MIN_RATE = 0.5
+"""The bucket is never slowed down below this rate."""
+
+BACKOFF_BASE = 1.0
+"""Seconds of the first backoff, it doubles on every retry of the same request."""
+
+BACKOFF_MAX = 64.0
+"""Longest backoff in seconds."""
+
+RETRY_BUDGETS = {
+    'list': 6,
+    'get': 6,
+    'changes': 6,
+    'create': 4,
+    'delete': 4,
+    'batch': 4,
+    'upload': 5,
+    'download': 5,
+}
+"""How many times a request of every operation is retried, the operations not listed get :data:`DEFAULT_BUDGET`."""
+
+DEFAULT_BUDGET = 4
+
+NON_IDEMPOTENT = ('create',)
+"""Operations not retried after a network error: Drive may have done the request before the connection broke, a
+retry would create a second folder. The caller looks up what it wanted to create before trying again."""
+
+DONE_STATUS = {'delete': 404}
+"""The answer to the retry of an operation that means its previous attempt was done: the file is already deleted."""
+
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+"""Reasons of a ``403`` answer that means slow down, the other ``403`` (forbidden, quota exhausted) are final."""
+
+SERVER_ERRORS = (500, 502, 503, 504)
+
+NETWORK_ERROR_MODULES = ('http', 'httplib2')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def error_reason(content):
+    """Get the reason of the first error of a Drive error answer (``rateLimitExceeded``, ...), ``None`` if none"""
+    try:
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        errors = json.loads(content)['error']['errors']
+        return errors[0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def classify_status(status, content=None):
+    """Tell why a Drive answer should be retried
+
+    :param status: the HTTP status of the answer
+    :param content: the body of the answer, a Drive error document
+    :returns: ``'rate_limited'``, ``'server_error'`` or ``None`` when the answer must not be retried
+    """
+    if status == 429 or (status == 403 and error_reason(content) in RATE_LIMIT_REASONS):
+        return 'rate_limited'
+    if status in SERVER_ERRORS:
+        return 'server_error'
+    return None
+
+
+def error_status(exception):
+    """Get the HTTP status of a failed request, ``None`` when it got no answer"""
+    resp = getattr(exception, 'resp', None)  # apiclient.errors.HttpError, without importing apiclient
+    return getattr(resp, 'status', None)
+
+
+def classify_error(exception):
+    """Tell why a failed request should be retried, the same as :func:`classify_status()` plus ``'network'``
+    for a connection that failed or timed out"""
+    status = error_status(exception)
+    if status is not None:
+        return classify_status(status, getattr(exception, 'content', None))
+    # socket errors and the errors of http.client and httplib2 (not imported here, they load slowly)
+    if isinstance(exception, OSError) or type(exception).__module__.split('.')[0] in NETWORK_ERROR_MODULES:
+        return 'network'
+    return None
+
+
+class TokenBucket(object):
+    """
+    A token bucket of ``rate`` tokens per second that holds ``burst`` tokens at most, a request takes one.
+
+    The rate adapts to the server: :func:`slow_down()` halves it when Drive answers with a rate limit and
+    :func:`speed_up()` adds back a small part of the configured rate for every request that succeeds.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, clock=time.monotonic, sleep=time.sleep):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting for it when the bucket is empty
+
+        :returns: the seconds waited
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # the token is reserved now, the threads that come later wait behind this one
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            self.sleep(wait)
+        return wait
+
+    def slow_down(self):
+        with self.lock:
+            self.rate = max(MIN_RATE, self.rate / 2)
+            return self.rate
+
+    def speed_up(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+
+class RetryBudgetExhausted(Exception):
+    """Raised by :func:`RequestExecutorCM.execute()` when a request still fails after the retries of its budget."""
+
+    def __init__(self, operation, attempts, error):
+        self.operation = operation
+        self.attempts = attempts
+        self.error = error
+        super().__init__("{} request failed {} times, last error: {}".format(operation, attempts, error))
+
+
+class RequestExecutorCM(object):
+    """Send the Drive requests of the process through a :class:`TokenBucket` and retry the ones that can be."""
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, budgets=None, backoff_base=BACKOFF_BASE,
+                 backoff_max=BACKOFF_MAX, sleep=time.sleep):
+        """
+        :param rate: requests per second
+        :param burst: requests that can be sent at once after an idle period
+        :param budgets: :class:`dict` with the retries of every operation, :data:`RETRY_BUDGETS` by default
+        :param backoff_base: seconds of the first backoff
+        :param backoff_max: longest backoff in seconds
+        :param sleep: the function that waits, for tests and benchmarks
+        """
+        self.bucket = TokenBucket(rate, burst, sleep=sleep)
+        self.budgets = dict(RETRY_BUDGETS, **(budgets or {}))
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.sleep = sleep
+        self.random = random.Random()
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(collections.Counter)
+        self.first_request = None
+        self.last_request = None
+
+    def budget(self, operation):
+        return self.budgets.get(operation, DEFAULT_BUDGET)
+
+    def execute(self, operation, function, *args, **kwargs):
+        """Call ``function(*args, **kwargs)`` when the bucket allows it, retrying it when it fails because of the
+        rate or on the server side. The operations of :data:`NON_IDEMPOTENT` are not retried after a network error,
+        a retried operation answered with its :data:`DONE_STATUS` returns ``None``
+
+        :param operation: the kind of request (``list``, ``delete``, ...), it selects the retry budget
+        :param function: the function that sends the request, for example the ``execute`` of an API request
+        :returns: what ``function`` returns
+        :raises: the exception of ``function`` when it can't be retried, :exc:`RetryBudgetExhausted` when the
+                 retries of the budget failed too
+        """
+        attempt = 0
+        while True:
+            self.acquire(operation)
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                if attempt and error_status(e) == DONE_STATUS.get(operation):
+                    # the attempt that failed on our side reached Drive
+                    self.count(operation, 'done_before_retry')
+                    return None
+                reason = classify_error(e)
+                if reason is None or (reason == 'network' and operation in NON_IDEMPOTENT):
+                    self.count(operation, 'failures')
+                    raise
+                if attempt >= self.budget(operation):
+                    self.count(operation, 'failures')
+                    raise RetryBudgetExhausted(operation, attempt + 1, e)
+                self.backoff(operation, attempt, reason, e)
+                attempt += 1
+                continue
+            self.bucket.speed_up()
+            return result
+
+    def acquire(self, operation):
+        """Wait for the bucket before sending a request of ``operation`` yourself, see :func:`backoff()`"""
+        waited = self.bucket.acquire()
+        now = time.time()
+        with self.lock:
+            counters = self.counters[operation]
+            counters['requests'] += 1
+            counters['throttle_wait'] += waited
+            if self.first_request is None:
+                self.first_request = now
+            self.last_request = now
+        metrics_dcm.count('requests')
+
+    def backoff(self, operation, attempt, reason, error=None):
+        """Wait before the retry ``attempt`` (0 for the first) of a request that failed, a random time up to
+        ``backoff_base * 2 ** attempt`` seconds (full jitter, the apps that were refused at the same time
+        do not retry at the same time)
+
+        :param reason: the reason returned by :func:`classify_error()`, a rate limit slows down the bucket
+        :returns: the seconds waited
+        """
+        if reason == 'rate_limited':
+            rate = self.bucket.slow_down()
+            log.info("Drive rate limit on %s requests, slowing down to %.1f requests per second", operation, rate)
+        delay = self.random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        with self.lock:
+            counters = self.counters[operation]
+            counters['retries'] += 1
+            counters[reason] += 1
+            counters['backoff_wait'] += delay
+        metrics_dcm.count('retries')
+        log.debug("retrying %s request in %.1f seconds (%s: %s)", operation, delay, reason, error)
+        self.sleep(delay)
+        return delay
+
+    def count(self, operation, name, amount=1):
+        with self.lock:
+            self.counters[operation][name] += amount
+
+    def stats(self, reset=False):
+        """Get the counters of the requests
+
+        :param reset: if ``True`` the counters start again from zero after reading them
+        :returns: :class:`dict` with the totals of ``requests``, ``retries``, ``rate_limited``, ``server_error``,
+                  ``network``, ``failures``, ``done_before_retry``, ``throttle_wait`` and ``backoff_wait`` (seconds),
+                  the effective
+                  ``requests_per_second``, the current ``rate`` of the bucket and the counters of every
+                  ``operations``
+        """
+        with self.lock:
+            operations = dict((operation, dict(counters)) for operation, counters in self.counters.items())
+            elapsed = (self.last_request - self.first_request) if self.first_request is not None else 0
+            if reset:
+                self.counters.clear()
+                self.first_request = self.last_request = None
+        totals = collections.Counter()
+        for counters in operations.values():
+            totals.update(counters)
+        stats = dict(totals)
+        stats['requests_per_second'] = totals['requests'] / elapsed if elapsed > 0 else float(totals['requests'])
+        stats['rate'] = self.bucket.rate
+        stats['operations'] = operations
+        return stats
+
+
+def configure_request_executor(rate=DEFAULT_RATE, burst=DEFAULT_BURST, budgets=None, backoff_base=BACKOFF_BASE,
+                               backoff_max=BACKOFF_MAX):
+    """Replace the :class:`RequestExecutorCM` shared by the process, before the first request"""
+    global _executor
+    with _executor_lock:
+        _executor = RequestExecutorCM(rate, burst, budgets, backoff_base, backoff_max)
+        return _executor
+
+
+def get_request_executor():
+    """Get the :class:`RequestExecutorCM` shared by every Drive request of the process"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = RequestExecutorCM()
+        return _executor
+
+
+def request_stats(reset=False):
+    """Get the counters of the shared :class:`RequestExecutorCM`, see :func:`RequestExecutorCM.stats()`"""
+    return get_request_executor().stats(reset)
@@ -0,0 +1,547 @@
+#!/usr/bin/env python
+# autobackup-dcm: streaming restore of the backups of an app.
+# a backup is restored from the first place that has it: the local backup directory, the local cache of downloaded
+# backups, or Google Drive, where it is downloaded with parallel range requests (see :mod:`core.download_dcm`). The
+# compressed bytes are decompressed on the way to the sink (the ``mysql`` client), the uncompressed dump is never
+# written to disk. An incremental backup is restored with its full backup and the incremental backups before it,
+# a deduplicated one from its chunks. What is downloaded is kept in a cache of bounded size, the backups used least
+# recently are evicted first, so restoring the same backup again (or the next point of its chain) is local.
+# The time of every stage of the restore (resolve, fetch, cache, decompress, import) is recorded in the run metrics.
+#
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import collections
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Modules included in our package.
+from core.dedup_dcm import CHUNK_DIR, ChunkStoreCM, is_dedup_backup
+from core.download_dcm import DEFAULT_DOWNLOADS, DEFAULT_RANGE_SIZE
+from core.metrics_dcm import bind, run_metrics
+from core.rotate_dcm import parse_timestamp
+from core.stream_dcm import DEFAULT_CHUNK_SIZE, GunzipWriter, TeeWriter
+
+# Semi-standard module versioning.
+__version__ = '1.0'
+
+# Initialize a logger for this module.
+log = logging.getLogger('dacopancm.' + __name__)
+
+CACHE_DIR = '../data/cache'
+"""Directory of the backups and chunks downloaded from Google Drive."""
+
+DEFAULT_CACHE_SIZE = 2 * 1024 ** 3
+"""Bytes the cache may use, the entries used least recently are evicted beyond it."""
+
+EVICT_TO = 0.9
+"""Part of the size of the cache left used by an eviction."""
+
+TEMPORARY_GRACE = 24 * 60 * 60
+"""Seconds after which a cache entry that was never completed (the restore crashed) is deleted."""
+
+RESTORE_STAGES = ('resolve', 'fetch', 'cache', 'decompress', 'import')
+"""The stages of a restore in the run metrics, in the order the data goes through them."""
+
+
+class RestoreFailed(Exception):
+    """Raised by :class:`RestoreCM` when a backup, or a backup it depends on, can't be found."""
+
+
+class TimedWriter(object):
+    """Sink that passes the data through to ``fileobj`` and counts the bytes and the seconds the writes took."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.elapsed = 0.0
+        self.size = 0
+
+    def write(self, data):
+        start = time.perf_counter()
+        self.fileobj.write(data)
+        self.elapsed += time.perf_counter() - start
+        self.size += len(data)
+
+
+class CacheWriter(object):
+    """
+    Sink that writes a new entry of an :class:`ArtifactCacheCM` under a temporary name, the entry appears in the
+    cache with :func:`commit()`. An entry bigger than the cache is dropped while it is written.
+    """
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        os.makedirs(cache.directory, exist_ok=True)
+        fd, self.temporary = tempfile.mkstemp(dir=cache.directory, prefix='.' + key, suffix='.tmp')
+        self.file = os.fdopen(fd, 'wb')
+        self.size = 0
+
+    def write(self, data):
+        if self.file is None:
+            return
+        self.size += len(data)
+        if self.size > self.cache.max_size:
+            log.debug("%s is bigger than the cache, it is not cached", self.key)
+            self.abort()
+            return
+        self.file.write(data)
+
+    def commit(self):
+        """Add the entry to the cache, evicting the entries used least recently if the cache is full
+
+        :return: ``True`` if the entry was added
+        """
+        if self.file is None:
+            return False
+        self.file.close()
+        self.file = None
+        with self.cache.lock:
+            os.replace(self.temporary, self.cache.path(self.key))
+            self.cache.added(self.key, self.size)
+        return True
+
+    def abort(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        os.remove(self.temporary)
+
+
+class ArtifactCacheCM(object):
+    """
+    A directory of files downloaded from Google Drive named by their file id, at most ``max_size`` bytes.
+
+    Reading an entry touches it, when a new entry does not fit the entries with the oldest modification time are
+    deleted first (least recently used). Entries are written under a temporary name and renamed when complete.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_size=DEFAULT_CACHE_SIZE):
+        """
+        :param directory: the directory of the cache, created when the first entry is written
+        :param max_size: bytes the entries may use
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.RLock()
+        self.used = None
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key, size=None):
+        """Get the path of a cached entry and mark it as used
+
+        :param key: the Google Drive file id
+        :param size: the expected size of the entry, an entry of another size is not used
+        :return: the path of the entry, ``None`` if it is not cached
+        """
+        path = self.path(key)
+        with self.lock:
+            try:
+                if size is not None and os.path.getsize(path) != size:
+                    return None
+                os.utime(path)
+            except FileNotFoundError:
+                return None
+        return path
+
+    def open(self, key):
+        """Start writing the entry ``key``
+
+        :return: a :class:`CacheWriter`, its :func:`~CacheWriter.commit()` adds the entry to the cache
+        """
+        return CacheWriter(self, key)
+
+    def put(self, key, data):
+        writer = self.open(key)
+        try:
+            writer.write(data)
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.commit()
+
+    def entries(self):
+        """Get the entries of the cache as tuples ``(mtime, size, key)``, the least recently used first"""
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.name))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for mtime, size, key in self.entries())
+
+    def added(self, key, size):
+        """Count a new entry, the cache is evicted when it does not fit (the size of the cache is only read from
+        the disk again on eviction, adding an entry does not list the directory)"""
+        with self.lock:
+            self.used = self.size() if self.used is None else self.used + size
+            if self.used > self.max_size:
+                self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """Delete the entries used least recently until the cache uses :data:`EVICT_TO` of :attr:`max_size` (the
+        next entries fit without evicting again), and the temporary files of writes that never finished
+
+        :param keep: the key of an entry that is not evicted (the one just added)
+        :return: a tuple with the number of entries deleted and their size
+        """
+        deleted = freed = 0
+        with self.lock:
+            entries = self.entries()
+            total = sum(size for mtime, size, key in entries)
+            for mtime, size, key in entries:
+                if total <= self.max_size * EVICT_TO:
+                    break
+                if key == keep:
+                    continue
+                os.remove(self.path(key))
+                total -= size
+                deleted += 1
+                freed += size
+            limit = time.time() - TEMPORARY_GRACE
+            for entry in os.scandir(self.directory):
+                if entry.name.startswith('.') and entry.stat().st_mtime < limit:
+                    os.remove(entry.path)
+            self.used = total
+        if deleted:
+            log.debug("evicted %i entries (%i bytes) from the cache %s", deleted, freed, self.directory)
+        return deleted, freed
+
+
+class RestoreSource(object):
+    """A backup that can be restored: where its copies are and the full backup it continues (``base``)."""
+
+    __slots__ = ('name', 'timestamp', 'local_path', 'local_size', 'file_id', 'size', 'md5', 'base')
+
+    def __init__(self, name, timestamp):
+        self.name = name
+        self.timestamp = timestamp
+        self.local_path = None
+        self.local_size = None
+        self.file_id = None
+        self.size = None
+        self.md5 = None
+        self.base = None
+
+    def locations(self):
+        return [location for location, present in (('local', self.local_path), ('drive', self.file_id)) if present]
+
+
+def is_restorable(name):
+    """Check if a file name is a backup (not a checksum or a manifest next to it)"""
+    return (name.endswith('.gz') or is_dedup_backup(name)) and parse_timestamp(name) is not None
+
+
+class RestoreCM(object):
+    """Restore the backups of an app into a sink, from the local backups, the cache or Google Drive."""
+
+    def __init__(self, app_name, local_dir, remote_dir=None, catalog=None, gdrivecm=None, cache=None,
+                 range_size=DEFAULT_RANGE_SIZE, workers=DEFAULT_DOWNLOADS, incremental_extension=None):
+        """
+        :param app_name: the name of the app, for the metrics
+        :param local_dir: the local backup directory of the app
+        :param remote_dir: the Google Drive folder id of the backups of the app
+        :param catalog: the :class:`~core.catalog_dcm.BackupCatalogCM` with the checksums and chains of the backups
+        :param gdrivecm: the :class:`~core.gdrive_dcm.GDriveCM` of the remote folder, ``None`` to restore only from
+                         the local backups and the cache
+        :param cache: the :class:`ArtifactCacheCM` of the downloads, ``None`` to not cache them
+        :param range_size: bytes of every range request of a download
+        :param workers: range requests (or chunks) downloaded at the same time
+        :param incremental_extension: the extension of the incremental backups, to find their full backup when the
+                                      catalog does not know it (the catalog of another machine was lost)
+        """
+        self.app_name = app_name
+        self.local_dir = local_dir
+        self.remote_dir = remote_dir
+        self.catalog = catalog
+        self.gdrivecm = gdrivecm
+        self.cache = cache
+        self.workers = max(workers, 1)
+        self.incremental_extension = incremental_extension
+        self.downloader = gdrivecm.get_downloader(range_size=range_size, workers=workers) if gdrivecm else None
+        self.lock = threading.Lock()
+        self.chunk_totals = collections.Counter()
+
+    def backups(self):
+        """Get the backups of the app that can be restored
+
+        :return: :class:`~collections.OrderedDict` with the names as keys and :class:`RestoreSource` objects as
+                 values, the oldest first
+        """
+        sources = {}
+
+        def source(name):
+            if name not in sources:
+                sources[name] = RestoreSource(name, parse_timestamp(name))
+            return sources[name]
+
+        if os.path.isdir(self.local_dir):
+            for entry in os.scandir(self.local_dir):
+                if entry.is_file() and is_restorable(entry.name):
+                    backup = source(entry.name)
+                    backup.local_path = entry.path
+                    backup.local_size = entry.stat().st_size
+        remote = self.catalog.backups('remote', self.remote_dir) if self.catalog and self.remote_dir else []
+        for entry in remote:
+            if is_restorable(entry.name):
+                backup = source(entry.name)
+                backup.file_id, backup.size, backup.md5 = entry.file_id, entry.size, entry.md5
+                backup.base = entry.base
+        if not remote and self.gdrivecm is not None and self.remote_dir:
+            self.list_remote(source)
+        if self.catalog:
+            for entry in self.catalog.backups('local', os.path.abspath(self.local_dir)):
+                if entry.name in sources:
+                    backup = sources[entry.name]
+                    backup.base = backup.base or entry.base
+                    # a local copy of another size is a truncated one
+                    if backup.local_size is not None and entry.size is not None and backup.local_size != entry.size:
+                        log.warning("local copy of %s has %i bytes, %i expected: it is not used", entry.name,
+                                    backup.local_size, entry.size)
+                        backup.local_path = None
+        backups = collections.OrderedDict((backup.name, backup) for backup in sorted(
+            sources.values(), key=lambda backup: (backup.timestamp, backup.name)))
+        self.infer_bases(backups)
+        return backups
+
+    def list_remote(self, source):
+        """Add to the backups the ones in the Google Drive folder, when the catalog knows none of them"""
+        try:
+            files = self.gdrivecm.list_files(self.remote_dir, fields='id, name, size, md5Checksum')
+        except Exception as e:
+            log.warning("could not list the backups of '%s' on Google Drive, only the local ones are restored: %s",
+                        self.app_name, e)
+            return
+        for file in files:
+            if is_restorable(file['name']):
+                backup = source(file['name'])
+                backup.file_id, backup.md5 = file['id'], file.get('md5Checksum')
+                backup.size = int(file['size']) if 'size' in file else None
+
+    def infer_bases(self, backups):
+        """Set the ``base`` of the incremental backups the catalog does not know: the full backup before them
+        (an incremental backup always continues the chain of the last backup)"""
+        if not self.incremental_extension:
+            return
+        base = None
+        for backup in backups.values():
+            if not backup.name.endswith('.' + self.incremental_extension):
+                base = backup.name
+            elif backup.base is None:
+                backup.base = base
+
+    def chain(self, name=None, backups=None):
+        """Get the backups to restore, in order, to get to the backup ``name``
+
+        :param name: the name of the backup, the latest one by default
+        :param backups: the result of :func:`backups()`, read again by default
+        :return: :class:`list` of :class:`RestoreSource`: the backup or, for an incremental backup, its full
+                 backup and the incremental backups of the chain up to it
+        :raises: :exc:`RestoreFailed` when the backup or its full backup can't be found
+        """
+        backups = self.backups() if backups is None else backups
+        if not backups:
+            raise RestoreFailed("'{}' has no backups to restore".format(self.app_name))
+        target = backups.get(name) if name else list(backups.values())[-1]
+        if target is None:
+            raise RestoreFailed("backup {} of '{}' not found".format(name, self.app_name))
+        if target.base is None:
+            return [target]
+        if target.base not in backups:
+            raise RestoreFailed("full backup {} of the incremental backup {} not found".format(target.base,
+                                                                                               target.name))
+        return [backups[target.base]] + [backup for backup in backups.values() if backup.base == target.base and
+                                         (backup.timestamp, backup.name) <= (target.timestamp, target.name)]
+
+    def restore(self, sink, name=None):
+        """Write the uncompressed data of a backup (of its chain) to ``sink`` and close it
+
+        :param sink: a binary file-like object, for example a :class:`~core.mysql_dcm.MysqlImportWriter`, its
+                     ``close()`` is timed as part of the import
+        :param name: the name of the backup, the latest one by default
+        :return: the :class:`list` of :class:`RestoreSource` restored
+        :raises: :exc:`RestoreFailed`, :exc:`~core.download_dcm.DownloadFailed`, :exc:`zlib.error` or the errors of
+                 the sink, the sink is not closed then
+        """
+        start = time.perf_counter()
+        chain = self.chain(name)
+        self.add('resolve', time.perf_counter() - start)
+        log.info("restoring '%s' from %s", self.app_name, ', '.join(backup.name for backup in chain))
+
+        imported = TimedWriter(sink)
+        for backup in chain:
+            if is_dedup_backup(backup.name):
+                self.restore_chunks(backup, imported)
+            else:
+                with GunzipWriter(imported) as gunzip_writer:
+                    self.fetch(backup, gunzip_writer)
+                self.add('decompress', gunzip_writer.elapsed, gunzip_writer.bytes_out)
+            log.info("restored %s", backup.name)
+        start = time.perf_counter()
+        sink.close()
+        self.add('import', imported.elapsed + time.perf_counter() - start, imported.size)
+        return chain
+
+    def fetch(self, backup, output):
+        """Write the compressed bytes of a backup to ``output``, from the local copy, the cache or Google Drive"""
+        if backup.local_path:
+            return self.read_file(backup.local_path, output, backup.name, 'the local backups')
+        if backup.file_id is None or (self.downloader is None and self.cache is None):
+            raise RestoreFailed("backup {} is not in {} and it is not on Google Drive".format(backup.name,
+                                                                                              self.local_dir))
+        if backup.size is None and self.gdrivecm is not None:
+            start = time.perf_counter()
+            metadata = self.gdrivecm.get_file(backup.file_id)
+            backup.size, backup.md5 = int(metadata['size']), backup.md5 or metadata.get('md5Checksum')
+            self.add('resolve', time.perf_counter() - start)
+        cached = self.cache.get(backup.file_id, backup.size) if self.cache else None
+        if cached:
+            return self.read_file(cached, output, backup.name, 'the cache')
+        if self.downloader is None:
+            raise RestoreFailed("backup {} is only on Google Drive".format(backup.name))
+
+        log.info("downloading %s (%s bytes) from Google Drive", backup.name, backup.size)
+        cache_writer = TimedWriter(self.cache.open(backup.file_id)) if self.cache else None
+        wait = self.downloader.wait
+        try:
+            self.gdrivecm.download_file(backup.file_id, TeeWriter(cache_writer, output) if cache_writer else output,
+                                        size=backup.size, md5=backup.md5, downloader=self.downloader)
+        except BaseException:
+            if cache_writer:
+                cache_writer.fileobj.abort()
+            raise
+        self.add('fetch', self.downloader.wait - wait, backup.size)
+        if cache_writer:
+            start = time.perf_counter()
+            cache_writer.fileobj.commit()
+            self.add('cache', cache_writer.elapsed + time.perf_counter() - start, cache_writer.size)
+
+    def read_file(self, path, output, name, where):
+        log.info("reading %s from %s", name, where)
+        elapsed = 0.0
+        size = 0
+        with open(path, 'rb') as f:
+            while True:
+                start = time.perf_counter()
+                data = f.read(DEFAULT_CHUNK_SIZE)
+                elapsed += time.perf_counter() - start
+                if not data:
+                    break
+                size += len(data)
+                output.write(data)
+        self.add('fetch', elapsed, size)
+
+    def restore_chunks(self, backup, output):
+        """Write the uncompressed data of a deduplicated backup to ``output``, its chunks are read (downloaded)
+        and decompressed ``workers`` at a time and written in the order of the manifest"""
+        manifest_data = io.BytesIO()
+        self.fetch(backup, manifest_data)
+        chunks = json.loads(manifest_data.getvalue().decode('utf-8'))['chunks']
+        store = ChunkStoreCM(os.path.join(self.local_dir, CHUNK_DIR))
+        missing = [digest for digest, size in chunks if not os.path.exists(store.path(digest))]
+        remote = self.remote_chunks(set(missing)) if missing else {}
+
+        self.chunk_totals.clear()
+        wait = 0.0
+        read_chunk = bind(self.read_chunk)
+        pending = collections.deque()
+        with ThreadPoolExecutor(self.workers) as executor:
+            try:
+                for digest, size in chunks:
+                    pending.append(executor.submit(read_chunk, store, digest, remote.get(digest)))
+                    while len(pending) >= self.workers * 2:
+                        wait += self._write_chunk(pending, output)
+                while pending:
+                    wait += self._write_chunk(pending, output)
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+        # the chunks are read and decompressed on the pool, the decompression is the seconds of the threads
+        self.add('fetch', wait, self.chunk_totals['compressed'])
+        self.add('decompress', self.chunk_totals['decompress'], self.chunk_totals['size'])
+        if self.chunk_totals['cache']:
+            self.add('cache', self.chunk_totals['cache'], self.chunk_totals['cached'])
+        log.info("%i chunks of %s restored, %i downloaded", len(chunks), backup.name, self.chunk_totals['downloads'])
+
+    @staticmethod
+    def _write_chunk(pending, output):
+        start = time.perf_counter()
+        data = pending.popleft().result()
+        waited = time.perf_counter() - start
+        output.write(data)
+        return waited
+
+    def remote_chunks(self, digests):
+        """Get the file ids of the chunks on Google Drive, from the catalog or from a listing of the chunks folder
+
+        :param digests: the digests of the chunks that are needed
+        :return: :class:`dict` with the digests as keys and the file ids as values
+        """
+        remote = self.catalog.chunks('remote', self.remote_dir) if self.catalog and self.remote_dir else {}
+        if digests.difference(remote) and self.gdrivecm is not None:
+            folder = self.gdrivecm.get_folder(CHUNK_DIR, create=False)
+            if folder:
+                remote.update((file['name'], file['id']) for file in self.gdrivecm.list_files(folder))
+        return remote
+
+    def read_chunk(self, store, digest, file_id):
+        """Get the uncompressed data of a chunk from the local store, the cache or Google Drive, verified
+        against its digest"""
+        path = store.path(digest)
+        if not os.path.exists(path) and file_id is not None and self.cache is not None:
+            path = self.cache.get(file_id) or path
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                compressed = f.read()
+            downloaded = False
+        elif file_id is not None and self.downloader is not None:
+            buffer = io.BytesIO()
+            self.gdrivecm.download_file(file_id, buffer, downloader=self.downloader)
+            compressed = buffer.getvalue()
+            downloaded = True
+        else:
+            raise RestoreFailed("chunk {} is not in {} and it is not on Google Drive".format(digest, store.directory))
+
+        start = time.perf_counter()
+        data = zlib.decompress(compressed, 31)
+        decompress = time.perf_counter() - start
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise RestoreFailed("chunk {} is corrupted".format(digest))
+        cache = 0.0
+        if downloaded and self.cache is not None:
+            start = time.perf_counter()
+            self.cache.put(file_id, compressed)
+            cache = time.perf_counter() - start
+        with self.lock:
+            self.chunk_totals.update({'decompress': decompress, 'size': len(data), 'compressed': len(compressed),
+                                       'downloads': downloaded, 'cache': cache,
+                                       'cached': len(compressed) if downloaded and self.cache else 0})
+        return data
+
+    def add(self, stage, seconds, size=0):
+        run_metrics().add(self.app_name, stage, seconds, bytes=size)
+
+
+def restore_summary(report, app_name):
+    """Get the seconds of the stages of a restore from a run metrics report, in the order of
+    :data:`RESTORE_STAGES`, as a string for the log"""
+    stages = report['apps'].get(app_name, {}).get('stages', {})
+    return ', '.join('{} {:.2f} s'.format(stage, stages[stage]['seconds']) for stage in RESTORE_STAGES
+                     if stage in stages)
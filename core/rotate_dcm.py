@@ -10,6 +10,12 @@
 #    - rotate_backups modified to call `gdrive` to delete files on Google Drive
 #    - custom_format_path instead of format_path to no format Google Drive files
 #    - collect_backups to get files from Google Drive
+#    - local backups are deleted in-process by :class:`~core.delete_dcm.LocalDeleterCM` instead of ``rm``
+#    - :func:`parse_backup_name` fast path for our names, include/exclude globs compiled once, no natsort
+#    - the full backup and earlier incrementals a preserved incremental backup depends on are preserved too
+#    - the chunks of deduplicated backups no backup references any more are deleted after rotation
+#    - the listing, deletion and chunk collection stages are measured by :mod:`core.metrics_dcm`
+#    - the per-backup lines go to the ``rotate`` and ``listing`` entry loggers, formatted only when they are written
 
 """
 Simple to use Python API for rotation of backups.
@@ -23,22 +29,33 @@ import collections
 import datetime
 import fnmatch
 import functools
+import heapq
 import logging
 import os
 import re
 
 # External dependencies.
 from dateutil.relativedelta import relativedelta
-from executor import execute
 from humanfriendly import format_path, Timer
 from humanfriendly.text import concatenate
-from natsort import natsort
+
+# Modules included in our package.
+from core.dedup_dcm import CHUNK_DIR, CHUNKS_EXTENSION, ChunkStoreCM, referenced_chunks
+from core.delete_dcm import LocalDeleterCM
+from core.gdrive_dcm import InvalidPageToken
+from core.logging_dcm import entry_logger, flush_summaries, lazy
+from core.metrics_dcm import stage
+from core.paralleldump_dcm import MANIFEST_SUFFIX, manifest_file
+from core.stream_dcm import CHECKSUM_ALGORITHMS, checksum_file
 
 # Semi-standard module versioning.
 __version__ = '2.3'
 
 # Initialize a logger for this module.
 logger = logging.getLogger('dacopancm.' + __name__)
+# one line per backup, see :class:`core.logging_dcm.SummaryFilter`
+rotate_logger = entry_logger('rotate')
+listing_logger = entry_logger('listing')
 
 ORDERED_FREQUENCIES = (('hourly', relativedelta(hours=1)),
                        ('daily', relativedelta(days=1)),
@@ -58,6 +75,13 @@ A dictionary with rotation frequency names (strings) as keys and
 :class:`~dateutil.relativedelta.relativedelta` objects as values. This
 dictionary is generated based on the tuples in :data:`ORDERED_FREQUENCIES`.
 """
+SIDECAR_SUFFIXES = tuple('.' + algorithm for algorithm in CHECKSUM_ALGORITHMS) + (MANIFEST_SUFFIX,)
+"""
+Suffixes of the files saved next to a backup (its checksums and the manifest
+of a parallel dump). They are not backups themselves: rotation ignores them
+and deletes them with their backup.
+"""
+
 # (?P<year>\d{4})\D?(?P<month>\d{2}) \D?(?P<day>\d{2})\D?(?:(?P<hour>\d{2})\D?(?P<minute>\d{2}) \D?(?P<second>\d{2})?)?
 TIMESTAMP_PATTERN = re.compile(r'''
     # Required components.
@@ -76,6 +100,87 @@ A compiled regular expression object used to match timestamps encoded in
 filenames.
 """
 
+INCREMENTAL_EXTENSIONS = ('binlog.gz',)
+"""
+Extensions of incremental backups. An incremental backup can only be restored
+on top of the full backup before it and the incremental backups in between.
+"""
+
+AUDIT_INTERVAL = 7 * 24 * 60 * 60
+"""
+Seconds between two full listings of a remote folder when rotation reads the
+backups from a :class:`~core.catalog_dcm.BackupCatalogCM`.
+"""
+
+
+_TWO_DIGITS = dict(('%02d' % number, number) for number in range(100))
+
+BackupName = collections.namedtuple('BackupName', 'app timestamp backup_type extension')
+"""
+The parts of a backup filename returned by :func:`parse_backup_name()`:
+the app name, the :class:`~datetime.datetime`, the backup type (the rotation
+tier like 'daily' or 'weekly') and the extension without the dot. Only the
+timestamp is known for names not in the ``app_YYYY-MM-DD_HH-MM_type.ext``
+form, the other parts are ``None``.
+"""
+
+
+def parse_backup_name(name):
+    """
+    Parse a backup filename.
+    Names in our ``app_YYYY-MM-DD_HH-MM_type.ext`` form (for example
+    ``jom_2015-12-25_09-58_daily.gz``) are split with string operations,
+    any other name is searched with :data:`TIMESTAMP_PATTERN`.
+    :param name: The filename of a backup (a string).
+    :returns: A :class:`BackupName` or ``None`` when the name has no
+              timestamp.
+    """
+    head, separator, tail = name.rpartition('_')
+    stamp = head[-16:]
+    if (separator and len(head) > 17 and head[-17] == '_' and stamp[4] == '-' and stamp[7] == '-' and
+            stamp[10] == '_' and stamp[13] == '-' and '.' in tail):
+        year = stamp[:4]
+        month, day = _TWO_DIGITS.get(stamp[5:7]), _TWO_DIGITS.get(stamp[8:10])
+        hour, minute = _TWO_DIGITS.get(stamp[11:13]), _TWO_DIGITS.get(stamp[14:])
+        if year.isdigit() and None not in (month, day, hour, minute):
+            try:
+                timestamp = datetime.datetime(int(year), month, day, hour, minute)
+            except ValueError:
+                pass  # not a valid date, let the regex decide
+            else:
+                backup_type, dot, extension = tail.partition('.')
+                return BackupName(head[:-17], timestamp, backup_type, extension)
+    match = TIMESTAMP_PATTERN.search(name)
+    if match:
+        return BackupName(None, datetime.datetime(*(int(group, 10) for group in match.groups('0'))), None, None)
+
+
+def parse_timestamp(name):
+    """
+    Get the timestamp encoded in a backup filename.
+    :param name: The filename of a backup (a string).
+    :returns: A :class:`~datetime.datetime` object or ``None`` when the name
+              has no timestamp.
+    """
+    parsed = parse_backup_name(name)
+    if parsed:
+        return parsed.timestamp
+
+
+def compile_patterns(patterns):
+    """
+    Compile a list of :mod:`fnmatch` patterns into one matcher.
+    :param patterns: A list of shell glob patterns (strings).
+    :returns: A function that takes a name and returns a true value when
+              it matches any of the patterns (like :func:`fnmatch.fnmatch()`
+              with each of them), or ``None`` when the list is empty.
+    """
+    if not patterns:
+        return None
+    regex = re.compile('|'.join('(?:{})'.format(fnmatch.translate(os.path.normcase(pattern)))
+                                for pattern in patterns))
+    return lambda name: regex.match(os.path.normcase(name))
+
 
 def coerce_retention_period(value):
     """
@@ -97,7 +202,8 @@ class RotateBackupsCM(object):
     """Python API for the ``rotate-backups`` program."""
 
     def __init__(self, rotation_scheme, include_list=None, exclude_list=None,
-                 dry_run=False, io_scheduling_class=None, rotate_type='local', gdrivecm=None):
+                 dry_run=False, io_scheduling_class=None, rotate_type='local', gdrivecm=None, catalog=None,
+                 audit_interval=AUDIT_INTERVAL, delete_threads=1):
         """
         Construct a :class:`RotateBackupsCM` object.
         :param rotation_scheme: A dictionary with one or more of the keys 'hourly',
@@ -128,13 +234,28 @@ class RotateBackupsCM(object):
         :param io_scheduling_class: Use ``ionice`` to set the I/O scheduling class
                                     (expected to be one of the strings 'idle',
                                     'best-effort' or 'realtime').
+        :param catalog: A :class:`~core.catalog_dcm.BackupCatalogCM`. When given
+                        the backups are read from the catalog instead of
+                        listing the directory on every run (see
+                        :func:`reconcile_catalog()`) and the deleted backups
+                        are removed from it.
+        :param audit_interval: Seconds between two full listings of a remote
+                               folder to reconcile the catalog.
+        :param delete_threads: Number of local backups deleted at the same
+                               time (more than one helps on network
+                               filesystems).
         """
         self.rotation_scheme = rotation_scheme
         self.include_list = include_list
         self.exclude_list = exclude_list
+        self.include_matcher = compile_patterns(include_list)
+        self.exclude_matcher = compile_patterns(exclude_list)
         self.dry_run = dry_run
         self.io_scheduling_class = io_scheduling_class
         self.rotate_type = rotate_type
+        self.catalog = catalog
+        self.audit_interval = audit_interval
+        self.delete_threads = delete_threads
         if rotate_type == 'remote':
             self.gdrivecm = gdrivecm
 
@@ -157,7 +278,8 @@ class RotateBackupsCM(object):
         # Load configuration overrides by user?
 
         # Collect the backups in the given directory. if rotate type is on local or on google drive
-        sorted_backups = self.collect_backups(directory, self.rotate_type)
+        with stage(self.rotate_type + '_listing'):
+            sorted_backups = self.collect_backups(directory, self.rotate_type)
         if not sorted_backups:
             logger.info("No backups found in %s.", self.custom_format_path(directory))
             return
@@ -168,29 +290,128 @@ class RotateBackupsCM(object):
         self.apply_rotation_scheme(backups_by_frequency, most_recent_backup.datetime)
         # Find which backups to preserve and why.
         backups_to_preserve = self.find_preservation_criteria(backups_by_frequency)
+        self.preserve_incremental_chains(sorted_backups, backups_to_preserve)
         # Apply the calculated rotation scheme.
+        backups_to_delete = []
+        log_entries = rotate_logger.isEnabledFor(logging.INFO)
         for backup in sorted_backups:
             if backup in backups_to_preserve:
-                matching_periods = backups_to_preserve[backup]
-                logger.info("Preserving %s (matches %s retention %s) ..",
-                            self.custom_format_path(backup.pathname),
-                            concatenate(map(repr, matching_periods)),
-                            "period" if len(matching_periods) == 1 else "periods")
+                if log_entries:
+                    matching_periods = backups_to_preserve[backup]
+                    rotate_logger.info("Preserving %s (matches %s retention %s) ..",
+                                       lazy(self.custom_format_path, backup.pathname),
+                                       lazy(concatenate, [repr(period) for period in matching_periods]),
+                                       "period" if len(matching_periods) == 1 else "periods")
             else:
-                logger.info("Deleting %s %s ..", backup.type, self.custom_format_path(backup.pathname))
+                if log_entries:
+                    rotate_logger.info("Deleting %s %s ..", backup.type, lazy(self.custom_format_path, backup.pathname))
                 if not self.dry_run:
-                    timer = Timer()
-                    if self.rotate_type == 'local':  # if rotate type is on local or on google drive
-                        command = ['rm', '-Rf', backup.pathname]
-                        if self.io_scheduling_class:
-                            command = ['ionice', '--class', self.io_scheduling_class] + command
-
-                        execute(*command, logger=logger)
-                    else:
-                        self.gdrivecm.delete_file(backup.pathname.split('_')[0])
-                    logger.debug("Deleted %s in %s.", self.custom_format_path(backup.pathname), timer)
+                    # deletions are done together once the whole set is known
+                    backups_to_delete.append(backup)
+        if backups_to_delete:
+            with stage(self.rotate_type + '_delete'):
+                if self.rotate_type == 'local':  # if rotate type is on local or on google drive
+                    self.delete_local_backups(directory, backups_to_delete)
+                else:
+                    self.delete_remote_backups(directory, backups_to_delete)
         if len(backups_to_preserve) == len(sorted_backups):
             logger.info("Nothing to do! (all backups preserved)")
+        with stage(self.rotate_type + '_chunk_gc'):
+            self.collect_chunks(directory)
+        flush_summaries()
+
+    def delete_local_backups(self, directory, backups):
+        """
+        Delete local backups and their checksum files in-process with
+        :class:`~core.delete_dcm.LocalDeleterCM`.
+        :param directory: The directory given to :func:`rotate_backups()`.
+        :param backups: A :class:`list` of local :class:`Backup` objects.
+        :returns: The number of backups deleted.
+        """
+        timer = Timer()
+        deleter = LocalDeleterCM(io_scheduling_class=self.io_scheduling_class, threads=self.delete_threads)
+        results = deleter.delete_all([backup.pathname, manifest_file(backup.pathname)] +
+                                     [checksum_file(backup.pathname, algorithm) for algorithm in CHECKSUM_ALGORITHMS]
+                                     for backup in backups)
+        deleted = []
+        for backup, (item, error) in zip(backups, results):
+            if error is None:
+                deleted.append(backup)
+                rotate_logger.debug("Deleted %s.", lazy(self.custom_format_path, backup.pathname))
+            else:
+                logger.error("Failed to delete %s: %s", self.custom_format_path(backup.pathname), error)
+        self.forget_backups(directory, deleted)
+        logger.info("Deleted %i of %i local backups in %s.", len(deleted), len(backups), timer)
+        return len(deleted)
+
+    def delete_remote_backups(self, directory, backups):
+        """
+        Delete backups from Google Drive in bulk with :func:`GDriveCM.delete_files()`.
+        :param directory: The Google Drive folder id of the backups.
+        :param backups: A :class:`list` of remote :class:`Backup` objects.
+        :returns: The number of backups deleted.
+        """
+        timer = Timer()
+        results = self.gdrivecm.delete_files([backup.file_id for backup in backups])
+        deleted = [backup for backup in backups if results[backup.file_id]]
+        for backup in backups:
+            if not results[backup.file_id]:
+                logger.error("Failed to delete %s.", self.custom_format_path(backup.pathname))
+        self.forget_backups(directory, deleted)
+        logger.info("Deleted %i of %i remote backups in %s.", len(deleted), len(backups), timer)
+        return len(deleted)
+
+    def collect_chunks(self, directory):
+        """
+        Delete the chunks of deduplicated backups (see :mod:`core.dedup_dcm`)
+        that no backup of the directory references any more. Local chunks are
+        checked against the manifests in the directory, remote ones against
+        the chunks recorded in the catalog for every remote manifest.
+        :param directory: The directory given to :func:`rotate_backups()`.
+        :returns: The number of chunks deleted.
+        """
+        timer = Timer()
+        if self.rotate_type == 'local':
+            store = ChunkStoreCM(os.path.join(directory, CHUNK_DIR))
+            if not os.path.isdir(store.directory):
+                return 0
+            deleted, freed = store.collect_garbage(referenced_chunks(directory), dry_run=self.dry_run)
+            logger.debug("Unreferenced chunks of %s: %i bytes.", self.custom_format_path(directory), freed)
+        else:
+            if self.catalog is None:
+                return 0
+            unreferenced = self.catalog.unreferenced_chunks('remote', directory, CHUNKS_EXTENSION)
+            if unreferenced is None:
+                logger.warning("Not collecting the chunks of %s: the chunks of some deduplicated backups are "
+                               "not in the catalog.", directory)
+                return 0
+            if not unreferenced:
+                return 0
+            if self.dry_run:
+                deleted = len(unreferenced)
+            else:
+                results = self.gdrivecm.delete_files(list(unreferenced.values()))
+                removed = [digest for digest, file_id in unreferenced.items() if results[file_id]]
+                self.catalog.remove_chunks('remote', directory, removed)
+                deleted = len(removed)
+        if deleted:
+            logger.info("Deleted %i unreferenced chunks of %s in %s.", deleted, self.custom_format_path(directory),
+                        timer)
+        return deleted
+
+    def forget_backups(self, directory, backups):
+        """
+        Remove deleted backups from the catalog (if there is one).
+        :param directory: The directory given to :func:`rotate_backups()`.
+        :param backups: A :class:`list` of deleted :class:`Backup` objects.
+        """
+        if self.catalog is not None and backups:
+            if self.rotate_type == 'remote':
+                # two files of the folder can have the same name
+                self.catalog.remove_files('remote', directory, [backup.pathname.split('_', 1)[0] for backup in backups])
+            else:
+                self.catalog.remove('local', os.path.abspath(directory),
+                                    [os.path.basename(backup.pathname) for backup in backups])
 
     def collect_backups(self, directory, rotate_type):
         """
@@ -203,29 +424,138 @@ class RotateBackupsCM(object):
         backups = []
         # directory = os.path.abspath(directory)
         directory = os.path.abspath(directory) if not rotate_type == 'remote' else directory
+        if self.catalog is not None:
+            return self.collect_catalog_backups(directory, rotate_type)
         logger.info("Scanning %s directory for backups: %s", rotate_type, self.custom_format_path(directory))
-        # get files from local if rotate_type is local else get files from GoogleDrive
-        files = os.listdir(directory) if not rotate_type == 'remote' else self.gdrivecm.get_files(directory)
+        # get files from local if rotate_type is local else get files from GoogleDrive, the type of local
+        # files comes from the same scandir() call
+        if rotate_type == 'remote':
+            types = dict((entry, 'file') for entry in self.gdrivecm.get_files(directory))
+        else:
+            types = dict((entry.name, scandir_type(entry)) for entry in os.scandir(directory))
 
-        for entry in natsort(files):
+        for entry in types:
+            if entry.endswith(SIDECAR_SUFFIXES):
+                continue
             # Check for a time stamp in the directory entry's name.
-            match = TIMESTAMP_PATTERN.search(entry)
-            if match:
+            timestamp = parse_timestamp(entry)
+            if timestamp:
                 # Make sure the entry matches the given include/exclude patterns.
-                if self.exclude_list and any(fnmatch.fnmatch(entry, p) for p in self.exclude_list):
-                    logger.debug("Excluded %r (it matched the exclude list).", entry)
-                elif self.include_list and not any(fnmatch.fnmatch(entry, p) for p in self.include_list):
-                    logger.debug("Excluded %r (it didn't match the include list).", entry)
-                else:
+                if self.is_included(entry):
                     backups.append(Backup(
                         pathname=os.path.join(directory, entry) if not rotate_type == 'remote' else entry,
-                        datetime=datetime.datetime(*(int(group, 10) for group in match.groups('0'))),
+                        datetime=timestamp,
+                        file_type=types[entry],
                     ))
             else:
-                logger.debug("Failed to match time stamp in filename: %s", entry)
+                listing_logger.debug("Failed to match time stamp in filename: %s", entry)
         if backups:
             logger.info("Found %i timestamped backups in %s.", len(backups), self.custom_format_path(directory))
-        return sorted(backups)
+        # backups with the same timestamp are ordered by name, like the catalog does
+        return sorted(backups, key=lambda backup: (backup.datetime, backup.pathname))
+
+    def collect_catalog_backups(self, directory, rotate_type):
+        """
+        Collect the backups of a directory with an indexed query to the catalog.
+        :param directory: The absolute pathname of a local directory or the
+                          Google Drive folder id.
+        :param rotate_type: The rotate type if local o remote on Google Drive
+        :returns: A sorted :class:`list` of :class:`Backup` objects.
+        """
+        self.reconcile_catalog(directory, rotate_type)
+        backups = []
+        for entry in self.catalog.backups(rotate_type, directory):
+            if self.is_included(entry.name):
+                backups.append(Backup(
+                    pathname=os.path.join(directory, entry.name) if not rotate_type == 'remote' else
+                    '{}_{}'.format(entry.file_id, entry.name),
+                    datetime=entry.datetime,
+                    file_type='file' if rotate_type == 'remote' else None,
+                ))
+        if backups:
+            logger.info("Found %i cataloged backups in %s.", len(backups), self.custom_format_path(directory))
+        return backups
+
+    def reconcile_catalog(self, directory, rotate_type):
+        """
+        Pick up the changes made out of band before reading the catalog.
+        A local directory is listed again only when its modification time
+        changed. A remote folder is updated from the Google Drive changes feed
+        (see :func:`apply_remote_changes()`) and listed completely only when
+        there is no valid page token or the last audit is older than
+        :attr:`audit_interval`.
+        :param directory: The absolute pathname of a local directory or the
+                          Google Drive folder id.
+        :param rotate_type: The rotate type if local o remote on Google Drive
+        """
+        page_token = None
+        if rotate_type == 'remote':
+            if not self.catalog.audit_due(rotate_type, directory, self.audit_interval):
+                page_token = self.catalog.page_token(rotate_type, directory)
+                if page_token is not None:
+                    try:
+                        self.apply_remote_changes(directory, page_token)
+                        return
+                    except InvalidPageToken as e:
+                        logger.warning("Changes feed of %s unavailable (%s), listing it completely.", directory, e)
+            logger.info("Auditing remote folder %s (full listing).", directory)
+            # the token is taken before listing so changes made during the listing are read again next time
+            page_token = self.gdrivecm.get_start_page_token()
+            files = [(f['name'], f['id']) for f in self.gdrivecm.list_files(directory)]
+            mtime = None
+        else:
+            mtime = os.stat(directory).st_mtime
+            if not self.catalog.directory_changed(rotate_type, directory, mtime):
+                return
+            files = [(name, None) for name in os.listdir(directory)]
+        entries = []
+        for name, file_id in files:
+            timestamp = parse_timestamp(name)
+            if timestamp and not name.endswith(SIDECAR_SUFFIXES):
+                entries.append((name, file_id, timestamp))
+        self.catalog.sync(rotate_type, directory, entries, mtime=mtime, page_token=page_token)
+
+    def apply_remote_changes(self, directory, page_token):
+        """
+        Update the catalog of a remote folder with the changes made in the
+        Google Drive since ``page_token``, instead of listing the folder.
+        A file deleted, trashed or moved out of the folder is forgotten and a
+        timestamped backup created or renamed in it is added.
+        :param directory: The Google Drive folder id.
+        :param page_token: The token saved by the previous run.
+        :raises: :exc:`~core.gdrive_dcm.InvalidPageToken` when a full listing
+                 is needed.
+        """
+        changes, new_token = self.gdrivecm.list_changes(page_token)
+        upserts = []
+        removed = []
+        for change in changes:
+            file = change.get('file') or {}
+            if change.get('removed') or file.get('trashed') or directory not in file.get('parents', []):
+                removed.append(change['fileId'])
+                continue
+            name = file.get('name', '')
+            timestamp = parse_timestamp(name)
+            if timestamp and not name.endswith(SIDECAR_SUFFIXES):
+                upserts.append((name, change['fileId'], timestamp))
+            else:
+                removed.append(change['fileId'])
+        logger.debug("Read %i changes of the Google Drive for %s.", len(changes), directory)
+        self.catalog.apply_changes('remote', directory, upserts, removed, new_token)
+
+    def is_included(self, entry):
+        """
+        Check a directory entry against the include/exclude patterns.
+        :param entry: The name of the entry (a string).
+        :returns: ``True`` if the entry is a backup to rotate.
+        """
+        if self.exclude_matcher and self.exclude_matcher(entry):
+            listing_logger.debug("Excluded %r (it matched the exclude list).", entry)
+            return False
+        elif self.include_matcher and not self.include_matcher(entry):
+            listing_logger.debug("Excluded %r (it didn't match the include list).", entry)
+            return False
+        return True
 
     def group_backups(self, backups):
         """
@@ -239,12 +569,15 @@ class RotateBackupsCM(object):
                   rotation frequency.
         """
         backups_by_frequency = dict((frequency, collections.defaultdict(list)) for frequency in SUPPORTED_FREQUENCIES)
+        hourly, daily, weekly, monthly, yearly = (backups_by_frequency[frequency]
+                                                  for frequency, delta in ORDERED_FREQUENCIES)
         for b in backups:
-            backups_by_frequency['hourly'][(b.year, b.month, b.day, b.hour)].append(b)
-            backups_by_frequency['daily'][(b.year, b.month, b.day)].append(b)
-            backups_by_frequency['weekly'][(b.year, b.week)].append(b)
-            backups_by_frequency['monthly'][(b.year, b.month)].append(b)
-            backups_by_frequency['yearly'][b.year].append(b)
+            daily_key, weekly_key, monthly_key, yearly_key = b.day_keys
+            hourly[daily_key * 100 + b.datetime.hour].append(b)
+            daily[daily_key].append(b)
+            weekly[weekly_key].append(b)
+            monthly[monthly_key].append(b)
+            yearly[yearly_key].append(b)
         return backups_by_frequency
 
     def apply_rotation_scheme(self, backups_by_frequency, most_recent_backup):
@@ -267,28 +600,32 @@ class RotateBackupsCM(object):
             # Ignore frequencies not specified by the user.
             if frequency not in self.rotation_scheme:
                 backups.clear()
+                continue
+            retention_period = self.rotation_scheme[frequency]
+            minimum_date = None
+            if retention_period != 'always':
+                # Backups created before the minimum date of this rotation
+                # frequency (relative to the most recent backup) are removed.
+                minimum_date = most_recent_backup - SUPPORTED_FREQUENCIES[frequency] * retention_period
+            # One pass over the periods of this rotation frequency: reduce each
+            # period to a single backup (the first in the period, min() keeps
+            # the first of equal backups like a stable sort) and drop the
+            # periods whose backup is older than the minimum date.
+            periods = {}
+            for period, backups_in_period in backups.items():
+                first_backup = min(backups_in_period)
+                if minimum_date is None or not first_backup.datetime < minimum_date:
+                    periods[period] = [first_backup]
+            if minimum_date is None:
+                backups.clear()
+                backups.update(periods)
+            elif 0 < retention_period < len(periods):
+                # If there are more periods remaining than the user requested
+                # to be preserved we delete the oldest one(s).
+                backups_by_frequency[frequency] = dict(heapq.nlargest(retention_period, periods.items()))
             else:
-                # Reduce the number of backups in each period of this rotation
-                # frequency to a single backup (the first in the period).
-                for period, backups_in_period in backups.items():
-                    first_backup = sorted(backups_in_period)[0]
-                    backups[period] = [first_backup]
-                # Check if we need to rotate away backups in old periods.
-                retention_period = self.rotation_scheme[frequency]
-                if retention_period != 'always':
-                    # Remove backups created before the minimum date of this
-                    # rotation frequency (relative to the most recent backup).
-                    minimum_date = most_recent_backup - SUPPORTED_FREQUENCIES[frequency] * retention_period
-                    for period, backups_in_period in list(backups.items()):
-                        for backup in backups_in_period:
-                            if backup.datetime < minimum_date:
-                                backups_in_period.remove(backup)
-                        if not backups_in_period:
-                            backups.pop(period)
-                    # If there are more periods remaining than the user
-                    # requested to be preserved we delete the oldest one(s).
-                    items_to_preserve = sorted(backups.items())[-retention_period:]
-                    backups_by_frequency[frequency] = dict(items_to_preserve)
+                # a retention period of 0 keeps the periods left (like the slice [-0:] always did)
+                backups_by_frequency[frequency] = periods
 
     def find_preservation_criteria(self, backups_by_frequency):
         """
@@ -307,10 +644,41 @@ class RotateBackupsCM(object):
                     backups_to_preserve[backup].append(frequency)
         return backups_to_preserve
 
+    def preserve_incremental_chains(self, sorted_backups, backups_to_preserve):
+        """
+        Preserve the backups the preserved incremental backups depend on.
+        A full backup starts a chain, every incremental backup after it (see
+        :data:`INCREMENTAL_EXTENSIONS`) continues the chain, so the full backup
+        and the incremental backups before a preserved one are added to
+        ``backups_to_preserve`` with the reason 'incremental chain'.
+        :param sorted_backups: The :class:`list` of :class:`Backup` objects
+                               returned by :func:`collect_backups()`.
+        :param backups_to_preserve: The :class:`dict` returned by
+                                    :func:`find_preservation_criteria()`, it is
+                                    updated in place.
+        """
+        chain = []
+        for backup in sorted_backups:
+            name = parse_backup_name(os.path.basename(backup.pathname))
+            if name is None or name.extension not in INCREMENTAL_EXTENSIONS:
+                chain = [backup]
+                continue
+            chain.append(backup)
+            if backup in backups_to_preserve:
+                for needed in chain[:-1]:
+                    if needed not in backups_to_preserve:
+                        backups_to_preserve[needed].append('incremental chain')
+                # the backups before this one are preserved now
+                del chain[:-1]
+
     def custom_format_path(self, directory):
         return format_path(directory) if not self.rotate_type == 'remote' else directory
 
 
+_DAY_KEYS = {}
+"""The tuple ``(daily, weekly, monthly, yearly)`` of period keys of every day seen, see :class:`Backup`."""
+
+
 @functools.total_ordering
 class Backup(object):
     """
@@ -319,35 +687,92 @@ class Backup(object):
     objects support all of the attributes of :py:class:`~datetime.datetime`
     objects by deferring attribute access for unknown attributes to the
     :py:class:`~datetime.datetime` object given to the constructor.
+    The keys of the periods the backup belongs to are integers that sort
+    like the dates (see :attr:`period_keys`). The keys of a day are computed
+    once and the backups of that day share them in :attr:`day_keys`, the
+    hourly key is derived from them when it is needed. The objects have no
+    ``__dict__`` and four slots, so folders with 100k backups stay cheap to
+    keep and group.
     """
 
-    def __init__(self, pathname, datetime):
+    __slots__ = ('pathname', 'datetime', 'day_keys', '_type')
+
+    def __init__(self, pathname, datetime, file_type=None):
         """
         Initialize a :py:class:`Backup` object.
         :param pathname: The filename of the backup (a string).
         :param datetime: The date/time when the backup was created (a
                          :py:class:`~datetime.datetime` object).
+        :param file_type: The value of :attr:`type` when it is already known
+                          (from a :func:`os.scandir()` entry or because the
+                          backup is remote), it is looked up on first use
+                          otherwise.
         """
         self.pathname = pathname
         self.datetime = datetime
+        day = datetime.toordinal()
+        keys = _DAY_KEYS.get(day)
+        if keys is None:
+            # the backups of the same day share the tuple of keys of its periods
+            yearly = datetime.year
+            monthly = yearly * 100 + datetime.month
+            keys = _DAY_KEYS[day] = (monthly * 100 + datetime.day, yearly * 100 + datetime.isocalendar()[1],
+                                     monthly, yearly)
+        self.day_keys = keys
+        self._type = file_type
+
+    @property
+    def hourly_key(self):
+        return self.day_keys[0] * 100 + self.datetime.hour
+
+    @property
+    def daily_key(self):
+        return self.day_keys[0]
+
+    @property
+    def weekly_key(self):
+        return self.day_keys[1]
+
+    @property
+    def monthly_key(self):
+        return self.day_keys[2]
+
+    @property
+    def yearly_key(self):
+        return self.day_keys[3]
+
+    @property
+    def period_keys(self):
+        """The keys of the hourly, daily, weekly, monthly and yearly periods of the backup."""
+        return (self.hourly_key,) + self.day_keys
+
+    @property
+    def file_id(self):
+        """Get the Google Drive file id of a remote backup (its pathname is ``<file_id>_<name>``)."""
+        return self.pathname.split('_', 1)[0]
 
     @property
     def type(self):
         """Get a string describing the type of backup (e.g. file, directory)."""
-        if os.path.islink(self.pathname):
-            return 'symbolic link'
-        elif os.path.isdir(self.pathname):
-            return 'directory'
-        else:
-            return 'file'
+        if self._type is None:
+            if os.path.islink(self.pathname):
+                self._type = 'symbolic link'
+            elif os.path.isdir(self.pathname):
+                self._type = 'directory'
+            else:
+                self._type = 'file'
+        return self._type
 
     @property
     def week(self):
         """Get the ISO week number."""
-        return self.datetime.isocalendar()[1]
+        return self.day_keys[1] % 100
 
     def __getattr__(self, name):
         """Defer attribute access to the datetime object."""
+        if name in Backup.__slots__:
+            # an unset slot, not an attribute of the datetime
+            raise AttributeError(name)
         return getattr(self.datetime, name)
 
     def __repr__(self):
@@ -365,3 +790,15 @@ class Backup(object):
     def __lt__(self, other):
         """Enable proper sorting of backups."""
         return self.datetime < other.datetime
+
+
+def scandir_type(entry):
+    """
+    Get the :attr:`Backup.type` of a :func:`os.scandir()` entry without an
+    extra system call on most filesystems.
+    """
+    if entry.is_symlink():
+        return 'symbolic link'
+    elif entry.is_dir():
+        return 'directory'
+    return 'file'
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# autobackup-dcm: run the backups of several apps at the same time.
+# every app runs on its own worker thread; the resources they compete for have separate limits: dump slots
+# (load on the database server), compression threads (CPU, one pool shared by all the apps) and upload slots
+# (network bandwidth). Wall-clock times per app and of the whole run are reported at the end.
+#
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import collections
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Semi-standard module versioning.
+__version__ = '1.0'
+
+# Initialize a logger for this module.
+log = logging.getLogger('dacopancm.' + __name__)
+
+SCHEDULER_FILE = '../config/scheduler.json'
+
+DEFAULT_LIMITS = {
+    'apps': 4,
+    'dump_slots': 2,
+    'compress_threads': os.cpu_count() or 1,
+    'upload_slots': 2,
+    'drive_rate': 10.0,
+    'drive_burst': 20,
+    'metrics_textfile': None,
+}
+"""Limits used for the keys missing in :data:`SCHEDULER_FILE` (or when it does not exist), ``drive_rate`` and
+``drive_burst`` are the requests per second to Google Drive of all the apps together. ``metrics_textfile`` is
+where the node_exporter textfile of the run metrics is written (see :mod:`core.metrics_dcm`)."""
+
+
+def read_limits(path=SCHEDULER_FILE):
+    """Read the concurrency limits from a json file, missing keys take the value of :data:`DEFAULT_LIMITS`
+
+    :param path: the json file with the limits
+    :return: :class:`dict` with the keys of :data:`DEFAULT_LIMITS`
+    """
+    limits = dict(DEFAULT_LIMITS)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            limits.update(json.load(f))
+    return limits
+
+
+class ResourceLimitsCM(object):
+    """Slots of the resources shared by the apps that run at the same time, safe to use from any thread."""
+
+    def __init__(self, apps=1, dump_slots=1, compress_threads=1, upload_slots=1):
+        """
+        :param apps: maximum number of apps running at the same time.
+        :param dump_slots: maximum number of dumps reading from the database servers at the same time.
+        :param compress_threads: threads of the compression pool shared by all the apps.
+        :param upload_slots: maximum number of apps uploading to Google Drive at the same time.
+        """
+        self.apps = max(1, apps)
+        self.compress_threads = max(1, compress_threads)
+        self.semaphores = {'dump': threading.BoundedSemaphore(max(1, dump_slots)),
+                           'upload': threading.BoundedSemaphore(max(1, upload_slots))}
+        self.waits = collections.Counter()
+        self.held = threading.local()
+        self.lock = threading.Lock()
+        self._compress_executor = None
+
+    @classmethod
+    def from_config(cls, limits):
+        return cls(apps=limits['apps'], dump_slots=limits['dump_slots'],
+                   compress_threads=limits['compress_threads'], upload_slots=limits['upload_slots'])
+
+    @contextlib.contextmanager
+    def slot(self, resource, needed=True):
+        """Hold one slot of ``resource`` (``'dump'`` or ``'upload'``) for the ``with`` block, waiting for it if
+        all are in use. The time spent waiting is added to :attr:`waits`
+
+        A thread that already holds a slot of ``resource`` does not take a second one, so an upload that
+        streams during the dump can hold the upload slot around the whole backup.
+
+        :param needed: ``False`` to run the block without taking a slot
+        """
+        held = getattr(self.held, resource, False)
+        if not needed or held:
+            yield
+            return
+        semaphore = self.semaphores[resource]
+        start = time.time()
+        semaphore.acquire()
+        with self.lock:
+            self.waits[resource] += time.time() - start
+        setattr(self.held, resource, True)
+        try:
+            yield
+        finally:
+            setattr(self.held, resource, False)
+            semaphore.release()
+
+    @property
+    def compress_executor(self):
+        """The thread pool every :class:`~core.stream_dcm.ParallelGzipWriter` of this run compresses on."""
+        with self.lock:
+            if self._compress_executor is None:
+                self._compress_executor = ThreadPoolExecutor(max_workers=self.compress_threads)
+            return self._compress_executor
+
+    def shutdown(self):
+        with self.lock:
+            executor, self._compress_executor = self._compress_executor, None
+        if executor is not None:
+            executor.shutdown()
+
+
+def run_apps(apps, job, max_workers=1):
+    """Run ``job(app)`` for every app, up to ``max_workers`` at the same time
+
+    An exception raised by the job of one app is logged and does not stop the others.
+
+    :param apps: :class:`list` of apps (the :class:`dict` of each one in the config file)
+    :param job: the function to run for every app
+    :param max_workers: maximum number of jobs running at the same time
+    :return: :class:`collections.OrderedDict` with the name of every app as key and a tuple
+             ``(result, seconds)`` as value, and the wall-clock seconds of the whole run
+    """
+
+    def timed(app):
+        start = time.time()
+        try:
+            result = job(app)
+        except Exception:
+            log.exception("unexpected error running backups of '%s'", app['cfg']['app_name'])
+            result = None
+        return result, time.time() - start
+
+    start = time.time()
+    if max_workers <= 1 or len(apps) <= 1:
+        results = [timed(app) for app in apps]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(timed, apps))
+    return collections.OrderedDict(zip((app['cfg']['app_name'] for app in apps), results)), time.time() - start
+
+
+def log_timings(timings, elapsed, limits=None):
+    """Log the wall-clock time of every app and of the whole run returned by :func:`run_apps()`"""
+    for name, (result, seconds) in timings.items():
+        log.info("'%s' finished in %.1f seconds", name, seconds)
+    total = sum(seconds for result, seconds in timings.values())
+    log.info("%i apps finished in %.1f seconds of wall-clock (%.1f seconds one after another, %.1fx)",
+             len(timings), elapsed, total, total / elapsed if elapsed else 1.0)
+    if limits is not None and limits.waits:
+        log.info("time waiting for a slot: dump %.1f seconds, upload %.1f seconds",
+                 limits.waits['dump'], limits.waits['upload'])
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# autobackup-dcm: crash-safe store of the run state of every app.
+# the state of an app (the ``bk`` counters of the last backup of every type and the last backup created) changes on
+# every run, the config of the apps does not: the state is kept out of the config, one small JSON file per app
+# written to a temporary file, flushed to disk and renamed over the previous one. Saving an app costs the same
+# with one app or with hundreds, a crash leaves the previous state of the app, and apps running at the same time
+# never write the same file.
+#
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+
+# Semi-standard module versioning.
+__version__ = '1.0'
+
+# Initialize a logger for this module.
+log = logging.getLogger('dacopancm.' + __name__)
+
+STATE_DIR = '../data/state'
+"""Directory of the state files of the apps."""
+
+STATE_KEYS = ('bk', 'last_backup')
+"""Keys of an app :class:`dict` that are run state: loaded from the store over the config and saved to it."""
+
+DEFAULT_BK = {'last_year': 0, 'last_month': 0, 'last_week': 0, 'last_day': 0}
+"""The ``bk`` of an app that never had a backup, the first run creates its yearly backup."""
+
+_UNSAFE_CHARACTERS = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+def fsync_directory(directory):
+    """Flush a directory entry (a rename in it) to disk, where the platform allows it"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return  # windows can't open directories
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class AppStateStoreCM(object):
+    """The state of the apps, a JSON file per app in ``directory``."""
+
+    def __init__(self, directory=STATE_DIR):
+        """
+        :param directory: the directory of the state files, created when the first state is saved
+        """
+        self.directory = directory
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    def path(self, app_name):
+        return os.path.join(self.directory, _UNSAFE_CHARACTERS.sub('_', app_name) + '.json')
+
+    def lock(self, app_name):
+        with self.locks_lock:
+            return self.locks.setdefault(app_name, threading.Lock())
+
+    def load(self, app_name):
+        """Get the state of an app
+
+        :param app_name: the name of the app
+        :return: :class:`dict` with the state saved last, ``None`` if the app has no state (or it can't be read)
+        """
+        try:
+            with open(self.path(app_name), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.error("could not read the state of '%s', it starts again from the config: %s", app_name, e)
+            return None
+
+    def save(self, app_name, state):
+        """Replace the state of an app atomically: after a crash the file has the old state or the new one
+
+        :param app_name: the name of the app
+        :param state: :class:`dict` with the state, it must be serializable as JSON
+        """
+        path = self.path(app_name)
+        data = json.dumps(state, indent=2, sort_keys=True)
+        with self.lock(app_name):
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temporary = tempfile.mkstemp(dir=self.directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temporary, path)
+            except BaseException:
+                os.remove(temporary)
+                raise
+            fsync_directory(self.directory)
+
+    def apply(self, app):
+        """Put the saved state of an app in its config :class:`dict`, the keys of :data:`STATE_KEYS`. An app
+        without a state file keeps the ``bk`` of its config (where it was saved before the store existed)
+
+        :param app: :class:`dict` with the configuration of the app
+        :return: ``app``
+        """
+        state = self.load(app['cfg']['app_name'])
+        if state is None:
+            state = {'bk': dict(DEFAULT_BK, **app.get('bk', {}))}
+        for key in STATE_KEYS:
+            if key in state:
+                app[key] = state[key]
+        return app
+
+    def save_app(self, app):
+        """Save the keys of :data:`STATE_KEYS` of an app config :class:`dict`"""
+        self.save(app['cfg']['app_name'], dict((key, app[key]) for key in STATE_KEYS if key in app))
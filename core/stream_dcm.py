@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# autobackup-dcm: streaming helpers to pipe the output of a backup command into compressed files.
+# this module lets the dump and the compression run at the same time with bounded memory: the command
+# stdout is read in fixed-size chunks and every chunk is handed to a sink (compressor, file, ...)
+#
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import collections
+import hashlib
+import logging
+import os
+import subprocess
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Semi-standard module versioning.
+__version__ = '1.0'
+
+# Initialize a logger for this module.
+log = logging.getLogger('dacopancm.' + __name__)
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+"""Size in bytes of the buffer used to read the output of the backup command."""
+
+DEFAULT_COMPRESS_LEVEL = 6
+"""Default gzip compression level (the same used by ``gzip -c``)."""
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+"""Size in bytes of the independent blocks compressed by :class:`ParallelGzipWriter`."""
+
+CHECKSUM_ALGORITHMS = ('md5', 'sha256')
+"""Checksums computed by :class:`HashingWriter`, each one is saved next to the backup as ``<backup>.<algorithm>``."""
+
+
+class StreamCommandFailed(Exception):
+    """Raised by :func:`stream_command()` when the command exits with a non zero status."""
+
+    def __init__(self, command, returncode, error_message):
+        self.command = command
+        self.returncode = returncode
+        self.error_message = error_message
+        super().__init__("command {} failed with exit code {}: {}".format(command[0], returncode, error_message))
+
+
+class GzipWriter(object):
+    """
+    Sink that gzip compresses all data written to it into ``fileobj``.
+
+    The compressed stream is a standard ``.gz`` file readable by ``gzip -d``.
+    :func:`close()` must be called to write the gzip trailer, the underlying
+    ``fileobj`` is not closed.
+    """
+
+    def __init__(self, fileobj, compress_level=DEFAULT_COMPRESS_LEVEL):
+        """
+        Construct a :class:`GzipWriter` object.
+
+        :param fileobj: a binary file-like object where the compressed data is written.
+        :param compress_level: the gzip compression level (1-9).
+        """
+        self.fileobj = fileobj
+        self.compressor = zlib.compressobj(compress_level, zlib.DEFLATED, 31)
+        self.bytes_in = 0
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        compressed = self.compressor.compress(data)
+        if compressed:
+            self.fileobj.write(compressed)
+
+    def close(self):
+        self.fileobj.write(self.compressor.flush())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+class GunzipWriter(object):
+    """
+    Sink that decompresses the gzip data written to it into ``fileobj``, the counterpart of :class:`GzipWriter`.
+
+    The data may have several gzip members (the ``.gz`` of :class:`ParallelGzipWriter`), a new decompressor
+    starts where a member ends. The output is handed to ``fileobj`` in pieces of at most ``max_output`` bytes,
+    a highly compressed input does not use more memory. :func:`close()` fails if the data ends inside a member.
+    """
+
+    def __init__(self, fileobj, max_output=DEFAULT_CHUNK_SIZE):
+        """
+        Construct a :class:`GunzipWriter` object.
+
+        :param fileobj: a binary file-like object where the decompressed data is written.
+        :param max_output: maximum size in bytes of every write to ``fileobj``.
+        """
+        self.fileobj = fileobj
+        self.max_output = max_output
+        self.decompressor = zlib.decompressobj(31)
+        self.in_member = False
+        self.members = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.elapsed = 0.0
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        while True:
+            self.in_member = self.in_member or bool(data)
+            start = time.perf_counter()
+            output = self.decompressor.decompress(data, self.max_output)
+            self.elapsed += time.perf_counter() - start
+            if self.decompressor.eof:
+                data = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(31)
+                self.in_member = False
+                self.members += 1
+            else:
+                data = self.decompressor.unconsumed_tail
+            if output:
+                self.bytes_out += len(output)
+                self.fileobj.write(output)
+            # a full output may leave more data inside the decompressor even when all the input was consumed
+            if not data and len(output) < self.max_output:
+                break
+
+    def close(self):
+        if self.in_member:
+            raise zlib.error('the compressed data ends in the middle of gzip member {}'.format(self.members + 1))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+class TeeWriter(object):
+    """Sink that writes the same data to several file-like objects, for example the local backup and its upload."""
+
+    def __init__(self, *targets):
+        self.targets = targets
+
+    def write(self, data):
+        for target in self.targets:
+            target.write(data)
+
+
+class HashingWriter(object):
+    """
+    Sink that computes the checksums of :data:`CHECKSUM_ALGORITHMS` over the data written to it
+    while it passes it through to ``fileobj``, so the backup is not read again to verify it.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hashes = collections.OrderedDict((name, hashlib.new(name)) for name in CHECKSUM_ALGORITHMS)
+        self.elapsed = 0.0
+        self.size = 0
+
+    def write(self, data):
+        start = time.perf_counter()
+        for digest in self.hashes.values():
+            digest.update(data)
+        self.elapsed += time.perf_counter() - start
+        self.size += len(data)
+        self.fileobj.write(data)
+
+    def hexdigests(self):
+        return collections.OrderedDict((name, digest.hexdigest()) for name, digest in self.hashes.items())
+
+
+def checksum_file(path, algorithm):
+    return '{}.{}'.format(path, algorithm)
+
+
+def write_checksums(path, hexdigests):
+    """Save the checksums of ``path`` next to it, in the format of ``md5sum``/``sha256sum`` so ``-c`` verifies them.
+
+    :param path: the backup file.
+    :param hexdigests: :class:`dict` with the algorithm names as keys and the hex digests as values.
+    """
+    for algorithm, hexdigest in hexdigests.items():
+        with open(checksum_file(path, algorithm), 'w') as f:
+            f.write('{}  {}\n'.format(hexdigest, os.path.basename(path)))
+
+
+def read_checksum(path, algorithm):
+    """Get the checksum saved next to ``path`` by :func:`write_checksums()`, ``None`` if there is none."""
+    try:
+        with open(checksum_file(path, algorithm), 'r') as f:
+            return f.read().split()[0]
+    except (OSError, IndexError):
+        return None
+
+
+def remove_checksums(path):
+    for algorithm in CHECKSUM_ALGORITHMS:
+        if os.path.exists(checksum_file(path, algorithm)):
+            os.remove(checksum_file(path, algorithm))
+
+
+def compress_member(data, compress_level):
+    """Compress ``data`` as one complete gzip member (zlib releases the GIL while it works)."""
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter(object):
+    """
+    Sink that splits the data written to it in blocks and compresses them on a thread pool.
+
+    Every block becomes an independent gzip member and the members are written to ``fileobj``
+    in order, the result is a standard multi-member ``.gz`` file readable by ``gzip -d``. At
+    most ``threads * 2`` blocks are in flight, so the memory used is bounded by the block size.
+    """
+
+    def __init__(self, fileobj, threads=1, compress_level=DEFAULT_COMPRESS_LEVEL, block_size=DEFAULT_BLOCK_SIZE,
+                 executor=None):
+        """
+        Construct a :class:`ParallelGzipWriter` object.
+
+        :param fileobj: a binary file-like object where the compressed data is written.
+        :param threads: number of blocks compressed at the same time.
+        :param compress_level: the gzip compression level (1-9).
+        :param block_size: size in bytes of every independent block.
+        :param executor: an optional :class:`~concurrent.futures.Executor` shared with other writers,
+                         by default a private pool of ``threads`` threads is used.
+        """
+        self.fileobj = fileobj
+        self.compress_level = compress_level
+        self.block_size = block_size
+        self.max_pending = max(threads, 1) * 2
+        self.own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max(threads, 1))
+        self.pending = collections.deque()
+        self.block = bytearray()
+        self.members = 0
+        self.bytes_in = 0
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        self.block += data
+        if len(self.block) >= self.block_size:
+            self._submit()
+
+    def close(self):
+        if self.block or not self.members:
+            # an empty input still has to produce a valid gzip file
+            self._submit()
+        while self.pending:
+            self._write_next()
+        self._shutdown()
+
+    def _submit(self):
+        self.pending.append(self.executor.submit(compress_member, bytes(self.block), self.compress_level))
+        self.block = bytearray()
+        self.members += 1
+        while len(self.pending) >= self.max_pending:
+            self._write_next()
+
+    def _write_next(self):
+        self.fileobj.write(self.pending.popleft().result())
+
+    def _shutdown(self):
+        if self.own_executor:
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for future in self.pending:
+                future.cancel()
+            self.pending.clear()
+            self._shutdown()
+
+
+def stream_command(command, sink, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Run ``command`` and stream its stdout into ``sink`` while the command is still running.
+
+    The output is read through a single buffer of ``chunk_size`` bytes which is reused for every
+    read, so the memory used does not depend on the size of the output. The sink receives
+    :class:`memoryview` slices of that buffer, sinks that need to keep the data must copy it.
+
+    :param command: :class:`list` with the program and its arguments.
+    :param sink: object with a ``write(data)`` method, for example a :class:`GzipWriter`.
+    :param chunk_size: size in bytes of the read buffer.
+    :returns: the number of bytes produced by the command.
+    :raises: :exc:`StreamCommandFailed` when the command exits with a non zero status.
+    """
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    total = 0
+
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr, bufsize=0)
+        try:
+            while True:
+                size = process.stdout.readinto(buffer)
+                if not size:
+                    break
+                sink.write(view[:size])
+                total += size
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+
+        if returncode != 0:
+            stderr.seek(0)
+            error_message = stderr.read().decode('utf-8', 'replace').strip()
+            raise StreamCommandFailed(command, returncode, error_message)
+
+    log.debug("streamed %i bytes from %s", total, command[0])
+    return total
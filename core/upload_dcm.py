@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+# autobackup-dcm: resumable chunked uploads to Google Drive.
+# this module implements the Drive resumable upload protocol on top of an authorized ``httplib2.Http``:
+# the upload session URI is saved to disk so an upload interrupted by a crash continues on the next run
+# from the last offset acknowledged by Drive instead of starting again from byte zero.
+#
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import collections
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+# Modules included in our package.
+from core.metrics_dcm import bind, write_atomically
+from core.ratelimit_dcm import classify_error, classify_status, get_request_executor
+
+# Semi-standard module versioning.
+__version__ = '1.0'
+
+# Initialize a logger for this module.
+log = logging.getLogger('dacopancm.' + __name__)
+
+UPLOAD_URL = 'https://www.googleapis.com/upload/drive/v3/files'
+SESSION_DIR = '../data/uploads'
+
+CHUNK_ALIGNMENT = 256 * 1024
+"""Drive requires every chunk but the last one to be a multiple of 256 KiB."""
+
+DEFAULT_CHUNK_SIZE = 32 * CHUNK_ALIGNMENT
+
+RANGE_PATTERN = re.compile(r'bytes=0-(\d+)')
+
+
+class UploadFailed(Exception):
+    """Raised by :class:`ResumableUploadCM` when Drive refuses the upload or the retries are exhausted."""
+
+    def __init__(self, message, status=None, content=None):
+        self.status = status
+        self.content = content
+        super().__init__(message)
+
+
+def upload_error_reason(exception):
+    """Tell why a failed upload request should be retried, see :func:`~core.ratelimit_dcm.classify_error()`"""
+    if isinstance(exception, UploadFailed):
+        return classify_status(exception.status, exception.content) if exception.status else None
+    return classify_error(exception)
+
+
+def align_chunk_size(chunk_size):
+    """Round ``chunk_size`` down to a multiple of :data:`CHUNK_ALIGNMENT` (at least one)."""
+    return max(chunk_size // CHUNK_ALIGNMENT, 1) * CHUNK_ALIGNMENT
+
+
+class ResumableUploadCM(object):
+    """Upload one local file to Drive in chunks, resuming a session left by a previous run if there is one."""
+
+    def __init__(self, http, upload_url=UPLOAD_URL, chunk_size=DEFAULT_CHUNK_SIZE, session_dir=SESSION_DIR,
+                 retries=None):
+        """
+        Construct a :class:`ResumableUploadCM` object.
+
+        :param http: an authorized ``httplib2.Http`` that does not follow ``308`` redirects.
+        :param upload_url: the Drive upload endpoint.
+        :param chunk_size: bytes sent on every request, rounded to a multiple of 256 KiB.
+        :param session_dir: directory where the upload session URIs are saved.
+        :param retries: how many consecutive failed chunks are retried before giving up, the ``upload`` retry
+                        budget of the shared :class:`~core.ratelimit_dcm.RequestExecutorCM` by default.
+        """
+        self.http = http
+        self.upload_url = upload_url
+        self.chunk_size = align_chunk_size(chunk_size)
+        self.session_dir = session_dir
+        self.executor = get_request_executor()
+        self.retries = self.executor.budget('upload') if retries is None else retries
+        self.bytes_sent = 0
+        self.requests = 0
+
+    def upload(self, path, metadata, fields='id'):
+        """Upload the file ``path`` and return the metadata of the created Drive file.
+
+        :param path: the local path of the file to upload.
+        :param metadata: :class:`dict` with the Drive metadata of the new file (name, parents, ...).
+        :param fields: the fields of the created file returned by Drive.
+        :returns: :class:`dict` with the requested ``fields`` of the new file.
+        :raises: :exc:`UploadFailed` when the upload can not be completed, the session is kept on disk.
+        """
+        size = os.path.getsize(path)
+        session = self.load_session(path, size)
+        if session:
+            offset = self.query_offset(session['uri'], size)
+            if offset is None:
+                log.info('upload session of %s expired, starting again', path)
+                session = None
+            else:
+                log.info('resuming upload of %s at byte %i of %i', path, offset, size)
+        if not session:
+            session = self.start_session(path, size, metadata, fields)
+            offset = 0
+
+        with open(path, 'rb') as f:
+            while True:
+                f.seek(offset)
+                chunk = f.read(self.chunk_size)
+                status, result = self.put_chunk(session['uri'], chunk, offset, size)
+                if status == 'done':
+                    self.remove_session(path)
+                    return result
+                if status == 'expired':
+                    raise UploadFailed('upload session of {} expired'.format(path))
+                offset = result
+
+    def start_session(self, path, size, metadata, fields):
+        uri = self.open_session(metadata, fields, size)
+        session = {'uri': uri, 'path': os.path.abspath(path), 'size': size,
+                   'mtime': os.path.getmtime(path), 'parents': metadata.get('parents')}
+        self.save_session(path, session)
+        return session
+
+    def open_session(self, metadata, fields, size=None):
+        """Open a resumable upload session and return its URI, ``size`` may be unknown (``None``)."""
+        headers = {'Content-Type': 'application/json; charset=UTF-8',
+                   'X-Upload-Content-Type': 'application/octet-stream'}
+        if size is not None:
+            headers['X-Upload-Content-Length'] = str(size)
+        attempt = 0
+        while True:
+            resp, content = self.request('{}?uploadType=resumable&fields={}'.format(self.upload_url, fields),
+                                         'POST', json.dumps(metadata), headers)
+            if resp.status == 200 and 'location' in resp:
+                return resp['location']
+            reason = classify_status(resp.status, content)
+            if reason is None or attempt >= self.retries:
+                raise UploadFailed('could not start upload of {}: {} {}'.format(metadata.get('name'), resp.status,
+                                                                                content[:200]), resp.status, content)
+            self.executor.backoff('upload', attempt, reason)
+            attempt += 1
+
+    def put_chunk(self, uri, chunk, offset, size):
+        """Send ``chunk`` with :func:`send_chunk()`, when it fails because of the rate, on the server side or the
+        network, Drive is asked for the acknowledged offset after a backoff so the caller continues from there, up
+        to ``retries`` times.
+
+        :returns: the same as :func:`parse_status()`.
+        :raises: :exc:`UploadFailed` when the retries are exhausted or Drive refused the chunk.
+        """
+        failures = 0
+        while True:
+            try:
+                return self.send_chunk(uri, chunk, offset, size)
+            except Exception as e:
+                reason = upload_error_reason(e)
+                failures += 1
+                if failures > self.retries or reason is None:
+                    raise UploadFailed('upload failed at byte {}: {}'.format(offset, e))
+                log.warning('chunk at byte %i failed (%s), asking Drive for the offset', offset, e)
+                self.executor.backoff('upload', failures - 1, reason, e)
+                try:
+                    return self.query_status(uri, size)
+                except Exception as e:
+                    log.warning('could not query upload session: %s', e)
+
+    def send_chunk(self, uri, chunk, offset, size):
+        """Send ``chunk`` placed at ``offset`` of a file of ``size`` bytes (``'*'`` while the size is unknown).
+
+        :returns: the same as :func:`parse_status()`.
+        """
+        if chunk:
+            content_range = 'bytes {}-{}/{}'.format(offset, offset + len(chunk) - 1, size)
+        else:
+            content_range = 'bytes */{}'.format(size)  # empty file
+        self.bytes_sent += len(chunk)
+        resp, content = self.request(uri, 'PUT', chunk, {'Content-Range': content_range,
+                                                         'Content-Length': str(len(chunk))})
+        if resp.status >= 500:
+            raise UploadFailed('Drive answered {}'.format(resp.status), resp.status, content)
+        return self.parse_status(resp, content)
+
+    def query_status(self, uri, size):
+        resp, content = self.request(uri, 'PUT', b'', {'Content-Range': 'bytes */{}'.format(size),
+                                                       'Content-Length': '0'})
+        return self.parse_status(resp, content)
+
+    def query_offset(self, uri, size):
+        """Ask Drive how many bytes of an existing session it has, ``None`` if the session is gone."""
+        try:
+            status, result = self.query_status(uri, size)
+        except Exception as e:
+            log.warning('could not query upload session: %s', e)
+            return None
+        return result if status == 'incomplete' else None
+
+    @staticmethod
+    def parse_status(resp, content):
+        """Interpret a Drive answer to a chunk or a status query.
+
+        :returns: ``('done', metadata)`` when the file is complete, ``('incomplete', next_offset)`` while
+                  Drive waits for more bytes and ``('expired', None)`` when the session does not exist anymore.
+        """
+        if resp.status in (200, 201):
+            return 'done', json.loads(content.decode('utf-8'))
+        if resp.status == 308:
+            match = RANGE_PATTERN.match(resp.get('range', ''))
+            return 'incomplete', int(match.group(1)) + 1 if match else 0
+        if resp.status in (404, 410):
+            return 'expired', None
+        raise UploadFailed('unexpected Drive answer {}: {}'.format(resp.status, content[:200]), resp.status,
+                           content)
+
+    def request(self, uri, method, body, headers):
+        self.executor.acquire('upload')
+        self.requests += 1
+        return self.http.request(uri, method, body=body, headers=headers)
+
+    def session_file(self, path):
+        key = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+        return os.path.join(self.session_dir, key + '.json')
+
+    def load_session(self, path, size):
+        try:
+            with open(self.session_file(path), 'r') as f:
+                session = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # a session is only valid for the very same file content
+        if session.get('size') != size or session.get('mtime') != os.path.getmtime(path):
+            self.remove_session(path)
+            return None
+        return session
+
+    def save_session(self, path, session):
+        # written atomically, :func:`pending_uploads()` deletes the session files it can't read
+        write_atomically(self.session_file(path), json.dumps(session))
+
+    def remove_session(self, path):
+        try:
+            os.remove(self.session_file(path))
+        except OSError:
+            pass
+
+
+class StreamingUploadCM(object):
+    """
+    Sink that uploads a stream of unknown size to Drive while it is being produced.
+
+    The data written is queued and sent by a background thread in chunks of ``chunk_size`` bytes.
+    At most ``max_buffer`` bytes wait in the queue: when the network is slower than the producer
+    :func:`write()` blocks, which throttles the producer (the dump) and keeps memory bounded. If
+    the upload fails the writes are discarded without blocking and :func:`close()` returns ``None``,
+    so the caller can still upload the local copy afterwards.
+    """
+
+    def __init__(self, http, metadata, upload_url=UPLOAD_URL, chunk_size=DEFAULT_CHUNK_SIZE, max_buffer=None,
+                 fields='id', retries=3):
+        """
+        Construct a :class:`StreamingUploadCM` object and start its upload thread.
+
+        :param http: an authorized ``httplib2.Http`` used only by the upload thread.
+        :param metadata: :class:`dict` with the Drive metadata of the new file (name, parents, ...).
+        :param upload_url: the Drive upload endpoint.
+        :param chunk_size: bytes sent on every request, rounded to a multiple of 256 KiB.
+        :param max_buffer: maximum bytes queued before :func:`write()` blocks, by default 4 chunks.
+        :param fields: the fields of the created file returned by :func:`close()`.
+        :param retries: how many times a failed chunk is retried.
+        """
+        self.uploader = ResumableUploadCM(http, upload_url=upload_url, chunk_size=chunk_size, retries=retries)
+        self.metadata = metadata
+        self.fields = fields
+        self.max_buffer = max_buffer or 4 * self.uploader.chunk_size
+        self.queue = collections.deque()
+        self.buffered = 0
+        self.closed = False
+        self.error = None
+        self.result = None
+        self.throttled = 0.0
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=bind(self.run), name='streaming-upload', daemon=True)
+        self.thread.start()
+
+    def write(self, data):
+        if self.error is not None:
+            return
+        data = bytes(data)
+        with self.condition:
+            start = None
+            while self.buffered and self.buffered + len(data) > self.max_buffer and self.error is None:
+                start = start or time.perf_counter()
+                self.condition.wait()
+            if start is not None:
+                self.throttled += time.perf_counter() - start
+            if self.error is None:
+                self.queue.append(data)
+                self.buffered += len(data)
+                self.condition.notify_all()
+
+    def close(self):
+        """Wait until the whole stream is uploaded.
+
+        :returns: :class:`dict` with the requested ``fields`` of the new file, ``None`` if the upload failed.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        if self.error is not None:
+            log.warning('streaming upload of %s failed: %s', self.metadata.get('name'), self.error)
+            return None
+        if self.throttled:
+            log.info('streaming upload of %s throttled the producer for %.1f seconds', self.metadata.get('name'),
+                     self.throttled)
+        return self.result
+
+    def abort(self):
+        """Stop the upload, the incomplete upload session is left to expire on Drive."""
+        self.fail(UploadFailed('aborted'))
+        self.thread.join()
+
+    def fail(self, error):
+        with self.condition:
+            if self.error is None:
+                self.error = error
+            self.closed = True
+            self.queue.clear()
+            self.buffered = 0
+            self.condition.notify_all()
+
+    def take(self):
+        """Get the next queued data, ``None`` at the end of the stream."""
+        with self.condition:
+            while not self.queue and not self.closed:
+                self.condition.wait()
+            if self.error is not None or not self.queue:
+                return None
+            data = self.queue.popleft()
+            self.buffered -= len(data)
+            self.condition.notify_all()
+            return data
+
+    def run(self):
+        try:
+            uri = self.uploader.open_session(self.metadata, self.fields)
+            chunk_size = self.uploader.chunk_size
+            pending = bytearray()
+            offset = 0
+            while True:
+                data = self.take()
+                if data is None:
+                    break
+                pending += data
+                while len(pending) >= chunk_size:
+                    offset = self.send(uri, pending, offset, chunk_size, '*')
+            if self.error is not None:
+                return
+
+            # the last chunk tells Drive the total size, it may need several requests if Drive keeps part of it
+            size = offset + len(pending)
+            while self.result is None:
+                offset = self.send(uri, pending, offset, len(pending), size)
+        except Exception as e:
+            self.fail(e)
+
+    def send(self, uri, pending, offset, length, size):
+        """Send the first ``length`` bytes of ``pending`` and drop from it the bytes Drive acknowledged.
+
+        :returns: the new offset, when the file is complete :attr:`result` is set with its metadata.
+        """
+        stalls = 0
+        while True:
+            status, result = self.uploader.put_chunk(uri, bytes(pending[:length]), offset, size)
+            if status == 'done':
+                self.result = result
+                return offset + len(pending)
+            if status != 'incomplete' or result < offset:
+                raise UploadFailed('unexpected answer to chunk at byte {}: {}'.format(offset, status))
+            if result > offset:
+                del pending[:result - offset]
+                return result
+            # nothing acknowledged (the chunk failed and Drive still has the same offset), send it again
+            stalls += 1
+            if stalls > self.uploader.retries:
+                raise UploadFailed('upload does not progress at byte {}'.format(offset))
+
+
+def pending_uploads(session_dir=SESSION_DIR, parents=None):
+    """Get the local files whose upload was interrupted and still exist, optionally only for some ``parents``.
+
+    The sessions of files that do not exist anymore (rotated away before the upload was resumed) and the session
+    files that can't be read are deleted.
+
+    :param session_dir: directory where :class:`ResumableUploadCM` saves the upload sessions.
+    :param parents: the Drive folder ids of the uploads to return, ``None`` returns all.
+    :returns: :class:`list` with the local paths.
+    """
+    files = []
+    if not os.path.isdir(session_dir):
+        return files
+    for entry in sorted(os.listdir(session_dir)):
+        if entry.startswith('.') or not entry.endswith('.json'):
+            continue  # a session being written
+        session_path = os.path.join(session_dir, entry)
+        try:
+            with open(session_path, 'r') as f:
+                session = json.load(f)
+            path = session['path']
+        except FileNotFoundError:
+            continue  # removed by an upload that just finished
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning("removing unreadable upload session %s: %s", entry, e)
+            remove_file(session_path)
+            continue
+        if not os.path.exists(path):
+            log.info("removing the upload session of %s, the file does not exist anymore", path)
+            remove_file(session_path)
+        elif parents is None or session.get('parents') == parents:
+            files.append(path)
+    return files
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
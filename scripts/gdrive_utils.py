@@ -11,6 +11,7 @@ import json
 import logging.config
 
 # Modules included in our package.
+from core import setup_logging
 from core.gdrive_dcm import GDriveCM
 
 # Initialize a logger for this module.
@@ -21,6 +22,7 @@ GOOGLE_CREDENTIALS_NAME = "setup-autobackup-dcm.json"
 
 
 def main():
+    setup_logging()
     print('Google drive folders in root')
     gdrive = GDriveCM(google_credentials_name=GOOGLE_CREDENTIALS_NAME,
                       google_authorized=False)
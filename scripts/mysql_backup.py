@@ -1,6 +1,16 @@
 #!/usr/bin/env python
 # autobackup-dcm: Simple python script to autobackup, rotate backup and upload to google drive.
 # this script create one daily incremental backups (if you need), and one full backup each week, month and year
+# incremental backups are the binary logs since the previous backup (app_name_DATE_HOUR_daily.binlog.gz), enable
+# them with "incremental": {"enabled": true} in the app config, the server must have binary logging enabled
+# with "parallel": {"enabled": true} full backups dump the tables on several connections, one gzip member per table
+# and a manifest next to the backup (app_name_DATE_HOUR_BACKTYPE.gz.manifest.json) with the offset of every table
+# with "dedup": {"enabled": true} full backups are stored in chunks shared with the other backups of the app, the
+# backup is the list of its chunks (app_name_DATE_HOUR_BACKTYPE.chunks.json) and only new chunks are uploaded
+# run it from cron, or once with --daemon: the backups of every app then run from its timetable, for example
+# "schedule": {"time": "03:00", "hourly": true} (with hourly backups, incremental ones if they are enabled), and
+# --status and --trigger APP ask the running daemon for the state of the apps and to run the backup of one now
+# the backups are restored with mysql_restore.py, from the local backups or streamed from Google Drive
 #
 # backups should be created and named as: app_name_DATE_HOUR_BACKTYPE.EXTENSION for example:
 # jom_2015-12-25_09-58_daily.gz
@@ -8,16 +18,29 @@
 # URL: https://github.com/dacopan/autobackup-dcm
 
 # Standard library modules.
+import argparse
+import contextlib
+import json
 import logging.config
 import os
+import sys
 import time
 
 # External dependencies.
 from humanfriendly import format_path, Timer
-from executor import execute, ExternalCommandFailed
 
 # Modules included in our package.
+from core import setup_logging
+from core.daemon_dcm import BACKUP_TYPES, DAEMON_SOCKET, send_command
+from core.dedup_dcm import CHUNK_DIR, CHUNKS_EXTENSION, DEFAULT_AVERAGE_CHUNK, ChunkStoreCM, DedupWriter
+from core.dedup_dcm import is_dedup_backup
 from core.generic_backup import GenericBackupCM
+from core.metrics_dcm import stage
+from core.mysql_dcm import BINLOG_START_POSITION, BinlogPositionWriter, MysqlClientCM, binlog_files_since
+from core.paralleldump_dcm import DEFAULT_LOCK_TIMEOUT, DEFAULT_WORKERS, ParallelDumpCM, remove_manifest
+from core.paralleldump_dcm import write_manifest
+from core.stream_dcm import DEFAULT_COMPRESS_LEVEL, HashingWriter, ParallelGzipWriter, StreamCommandFailed, TeeWriter
+from core.stream_dcm import remove_checksums, stream_command, write_checksums
 
 # Semi-standard module version.
 __version__ = '1.0'
@@ -26,6 +49,12 @@ log = logging.getLogger('dacopancm.mysql')
 
 # constants
 CONFIG_FILE = '../config/mysql_config.json'
+MYSQL_BIN = '/opt/lamp/mysql/bin/mysql'
+MYSQLDUMP_BIN = '/opt/lamp/mysql/bin/mysqldump'
+MYSQLBINLOG_BIN = '/opt/lamp/mysql/bin/mysqlbinlog'
+# a consistent snapshot that starts a new binary log, its coordinates are written in the header of the dump
+BINLOG_DUMP_OPTIONS = ['--single-transaction', '--flush-logs', '--master-data=2']
+INCREMENTAL_EXTENSION = 'binlog.gz'
 
 
 class MysqlBackupCM(GenericBackupCM):
@@ -39,11 +68,23 @@ class MysqlBackupCM(GenericBackupCM):
             return self.create_full_backup(app, backup_type)
         elif backup_type == 'weekly':
             return self.create_full_backup(app, backup_type)
-        elif backup_type == 'daily':
+        elif backup_type in ('daily', 'hourly'):
+            if app.get('incremental', {}).get('enabled'):
+                return self.create_incremental_backup(app, backup_type)
             return self.create_full_backup(app, backup_type)
         else:
             return False
 
+    def get_mysqlcm(self, app):
+        """ Get a :class:`~core.mysql_dcm.MysqlClientCM` connected as the database user of this app """
+        return MysqlClientCM(MYSQL_BIN, app['custom']['db_user'], app['custom']['db_password'],
+                             host=app['custom'].get('db_host'))
+
+    def backup_filename(self, app, backup_type, extension):
+        filestamp = time.strftime('%Y-%m-%d_%H-%M')
+        return '{}{}_{}_{}.{}'.format(app['cfg']['local_backup_dir'], app['cfg']['app_name'], filestamp,
+                                      backup_type, extension)
+
     def create_full_backup(self, app, backup_type):
         """Create a full backup of a database defined in attr:´app´
 
@@ -53,59 +94,262 @@ class MysqlBackupCM(GenericBackupCM):
         """
         log.info("starting full backup_{} to '{}'".format(backup_type, app['cfg']['app_name']))
 
-        filestamp = time.strftime('%Y-%m-%d_%H-%M')
+        # the binary log coordinates of the dump are where the next incremental backup starts
+        incremental = app.get('incremental', {}).get('enabled', False)
+        if app.get('parallel', {}).get('enabled'):
+            backup_file = self.backup_filename(app, backup_type, 'gz')
+            return self.stream_backup(app, backup_type, backup_file,
+                                      self.parallel_dump(app, backup_file, incremental), 'full')
+
+        mysql_cmd = [MYSQLDUMP_BIN, '--opt', '--triggers', '--events',
+                     '--user={}'.format(app['custom']['db_user']),
+                     '--password={}'.format(app['custom']['db_password'])]
+        if incremental:
+            mysql_cmd += BINLOG_DUMP_OPTIONS
+        mysql_cmd += ['--databases', app['custom']['db_name']]
+
+        if app.get('dedup', {}).get('enabled'):
+            backup_file = self.backup_filename(app, backup_type, CHUNKS_EXTENSION)
+            return self.stream_backup(app, backup_type, backup_file,
+                                      self.dedup_dump(app, mysql_cmd, backup_file, incremental), 'full')
+        backup_file = self.backup_filename(app, backup_type, 'gz')
+        return self.stream_backup(app, backup_type, backup_file, self.command_dump(app, mysql_cmd, incremental),
+                                  'full')
+
+    def create_incremental_backup(self, app, backup_type):
+        """Create a incremental backup of a database defined in attr:´app´: the binary logs written since the
+        previous backup of its chain, read from the server with ``mysqlbinlog``. A full backup is created
+        instead when the chain can't continue (no previous backup with binary log coordinates, or its binary
+        log was purged from the server)
+
+            :param app: :class:`dict` with configuration returned by :func:`read_config()`
+            :param backup_type: the key backup type to include in backup filename: daily, weekly, monthly, yearly
+            :return: ``True`` if local and remote backup created correctly, ``False`` otherwise
+        """
+
+        log.info("starting incremental backup_{} to '{}'".format(backup_type, app['cfg']['app_name']))
+
+        local_backup_dir = os.path.abspath(app['cfg']['local_backup_dir'])
+        head = self.catalog.chain_head('local', local_backup_dir)
+        base = (head.base or head.name) if head else None
+        if head is None or not os.path.exists(os.path.join(local_backup_dir, base)):
+            log.info("no backup of '{}' to continue from, creating a full backup".format(app['cfg']['app_name']))
+            return self.create_full_backup(app, backup_type)
+
+        mysqlcm = self.get_mysqlcm(app)
+        try:
+            # the binary logs up to now are closed, the chain continues at the start of the new one
+            mysqlcm.flush_binary_logs()
+            current_file = mysqlcm.master_status()[0]
+            binlog_files = binlog_files_since(mysqlcm.binary_logs(), head.binlog_file, current_file)
+        except StreamCommandFailed as ex:
+            log.error("error reading binary logs of '{}' :{}".format(app['cfg']['app_name'], ex.error_message))
+            return False
+        if binlog_files is None:
+            log.warning("binary log {} of '{}' is not on the server anymore, creating a full backup".format(
+                head.binlog_file, app['cfg']['app_name']))
+            return self.create_full_backup(app, backup_type)
+        if not binlog_files:
+            # the flush did not open a new binary log, the one the chain continues from is still being written
+            log.error("binary log {} of '{}' was not closed by the flush, nothing to back up".format(
+                head.binlog_file, app['cfg']['app_name']))
+            return False
+
+        backup_file = self.backup_filename(app, backup_type, INCREMENTAL_EXTENSION)
+        binlog_cmd = ([MYSQLBINLOG_BIN, '--read-from-remote-server'] + mysqlcm.connection_args() +
+                      ['--start-position={}'.format(head.binlog_position),
+                       '--database={}'.format(app['custom']['db_name'])] + binlog_files)
+
+        return self.stream_backup(app, backup_type, backup_file, self.command_dump(app, binlog_cmd), 'incremental',
+                                  base=base, binlog_position=(current_file, BINLOG_START_POSITION))
+
+    def command_dump(self, app, command, sniff_position=False):
+        """Get the dump function of :func:`stream_backup()` that compresses the output of command
+
+        :param app: :class:`dict` with configuration returned by :func:`read_config()`
+        :param command: the dump command, its output is the backup
+        :param sniff_position: ``True`` to read the binary log coordinates from the header of a ``mysqldump`` output
+        """
+        compress = app.get('compress', {})
 
-        backup_file = '{}{}_{}_{}.{}'.format(app['cfg']['local_backup_dir'], app['cfg']['app_name'], filestamp,
-                                             backup_type,
-                                             'gz')
+        def dump(output):
+            # the output is compressed on the thread pool shared by all the apps while the command is running
+            with ParallelGzipWriter(output, threads=compress.get('threads', 1),
+                                    compress_level=compress.get('level', DEFAULT_COMPRESS_LEVEL),
+                                    executor=self.limits.compress_executor) as gzip_writer:
+                sink = BinlogPositionWriter(gzip_writer) if sniff_position else gzip_writer
+                dump_size = stream_command(command, sink)
+            if sniff_position and sink.position is None:
+                log.warning("no binary log coordinates in the dump of '{}', incremental backups will "
+                            "start after the next full backup".format(app['cfg']['app_name']))
+            return dump_size, sink.position if sniff_position else None
 
-        # here create backup
+        return dump
+
+    def dedup_dump(self, app, command, backup_file, sniff_position=False):
+        """Get the dump function of :func:`stream_backup()` that stores the output of command in the chunk store
+        next to backup_file and writes the manifest of its chunks, see :mod:`core.dedup_dcm`
+
+        :param app: :class:`dict` with configuration returned by :func:`read_config()`
+        :param command: the dump command, its output is the backup
+        :param backup_file: the local path of the manifest
+        :param sniff_position: ``True`` to read the binary log coordinates from the header of a ``mysqldump`` output
+        """
+        dedup = app.get('dedup', {})
+        compress = app.get('compress', {})
+        store = ChunkStoreCM(os.path.join(os.path.dirname(backup_file), CHUNK_DIR),
+                             compress_level=compress.get('level', DEFAULT_COMPRESS_LEVEL))
+
+        def dump(output):
+            with DedupWriter(store, average=dedup.get('average_chunk', DEFAULT_AVERAGE_CHUNK),
+                             threads=compress.get('threads', 1),
+                             executor=self.limits.compress_executor) as dedup_writer:
+                sink = BinlogPositionWriter(dedup_writer) if sniff_position else dedup_writer
+                dump_size = stream_command(command, sink)
+            output.write(json.dumps(dedup_writer.manifest()).encode('utf-8'))
+            log.info("{} of {} chunks of '{}' are new ({} bytes stored)".format(
+                len(dedup_writer.new_chunks), len(dedup_writer.chunks), app['cfg']['app_name'], dedup_writer.stored))
+            if sniff_position and sink.position is None:
+                log.warning("no binary log coordinates in the dump of '{}', incremental backups will "
+                            "start after the next full backup".format(app['cfg']['app_name']))
+            return dump_size, sink.position if sniff_position else None
+
+        return dump
+
+    def parallel_dump(self, app, backup_file, incremental=False):
+        """Get the dump function of :func:`stream_backup()` that dumps the tables on several connections and
+        saves the manifest of the dump next to backup_file, see :class:`~core.paralleldump_dcm.ParallelDumpCM`
+
+        :param app: :class:`dict` with configuration returned by :func:`read_config()`
+        :param backup_file: the local path of the backup
+        :param incremental: ``True`` to read the binary log coordinates of the snapshot
+        """
+        parallel = app.get('parallel', {})
+        compress = app.get('compress', {})
+        dumper = ParallelDumpCM(self.get_mysqlcm(app), MYSQLDUMP_BIN, app['custom']['db_name'],
+                                workers=parallel.get('workers', DEFAULT_WORKERS),
+                                lock_timeout=parallel.get('lock_timeout', DEFAULT_LOCK_TIMEOUT),
+                                dump_options=parallel.get('dump_options', []),
+                                compress_threads=compress.get('threads', 1),
+                                compress_level=compress.get('level', DEFAULT_COMPRESS_LEVEL),
+                                executor=self.limits.compress_executor,
+                                spool_dir=os.path.dirname(backup_file) or None, binlog=incremental)
+
+        def dump(output):
+            write_manifest(backup_file, dumper.dump(output))
+            return dumper.dump_size, dumper.position
+
+        return dump
+
+    def stream_backup(self, app, backup_type, backup_file, dump, kind, base=None, binlog_position=None):
+        """Write a dump to backup_file, record it in the catalog and upload it
+
+        :param app: :class:`dict` with configuration returned by :func:`read_config()`
+        :param backup_type: the key backup type to include in backup filename: daily, weekly, monthly, yearly
+        :param backup_file: the local path of the backup
+        :param dump: a function that writes the compressed dump to the file-like object it is given, it returns a
+                     tuple ``(dump_size, binlog_position)``, see :func:`command_dump()` and :func:`parallel_dump()`
+        :param kind: 'full' or 'incremental', for the log
+        :param base: the name of the full backup an incremental backup depends on
+        :param binlog_position: the binary log coordinates ``(binlog_file, binlog_position)`` where the backup ends,
+                                when the dump does not return them
+        :return: ``True`` if local and remote backup created correctly, ``False`` otherwise
+        """
+        streaming_upload = None
+        upload_slot = contextlib.ExitStack()
         try:
             os.makedirs(os.path.dirname(backup_file), exist_ok=True)
             timer = Timer()
 
-            mysql_cmd = '/opt/lamp/mysql/bin/mysqldump '
-            mysql_cmd += '--opt --triggers --events --user={} --password={} --databases {}'.format(
-                app['custom']['db_user'], app['custom']['db_password'], app['custom']['db_name'])
+            # in upload mode 'tee' the compressed stream goes to the local file and to Google Drive in one pass,
+            # the app holds its upload slot from the start of the dump to the end of the upload
+            tee = app.get('upload', {}).get('mode') == 'tee' and not is_dedup_backup(backup_file)
+            upload_slot.enter_context(self.limits.slot('upload', needed=tee))
+            with self.limits.slot('dump'):
+                with stage('dump') as scope:
+                    streaming_upload = self.open_streaming_upload(app, backup_file)
 
-            gzip_cmd = 'gzip -c > {}'.format(format_path(backup_file))
+                    # the compressed dump is written to disk while it is running, the checksums of the compressed
+                    # bytes are computed on the way
+                    with open(backup_file, 'wb') as f:
+                        hashing_writer = HashingWriter(TeeWriter(f, streaming_upload) if streaming_upload else f)
+                        dump_size, position = dump(hashing_writer)
+                    scope.add_bytes(dump_size)
+                # the checksums are computed during the dump, their share of it is a stage of its own
+                scope.metrics.add(app['cfg']['app_name'], 'checksum', hashing_writer.elapsed, bytes=hashing_writer.size)
+                binlog_position = position or binlog_position
+                write_checksums(backup_file, hashing_writer.hexdigests())
+                self.record_backup(app, backup_file, backup_type, hashing_writer.hexdigests(), base=base,
+                                   binlog_position=binlog_position)
+                dump_timer = str(timer)
 
-            mysql_cmd_res = execute(mysql_cmd, logger=log, capture=True)
-            cmd_result = execute(gzip_cmd, logger=log, input=mysql_cmd_res, error_message='error en gzip')
-
-            if cmd_result:
-                log.info(
-                    "finish full backup_{} to '{}:{} in {}'".format(backup_type, app['cfg']['app_name'],
-                                                                    format_path(backup_file), timer))
-                cmd_result = self.upload_backup(app, backup_file)
-            else:
-                log.error("error creating full backup_{} to '{}'".format(backup_type, app['cfg']['app_name']))
-            return cmd_result
-        except ExternalCommandFailed as ex:
+            log.info(
+                "finish {} backup_{} to '{}:{} ({} bytes dumped) in {}'".format(kind, backup_type,
+                                                                                app['cfg']['app_name'],
+                                                                                format_path(backup_file), dump_size,
+                                                                                dump_timer))
+            upload_timer = Timer()
+            streamed = streaming_upload.close() if streaming_upload else None
+            result = self.upload_backup(app, backup_file, streamed=streamed)
+            log.info("stage timings of '{}': dump {}, checksum {:.3f} seconds, upload and verify {}".format(
+                app['cfg']['app_name'], dump_timer, hashing_writer.elapsed, upload_timer))
+            return result
+        except (StreamCommandFailed, OSError) as ex:
             log.error(
-                "error creating full backup_{} to '{} :{}'".format(backup_type, app['cfg']['app_name'],
-                                                                   ex.error_message))
+                "error creating {} backup_{} to '{} :{}'".format(kind, backup_type, app['cfg']['app_name'],
+                                                                 getattr(ex, 'error_message', ex)))
+            self.discard_backup(backup_file, streaming_upload)
+            return False
+        except BaseException:
+            # any other error (the catalog, the compressor, the rate limiter, an interrupt) is raised to the
+            # caller after the same cleanup
+            self.discard_backup(backup_file, streaming_upload)
+            raise
+        finally:
+            upload_slot.close()
 
-    def create_incremental_backup(self, app, backup_type):
-        """Create a incremental backup of a database defined in attr:´app´
+    @staticmethod
+    def discard_backup(backup_file, streaming_upload=None):
+        """Stop the streaming upload of a backup that failed and remove its files
 
-            :param app: :class:`dict` with configuration returned by :func:`read_config()`
-            :param backup_type: the key backup type to include in backup filename: daily, weekly, monthly, yearly
-            :return: ``True`` if local and remote backup created correctly, ``False`` otherwise
+        :param backup_file: the local path of the backup
+        :param streaming_upload: the :class:`~core.upload_dcm.StreamingUploadCM` of the backup, if any
         """
+        if streaming_upload:
+            streaming_upload.abort()
+        # never leave a truncated dump that rotation could take as a valid backup
+        if os.path.exists(backup_file):
+            os.remove(backup_file)
+        remove_checksums(backup_file)
+        remove_manifest(backup_file)
 
-        log.info("starting incremental backup_{} to '{}'".format(backup_type, app['cfg']['app_name']))
 
-        filestamp = time.strftime('%Y-%m-%d_%H-%M')
-        backup_file = '{}{}_{}_{}.{}'.format(app['cfg']['local_backup_dir'], app['cfg']['app_name'], filestamp,
-                                             backup_type,
-                                             'gz')
-        # TODO here create incremental backup if you need
-
-        self.upload_backup(app, backup_file)
+def main():
+    parser = argparse.ArgumentParser(description='Backup, rotate and upload to Google Drive the MySQL databases')
+    parser.add_argument('--daemon', action='store_true', help='keep running and back up every app on its timetable')
+    parser.add_argument('--status', action='store_true', help='print the state of the apps of the running daemon')
+    parser.add_argument('--trigger', metavar='APP', help='ask the running daemon to back up APP now: the backup '
+                                                         'that is due, or a daily one')
+    parser.add_argument('--type', choices=BACKUP_TYPES, help='with --trigger, the type of backup to create '
+                                                             'instead of the one that is due')
+    parser.add_argument('--socket', default=DAEMON_SOCKET, help='control socket of the daemon')
+    # the arguments of the Google authorization flow are parsed by core.gdrive_dcm
+    args = parser.parse_known_args()[0]
+    setup_logging()
 
-        log.info("finish incremental backup_{} to '{}:{}'".format(backup_type, app['cfg']['app_name'], backup_file))
+    if args.status or args.trigger:
+        if args.trigger:
+            response = send_command('trigger', args.socket, app=args.trigger, type=args.type)
+        else:
+            response = send_command('status', args.socket)
+        print(json.dumps(response, indent=2))
+        return 0 if response.get('ok') else 1
+    if args.daemon:
+        MysqlBackupCM().run_daemon(args.socket)
+    else:
+        MysqlBackupCM().run_backups()
+    return 0
 
 
 if __name__ == "__main__":
-    MysqlBackupCM().run_backups()
+    sys.exit(main())
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# autobackup-dcm: Simple python script to restore the backups created by mysql_backup.py.
+# the backup is streamed into the mysql client: read from the local backup directory, from the cache of downloaded
+# backups (../data/cache) or downloaded from Google Drive with parallel range requests, and decompressed on the way,
+# the uncompressed dump is never written to disk. An incremental backup is restored with its full backup and the
+# incremental backups before it. The time of every stage of the restore is logged when it ends.
+#
+# for example, the latest backup of the app jom, or one of its backups into a file instead of the server:
+# python mysql_restore.py jom
+# python mysql_restore.py jom --backup jom_2015-12-25_09-58_daily.gz --output jom.sql
+# Author: dacopanCM <dacopan.bsc@gmail.com>
+# URL: https://github.com/dacopan/autobackup-dcm
+
+# Standard library modules.
+import argparse
+import json
+import logging.config
+import os
+import sys
+
+# Modules included in our package.
+from core import setup_logging
+from core.download_dcm import DEFAULT_DOWNLOADS, DEFAULT_RANGE_SIZE
+from core.metrics_dcm import app_scope, log_report, stage, start_run, write_atomically
+from core.mysql_dcm import MysqlImportWriter
+from core.restore_dcm import CACHE_DIR, DEFAULT_CACHE_SIZE, ArtifactCacheCM, RestoreCM, restore_summary
+from mysql_backup import INCREMENTAL_EXTENSION, MysqlBackupCM
+
+# Semi-standard module version.
+__version__ = '1.0'
+
+log = logging.getLogger('dacopancm.mysql')
+
+
+def get_restorecm(backup, app, args):
+    """Get the :class:`~core.restore_dcm.RestoreCM` of an app with the options of the command line"""
+    return RestoreCM(app['cfg']['app_name'], app['cfg']['local_backup_dir'],
+                     remote_dir=app['cfg']['remote_backup_dir'], catalog=backup.catalog,
+                     gdrivecm=None if args.local else backup.get_gdrivecm(app),
+                     cache=ArtifactCacheCM(args.cache_dir, args.cache_size) if args.cache_size > 0 else None,
+                     range_size=args.range_size, workers=args.downloads,
+                     incremental_extension=INCREMENTAL_EXTENSION)
+
+
+def list_backups(restorecm):
+    for name, source in restorecm.backups().items():
+        print('{}  {}{}'.format(name, ','.join(source.locations()),
+                                '  (incremental of {})'.format(source.base) if source.base else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Restore a backup of a MySQL database created by mysql_backup.py')
+    parser.add_argument('app', help='the app_name of the database in the config')
+    parser.add_argument('--backup', metavar='NAME', help='the backup to restore, the latest one by default')
+    parser.add_argument('--list', action='store_true', help='list the backups that can be restored')
+    parser.add_argument('--output', metavar='FILE', help='write the SQL to FILE instead of importing it')
+    parser.add_argument('--database', help='the default database of the import')
+    parser.add_argument('--local', action='store_true', help='do not use Google Drive, only the local backups '
+                                                             'and the cache')
+    parser.add_argument('--downloads', type=int, default=DEFAULT_DOWNLOADS,
+                        help='range requests (or chunks) downloaded at the same time')
+    parser.add_argument('--range-size', type=int, default=DEFAULT_RANGE_SIZE, help='bytes of every range request')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='directory of the downloaded backups')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help='bytes the downloaded backups may use, 0 to not keep them')
+    parser.add_argument('--report', metavar='FILE', help='write the metrics of the restore as JSON to FILE')
+    # the arguments of the Google authorization flow are parsed by core.gdrive_dcm
+    args = parser.parse_known_args()[0]
+    setup_logging()
+
+    backup = MysqlBackupCM()
+    apps = [app for app in backup.read_config() if app['cfg']['app_name'] == args.app]
+    if not apps:
+        log.error("app '%s' not found in %s", args.app, backup.CONFIG_FILE)
+        return 1
+    app = apps[0]
+    restorecm = get_restorecm(backup, app, args)
+    if args.list:
+        list_backups(restorecm)
+        return 0
+
+    metrics = start_run()
+    sink = None
+    try:
+        with app_scope(args.app), stage('restore'):
+            sink = open(args.output, 'wb') if args.output else MysqlImportWriter(backup.get_mysqlcm(app),
+                                                                                 args.database)
+            chain = restorecm.restore(sink, args.backup)
+    except Exception as e:
+        log.error("error restoring '%s': %s", args.app, getattr(e, 'error_message', e))
+        if args.output and sink:
+            # never leave a partial dump that could be taken as a complete one
+            sink.close()
+            os.remove(args.output)
+        elif sink:
+            sink.abort()
+        return 1
+    metrics.finish()
+
+    report = metrics.report()
+    log_report(report)
+    log.info("restored '%s' to %s from %s in %.1f seconds: %s", args.app, args.output or 'the server',
+             chain[-1].name, report['apps'][args.app]['stages']['restore']['seconds'],
+             restore_summary(report, args.app))
+    if args.report:
+        write_atomically(args.report, json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())